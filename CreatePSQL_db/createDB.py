@@ -1,7 +1,12 @@
+import glob
+import os
 import pandas as pd
-from sqlalchemy import create_engine, text
 import psycopg2
-from sqlalchemy import Date
+from rollups import refresh_rollups
+from tag_tokens import TagVocabulary, add_tag_ids
+from schema import (advised_indexes, chunk_months, copy_chunk, create_partitions, index_partition,
+                    month_bounds, partition_name, partitions, text_columns, yt_columns, yt_indexes,
+                    yt_table_ddl)
 
 # --------- CONFIGURATION ----------
 csv_file = 'all_month_yt_data.csv'
@@ -11,8 +16,183 @@ db_password = 'aryan'
 db_host = 'localhost'
 db_port = '5432'
 table_name = 'yt'
+# Rows per CSV chunk; bounds the loader's memory whatever the file size
+chunk_rows = 200_000
+# 'replace' rebuilds yt from csv_file. 'append' loads only the files matching
+# append_files that were not loaded before, skipping rows already in yt
+# (same "ID", timestamp and country) and refreshing rollups for their days.
+load_mode = 'replace'
+append_files = 'incoming/*.csv'
+# Skip the CSV load and only refresh the rollup tables from `yt`.
+refresh_rollups_only = False
+# First day to re-aggregate when refreshing only ('YYYY-MM-DD'); None means
+# the latest day already present in the rollup.
+rollup_since = None
 # ----------------------------------
 
+loaded_files_table = 'yt_loaded_files'
+
+
+def connect_db():
+    return psycopg2.connect(
+        dbname=db_name,
+        user=db_user,
+        password=db_password,
+        host=db_host,
+        port=db_port
+    )
+
+
+def read_csv_chunks(path):
+    return pd.read_csv(path, dtype={col: str for col in text_columns}, chunksize=chunk_rows)
+
+
+def prepare_chunk(chunk, vocab):
+    """Coerce one CSV chunk to the yt column types and encode its tags with `vocab`"""
+    chunk = chunk.loc[:, list(yt_columns)].copy()
+    # Convert timestamp to datetime and extract date
+    chunk['timestamp'] = pd.to_datetime(chunk['timestamp'], errors='coerce').dt.date
+    for col, col_type in yt_columns.items():
+        if col_type == 'BIGINT':
+            chunk[col] = pd.to_numeric(chunk[col], errors='coerce').round().astype('Int64')
+        elif col_type == 'DOUBLE PRECISION':
+            chunk[col] = pd.to_numeric(chunk[col], errors='coerce')
+    chunk['tag_ids'] = vocab.encode(chunk['tags'])
+    return chunk
+
+
+def index_definitions(cur):
+    """The fixed yt indexes plus those benchmarks/index_advisor.py kept"""
+    return {**yt_indexes, **advised_indexes(cur, table_name)}
+
+
+def create_indexes(cur, target, suffix=''):
+    indexes = index_definitions(cur)
+    # Month by month first; the parent's indexes then adopt the partitions' ones
+    for partition in partitions(cur, target):
+        index_partition(cur, partition, indexes)
+    for name, definition in indexes.items():
+        index_name = f"idx_{table_name}_{name}{suffix}"
+        cur.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON {target} {definition};")
+        print(f"Created index: {index_name}")
+
+
+def rename_partitions(cur, old_prefix):
+    """After the swap, rename yt's partitions (and their indexes) from old_prefix_* to yt_*"""
+    indexes = index_definitions(cur)
+    for partition in partitions(cur, table_name):
+        renamed = table_name + partition[len(old_prefix):]
+        cur.execute(f"ALTER TABLE {partition} RENAME TO {renamed};")
+        for name in indexes:
+            cur.execute(f"ALTER INDEX idx_{partition}_{name} RENAME TO idx_{renamed}_{name};")
+
+
+def is_partitioned(cur, table):
+    cur.execute("SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass(%s);", (table,))
+    row = cur.fetchone()
+    return bool(row and row[0])
+
+
+def attach_month(conn, month):
+    """
+    Create, index and attach an empty partition for a month yt has none
+    for, and commit. The rows come with the file's INSERT afterwards, so the
+    locks ATTACH takes on yt and yt_default are held only this long.
+    """
+    partition = partition_name(table_name, month)
+    first_day, next_month = month_bounds(month)
+    cur = conn.cursor()
+    cur.execute(f"CREATE TABLE {partition} (LIKE {table_name});")
+    # Built on the empty table, the parent's indexes adopt these on ATTACH
+    index_partition(cur, partition, index_definitions(cur))
+    cur.execute(
+        f"ALTER TABLE {table_name} ATTACH PARTITION {partition} "
+        "FOR VALUES FROM (%(first_day)s) TO (%(next_month)s);",
+        {'first_day': first_day, 'next_month': next_month}
+    )
+    conn.commit()
+    cur.close()
+
+
+def ensure_tag_ids(conn):
+    """Encode the tags of a yt loaded before it had tag_ids, which the tag rollups read"""
+    cur = conn.cursor()
+    if add_tag_ids(cur, table_name, TagVocabulary.load(cur)):
+        print(f"Added tag_ids to the existing rows of '{table_name}'.")
+    conn.commit()
+    cur.close()
+
+
+def create_loaded_files_table(cur):
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {loaded_files_table} (
+            filename TEXT PRIMARY KEY,
+            rows_added BIGINT NOT NULL,
+            loaded_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+    """)
+
+
+def append_file(conn, path):
+    """
+    Load one file into yt, skipping rows whose ("ID", timestamp, country) is
+    already present, and refresh the rollups for the days it touched. Plain
+    INSERTs only take row-level locks, so the API keeps serving meanwhile.
+    Partitions for new months are attached first, each in a short
+    transaction of its own; the rows are loaded after that.
+    """
+    cur = conn.cursor()
+    vocab = TagVocabulary.load(cur)
+    incoming = f"{table_name}_incoming"
+    # Kept across the commits below and dropped at the end
+    cur.execute(f"CREATE TEMP TABLE {incoming} (LIKE {table_name});")
+    months = set()
+    for chunk in read_csv_chunks(path):
+        chunk = prepare_chunk(chunk, vocab)
+        months |= chunk_months(chunk)
+        copy_chunk(cur, incoming, chunk)
+    vocab.save(cur)
+    conn.commit()
+
+    # yt tables from before partitioning take every row through the INSERT below
+    if is_partitioned(cur, table_name):
+        existing = set(partitions(cur, table_name))
+        conn.commit()
+        for month in sorted(months):
+            if partition_name(table_name, month) not in existing:
+                attach_month(conn, month)
+
+    # Rows without a timestamp cannot be keyed to a day, so they are skipped
+    cur.execute(f"""
+        WITH inserted AS (
+            INSERT INTO {table_name}
+            SELECT DISTINCT ON (s."ID", s."timestamp", s.country) s.*
+            FROM {incoming} s
+            WHERE s."timestamp" IS NOT NULL
+              AND NOT EXISTS (
+                  SELECT 1 FROM {table_name} t
+                  WHERE t."ID" = s."ID"
+                    AND t."timestamp" = s."timestamp"
+                    AND t.country IS NOT DISTINCT FROM s.country
+              )
+            RETURNING "timestamp"
+        )
+        SELECT COUNT(*), MIN("timestamp"), MAX("timestamp") FROM inserted;
+    """)
+    rows_added, first_day, last_day = cur.fetchone()
+
+    if rows_added:
+        refresh_rollups(cur, since=first_day, until=last_day)
+    cur.execute(
+        f"INSERT INTO {loaded_files_table} (filename, rows_added) VALUES (%s, %s);",
+        (os.path.basename(path), rows_added)
+    )
+    cur.execute(f"DROP TABLE {incoming};")
+    conn.commit()
+    cur.close()
+    return rows_added, first_day, last_day
+
+
 # Step 1: Connect to default database to create new database
 conn_default = psycopg2.connect(
     dbname='postgres',
@@ -35,68 +215,103 @@ else:
 cur.close()
 conn_default.close()
 
-# Step 2: Read CSV and convert timestamp
-df = pd.read_csv(csv_file, dtype={'title': str}, low_memory=False)
-# Convert timestamp to datetime and extract date
-df['timestamp'] = pd.to_datetime(df['timestamp'], errors='coerce').dt.date
-
-# Step 3: Connect to new database and load data
-engine = create_engine(f'postgresql://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}')
-# Specify DATE type for timestamp column
-df.to_sql(
-    table_name,
-    engine,
-    if_exists='replace',
-    index=False,
-    dtype={'timestamp': Date()}
-)
-print(f"Data loaded into table '{table_name}'.")
+if refresh_rollups_only:
+    # Steps 2-5: nothing to load
+    with connect_db() as conn:
+        ensure_tag_ids(conn)
 
-# Step 4: Create indexes
-with psycopg2.connect(
-    dbname=db_name,
-    user=db_user,
-    password=db_password,
-    host=db_host,
-    port=db_port
-) as conn:
-    cur = conn.cursor()
+elif load_mode == 'append':
+    # Step 2 (append): Load only files that have not been loaded before
+    with connect_db() as conn:
+        ensure_tag_ids(conn)
+        cur = conn.cursor()
+        create_loaded_files_table(cur)
+        # Tables from older loads may lack the row_key index the checks rely on
+        create_indexes(cur, table_name)
+        cur.execute(f"SELECT filename FROM {loaded_files_table};")
+        already_loaded = {row[0] for row in cur.fetchall()}
+        conn.commit()
+        cur.close()
 
-    # Individual column indexes
-    for col in ['timestamp', 'country', 'category']:
-        index_name = f"idx_{table_name}_{col}"
-        cur.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON {table_name} ({col});")
-        print(f"Created index: {index_name}")
+        new_files = [
+            path for path in sorted(glob.glob(append_files))
+            if os.path.basename(path) not in already_loaded
+        ]
+        print(f"{len(new_files)} new file(s) to append.")
 
-    # GIN index for tags array
-    gin_index_name = f"idx_{table_name}_tags_gin"
-    cur.execute(f"""
-        CREATE INDEX IF NOT EXISTS {gin_index_name}
-        ON {table_name} USING GIN ((string_to_array(tags, '|')));
-    """)
-    print(f"Created GIN index: {gin_index_name}")
+        for path in new_files:
+            rows_added, first_day, last_day = append_file(conn, path)
+            print(f"Appended {rows_added} new rows from {path} ({first_day} to {last_day}).")
 
-    # Composite index
-    composite_index_name = f"idx_{table_name}_country_cat_ts"
-    cur.execute(f"""
-        CREATE INDEX IF NOT EXISTS {composite_index_name}
-        ON {table_name} (country, category, timestamp);
-    """)
+else:
+    # Build the new table next to the live one and swap it in at the end,
+    # so the API keeps serving the old data during the load
+    staging_table = f"{table_name}_staging"
 
-    composite_index_name = f"idx_{table_name}_country_ts"
-    cur.execute(f"""
-        CREATE INDEX IF NOT EXISTS {composite_index_name}
-        ON {table_name} (country, timestamp);
-    """)
+    with connect_db() as conn:
+        cur = conn.cursor()
 
-    composite_index_name = f"idx_{table_name}_cat_ts"
-    cur.execute(f"""
-        CREATE INDEX IF NOT EXISTS {composite_index_name}
-        ON {table_name} (category, timestamp);
-    """)
-    print(f"Created composite index: {composite_index_name}")
+        # Step 2: Create the table with explicit column types
+        cur.execute(f"DROP TABLE IF EXISTS {staging_table};")
+        cur.execute(yt_table_ddl(staging_table))
 
-    conn.commit()
-    cur.close()
+        # Step 3: Stream the CSV in chunks through COPY (indexes come after)
+        rows_loaded = 0
+        vocab = TagVocabulary.load(cur)
+        for chunk in read_csv_chunks(csv_file):
+            chunk = prepare_chunk(chunk, vocab)
+            create_partitions(cur, staging_table, chunk_months(chunk))
+            copy_chunk(cur, staging_table, chunk)
+            rows_loaded += len(chunk)
+            print(f"  copied {rows_loaded} rows")
+        vocab.save(cur)
+
+        conn.commit()
+        cur.close()
+    print(f"Data loaded into table '{staging_table}'.")
+
+    # Step 4: Create indexes on the staging table
+    with connect_db() as conn:
+        cur = conn.cursor()
+
+        create_indexes(cur, staging_table, suffix='_new')
+        cur.execute(f"ANALYZE {staging_table};")
+        conn.commit()
+
+        # Step 5: Build the rollups from staging and swap it in. The rollups
+        # and the new data version commit together with the swap, so they
+        # never describe a different yt. Readers keep seeing the old rollup
+        # rows until then.
+        refresh_rollups(cur, source=staging_table)
+        print("Rebuilt rollup tables.")
+
+        # The exclusive lock on yt is only taken from here to the commit
+        cur.execute(f"DROP TABLE IF EXISTS {table_name};")
+        cur.execute(f"ALTER TABLE {staging_table} RENAME TO {table_name};")
+        for name in index_definitions(cur):
+            cur.execute(f"ALTER INDEX idx_{table_name}_{name}_new RENAME TO idx_{table_name}_{name};")
+        rename_partitions(cur, staging_table)
+
+        # A full reload starts the loaded-files ledger over
+        create_loaded_files_table(cur)
+        cur.execute(f"DELETE FROM {loaded_files_table};")
+        cur.execute(
+            f"INSERT INTO {loaded_files_table} (filename, rows_added) VALUES (%s, %s);",
+            (os.path.basename(csv_file), rows_loaded)
+        )
+
+        conn.commit()
+        cur.close()
+    print(f"Swapped '{staging_table}' in as '{table_name}'.")
+
+# Step 6: Refresh the rollup tables (a full load rebuilt them with the swap,
+# append mode refreshes them per file)
+if refresh_rollups_only:
+    with connect_db() as conn:
+        cur = conn.cursor()
+        refresh_rollups(cur, since=rollup_since, incremental=True)
+        print("Refreshed rollup tables.")
+        conn.commit()
+        cur.close()
 
 print("All operations completed successfully.")
\ No newline at end of file
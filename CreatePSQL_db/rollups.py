@@ -0,0 +1,404 @@
+import os
+from datetime import date
+from itertools import combinations
+
+try:
+    from .tag_sketch import TagSketch, sketch_size, tag_rows
+    from .tag_tokens import vocab_table
+except ImportError:
+    # createDB.py runs from this folder, outside the package
+    from tag_sketch import TagSketch, sketch_size, tag_rows
+    from tag_tokens import vocab_table
+
+# -------------------------------
+# Rollup definitions
+# -------------------------------
+
+source_table = 'yt'
+daily_table = 'yt_daily'
+monthly_stats_table = 'yt_monthly_stats'
+tag_table = 'yt_tag'
+tag_counts_table = 'yt_tag_monthly'
+tag_sketch_table = 'yt_tag_sketch'
+meta_table = 'yt_meta'
+
+# (name used in rollup columns, column in the source table)
+METRICS = [
+    ('views', '"#views"'),
+    ('likes', '"#likes"'),
+    ('comments', '"#comments"'),
+    ('dislikes', '"#dislikes"'),
+    ('duration', 'duration'),
+]
+
+METRIC_PAIRS = list(combinations([name for name, _ in METRICS], 2))
+
+
+def stat_columns():
+    """
+    Names of the correlation statistic columns, in table order. For every
+    metric pair (a, b) they hold, over rows where both are non-null: the row
+    count, the sums and sums of squares of a and of b, and the sum of a*b.
+    """
+    columns = []
+    for a, b in METRIC_PAIRS:
+        columns += [
+            f'pw_n_{a}_{b}',
+            f'pw_s_{a}_{b}', f'pw_s_{b}_{a}',
+            f'pw_q_{a}_{b}', f'pw_q_{b}_{a}',
+            f'pw_p_{a}_{b}',
+        ]
+    return columns
+
+
+def daily_table_ddl():
+    # Plain sums/counts serve the chart endpoints. The pw_* columns are the
+    # pairwise sufficient statistics for Pearson correlation; keeping them per
+    # pair (rather than over rows with all five metrics set) matches how
+    # CORR() skips rows where either of its two arguments is NULL.
+    columns = [
+        'day DATE',
+        'country TEXT',
+        'category TEXT',
+        'video_count BIGINT NOT NULL',
+    ]
+    columns += [f'sum_{name} NUMERIC' for name, _ in METRICS]
+    columns.append('cnt_duration BIGINT NOT NULL')
+    columns += [stat_column_ddl(col) for col in stat_columns()]
+    return f"CREATE TABLE IF NOT EXISTS {daily_table} (\n    " + ',\n    '.join(columns) + '\n);'
+
+
+def stat_column_ddl(col):
+    if col.startswith('pw_n_'):
+        return f'{col} BIGINT NOT NULL'
+    return f'{col} DOUBLE PRECISION NOT NULL'
+
+
+def daily_select_sql(date_filter=False, source=source_table):
+    """Aggregate `source` (yt or a table shaped like it) into one row per (day, country, category)."""
+    columns = dict(METRICS)
+
+    select = [
+        '"timestamp" AS day',
+        'country',
+        'category',
+        'COUNT(*) AS video_count',
+    ]
+    select += [f'SUM({col}) AS sum_{name}' for name, col in METRICS]
+    select.append('COUNT(duration) AS cnt_duration')
+    for a, b in METRIC_PAIRS:
+        x, y = f'{columns[a]}::float8', f'{columns[b]}::float8'
+        both = f'{columns[a]} IS NOT NULL AND {columns[b]} IS NOT NULL'
+        select += [
+            f'COUNT(*) FILTER (WHERE {both}) AS pw_n_{a}_{b}',
+            f'COALESCE(SUM({x}) FILTER (WHERE {both}), 0) AS pw_s_{a}_{b}',
+            f'COALESCE(SUM({y}) FILTER (WHERE {both}), 0) AS pw_s_{b}_{a}',
+            f'COALESCE(SUM({x} * {x}) FILTER (WHERE {both}), 0) AS pw_q_{a}_{b}',
+            f'COALESCE(SUM({y} * {y}) FILTER (WHERE {both}), 0) AS pw_q_{b}_{a}',
+            f'COALESCE(SUM({x} * {y}), 0) AS pw_p_{a}_{b}',
+        ]
+
+    sql = "SELECT\n    " + ',\n    '.join(select) + f"\nFROM {source}\n"
+    if date_filter:
+        sql += 'WHERE "timestamp" BETWEEN %(start_day)s AND %(end_day)s\n'
+    sql += 'GROUP BY "timestamp", country, category'
+    return sql
+
+
+def monthly_stats_table_ddl():
+    columns = ['month DATE', 'country TEXT', 'category TEXT']
+    columns += [stat_column_ddl(col) for col in stat_columns()]
+    return f"CREATE TABLE IF NOT EXISTS {monthly_stats_table} (\n    " + ',\n    '.join(columns) + '\n);'
+
+
+def monthly_stats_select_sql(date_filter=False):
+    """Fold the daily correlation statistics into (month, country, category)."""
+    select = ["DATE_TRUNC('month', day)::date AS month", 'country', 'category']
+    select += [f'SUM({col}) AS {col}' for col in stat_columns()]
+
+    sql = "SELECT\n    " + ',\n    '.join(select) + f"\nFROM {daily_table}\n"
+    if date_filter:
+        sql += "WHERE day >= %(start_month)s AND day < %(end_month)s::date + INTERVAL '1 month'\n"
+    sql += "GROUP BY DATE_TRUNC('month', day), country, category"
+    return sql
+
+
+# One row per tag occurrence, from the tag_ids the loaders store (split on
+# '|', quotes trimmed, lowercased; see tag_tokens.py).
+# A video row is identified by ("ID", timestamp, country).
+TAG_TABLE_DDL = f"""
+CREATE TABLE IF NOT EXISTS {tag_table} (
+    video_id TEXT,
+    day DATE,
+    country TEXT,
+    category TEXT,
+    tag TEXT NOT NULL
+);
+"""
+
+TAG_COUNTS_TABLE_DDL = f"""
+CREATE TABLE IF NOT EXISTS {tag_counts_table} (
+    tag TEXT NOT NULL,
+    month DATE,
+    country TEXT,
+    category TEXT,
+    count BIGINT NOT NULL
+);
+"""
+
+# Tag sketches for the approximate /word_cloud (approx=1): one per (month,
+# country, category), plus (month, country, '*'), (month, '*', category) and
+# (month, '*', '*') where '*' is "all", so any filter merges at most one
+# sketch per month. Counts are overestimated by at most SKETCH_EPSILON x the
+# tag occurrences, with probability 1 - SKETCH_DELTA, and each sketch lists
+# its SKETCH_TOP heaviest tags. They are read from the environment of the
+# loader; each sketch records the values it was built with, and sketches
+# built with different ones are never merged, so a change needs a full
+# rollup rebuild.
+SKETCH_EPSILON = float(os.getenv('SKETCH_EPSILON', 0.002))
+SKETCH_DELTA = float(os.getenv('SKETCH_DELTA', 0.02))
+SKETCH_TOP = int(os.getenv('SKETCH_TOP', 1000))
+ALL = '*'
+
+TAG_SKETCH_TABLE_DDL = f"""
+CREATE TABLE IF NOT EXISTS {tag_sketch_table} (
+    month DATE,
+    country TEXT NOT NULL,
+    category TEXT NOT NULL,
+    sketch BYTEA NOT NULL
+);
+"""
+
+
+def tag_select_sql(date_filter=False, source=source_table):
+    sql = f"""
+SELECT y."ID", y."timestamp", y.country, y.category, v.tag
+FROM {source} y
+CROSS JOIN LATERAL unnest(y.tag_ids) AS t(id)
+JOIN {vocab_table} v ON v.id = t.id
+"""
+    if date_filter:
+        sql += 'WHERE y."timestamp" BETWEEN %(start_day)s AND %(end_day)s\n'
+    return sql
+
+
+def tag_counts_select_sql(date_filter=False):
+    sql = f"""
+SELECT tag, DATE_TRUNC('month', day)::date AS month, country, category, COUNT(*)
+FROM {tag_table}
+"""
+    if date_filter:
+        sql += "WHERE day >= %(start_month)s AND day < %(end_month)s::date + INTERVAL '1 month'\n"
+    sql += "GROUP BY tag, DATE_TRUNC('month', day), country, category"
+    return sql
+
+
+# -------------------------------
+# Build / refresh
+# -------------------------------
+
+def create_rollup_tables(cur):
+    cur.execute(daily_table_ddl())
+    cur.execute(f"""
+        CREATE INDEX IF NOT EXISTS idx_{daily_table}_day_country_cat
+        ON {daily_table} (day, country, category);
+    """)
+    cur.execute(monthly_stats_table_ddl())
+    cur.execute(f"""
+        CREATE INDEX IF NOT EXISTS idx_{monthly_stats_table}_month_country
+        ON {monthly_stats_table} (month, country);
+    """)
+    cur.execute(TAG_TABLE_DDL)
+    cur.execute(f"""
+        CREATE INDEX IF NOT EXISTS idx_{tag_table}_day
+        ON {tag_table} (day);
+    """)
+    cur.execute(TAG_COUNTS_TABLE_DDL)
+    cur.execute(f"""
+        CREATE INDEX IF NOT EXISTS idx_{tag_counts_table}_month_country_cat
+        ON {tag_counts_table} (month, country, category);
+    """)
+    cur.execute(TAG_SKETCH_TABLE_DDL)
+    cur.execute(f"""
+        CREATE INDEX IF NOT EXISTS idx_{tag_sketch_table}_country_cat_month
+        ON {tag_sketch_table} (country, category, month);
+    """)
+
+
+def refresh_daily_rollup(cur, start_day=None, end_day=None, source=source_table):
+    """
+    Recompute the daily rollup. With no bounds the whole table is rebuilt;
+    otherwise only the days in [start_day, end_day] are replaced. Runs inside
+    the caller's transaction, so readers keep seeing the old rows until commit.
+    """
+    if start_day is None and end_day is None:
+        cur.execute(f"DELETE FROM {daily_table};")
+        cur.execute(f"INSERT INTO {daily_table}\n{daily_select_sql(source=source)};")
+        return
+
+    params = {'start_day': start_day, 'end_day': end_day}
+    cur.execute(
+        f"DELETE FROM {daily_table} WHERE day BETWEEN %(start_day)s AND %(end_day)s;",
+        params
+    )
+    cur.execute(f"INSERT INTO {daily_table}\n{daily_select_sql(date_filter=True, source=source)};", params)
+
+
+def refresh_monthly_stats(cur, start_day=None, end_day=None):
+    """
+    Recompute the monthly correlation statistics from the daily rollup.
+    Bounds are widened to whole months, so only the months that contain
+    changed days are rewritten.
+    """
+    if start_day is None and end_day is None:
+        cur.execute(f"DELETE FROM {monthly_stats_table};")
+        cur.execute(f"INSERT INTO {monthly_stats_table}\n{monthly_stats_select_sql()};")
+        return
+
+    params = {
+        'start_month': start_day.replace(day=1),
+        'end_month': end_day.replace(day=1)
+    }
+    cur.execute(
+        f"DELETE FROM {monthly_stats_table} WHERE month BETWEEN %(start_month)s AND %(end_month)s;",
+        params
+    )
+    cur.execute(
+        f"INSERT INTO {monthly_stats_table}\n{monthly_stats_select_sql(date_filter=True)};",
+        params
+    )
+
+
+def refresh_tag_tables(cur, start_day=None, end_day=None, source=source_table):
+    """
+    Re-extract tag occurrences for the given days (all days when unbounded)
+    and recount the months they fall in.
+    """
+    if start_day is None and end_day is None:
+        cur.execute(f"DELETE FROM {tag_table};")
+        cur.execute(f"INSERT INTO {tag_table}\n{tag_select_sql(source=source)};")
+        cur.execute(f"DELETE FROM {tag_counts_table};")
+        cur.execute(f"INSERT INTO {tag_counts_table}\n{tag_counts_select_sql()};")
+        refresh_tag_sketches(cur)
+        return
+
+    params = {
+        'start_day': start_day,
+        'end_day': end_day,
+        'start_month': start_day.replace(day=1),
+        'end_month': end_day.replace(day=1)
+    }
+    cur.execute(f"DELETE FROM {tag_table} WHERE day BETWEEN %(start_day)s AND %(end_day)s;", params)
+    cur.execute(f"INSERT INTO {tag_table}\n{tag_select_sql(date_filter=True, source=source)};", params)
+    cur.execute(
+        f"DELETE FROM {tag_counts_table} WHERE month BETWEEN %(start_month)s AND %(end_month)s;",
+        params
+    )
+    cur.execute(f"INSERT INTO {tag_counts_table}\n{tag_counts_select_sql(date_filter=True)};", params)
+    refresh_tag_sketches(cur, params['start_month'], params['end_month'])
+
+
+def refresh_tag_sketches(cur, start_month=None, end_month=None):
+    """
+    Rebuild the tag sketches of the months in [start_month, end_month] (all
+    months when unbounded) from the monthly tag counts, a month at a time.
+    """
+    width, depth = sketch_size(SKETCH_EPSILON, SKETCH_DELTA)
+    if start_month is None:
+        cur.execute(f"DELETE FROM {tag_sketch_table};")
+        cur.execute(f"SELECT DISTINCT month FROM {tag_counts_table};")
+    else:
+        params = {'start_month': start_month, 'end_month': end_month}
+        cur.execute(
+            f"DELETE FROM {tag_sketch_table} WHERE month BETWEEN %(start_month)s AND %(end_month)s;",
+            params
+        )
+        cur.execute(
+            f"SELECT DISTINCT month FROM {tag_counts_table} WHERE month BETWEEN %(start_month)s AND %(end_month)s;",
+            params
+        )
+
+    for (month,) in cur.fetchall():
+        condition = "month IS NULL" if month is None else "month = %(month)s"
+        cur.execute(
+            f"SELECT country, category, tag, count FROM {tag_counts_table} WHERE {condition};",
+            {'month': month}
+        )
+        groups = {}
+        for country, category, tag, count in cur.fetchall():
+            # Rows without a country or category only count towards '*'
+            for key in ((ALL, ALL), (ALL, category), (country, ALL), (country, category)):
+                if None not in key:
+                    counts = groups.setdefault(key, {})
+                    counts[tag] = counts.get(tag, 0) + count
+        if not groups:
+            continue
+
+        # Hash each distinct tag once for all the month's groups
+        tags = list(groups[(ALL, ALL)])
+        rows = tag_rows(tags, width, depth)
+        position = {tag: i for i, tag in enumerate(tags)}
+        for (country, category), counts in groups.items():
+            group_rows = rows[[position[tag] for tag in counts]]
+            sketch = TagSketch.build(
+                counts, width, depth, SKETCH_TOP, rows=group_rows,
+                settings=(SKETCH_EPSILON, SKETCH_DELTA, SKETCH_TOP)
+            )
+            cur.execute(
+                f"INSERT INTO {tag_sketch_table} (month, country, category, sketch) VALUES (%s, %s, %s, %s);",
+                (month, country, category, sketch.to_bytes())
+            )
+
+
+def bump_data_version(cur):
+    """Stamp a new data version; the API drops cached responses when it changes."""
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {meta_table} (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+    """)
+    cur.execute(f"""
+        INSERT INTO {meta_table} (key, value)
+        VALUES ('data_version', clock_timestamp()::text)
+        ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value;
+    """)
+
+
+def last_rolled_up_day(cur):
+    cur.execute(f"SELECT MAX(day) FROM {daily_table};")
+    return cur.fetchone()[0]
+
+
+def refresh_rollups(cur, since=None, incremental=False, until=None, source=source_table):
+    """
+    Bring all rollups up to date. A full rebuild by default; with a `since`
+    day only the days from `since` to `until` (default: the newest day in
+    yt) are re-aggregated. `incremental=True` without `since` starts from the
+    newest day already in the rollup (an empty rollup is rebuilt in full).
+    `source` is read instead of yt, e.g. a staging table about to replace it.
+    """
+    create_rollup_tables(cur)
+    if isinstance(since, str):
+        since = date.fromisoformat(since)
+    if incremental and since is None:
+        since = last_rolled_up_day(cur)
+    if since is None:
+        refresh_daily_rollup(cur, source=source)
+        refresh_monthly_stats(cur)
+        refresh_tag_tables(cur, source=source)
+        bump_data_version(cur)
+        return
+
+    if isinstance(until, str):
+        until = date.fromisoformat(until)
+    latest = until
+    if latest is None:
+        cur.execute(f'SELECT MAX("timestamp") FROM {source};')
+        latest = cur.fetchone()[0]
+    if latest is None or latest < since:
+        return
+    refresh_daily_rollup(cur, since, latest, source=source)
+    refresh_monthly_stats(cur, since, latest)
+    refresh_tag_tables(cur, since, latest, source=source)
+    bump_data_version(cur)
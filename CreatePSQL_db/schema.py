@@ -0,0 +1,134 @@
+import io
+from datetime import timedelta
+
+# -------------------------------
+# yt table definition
+# -------------------------------
+# Shared by createDB.py and the benchmark loader (benchmarks/synthetic.py).
+# yt is partitioned by month into yt_YYYYMM tables plus yt_default.
+
+# Column types of the yt table (the CSV header must contain these columns)
+yt_columns = {
+    'ID': 'TEXT',
+    'title': 'TEXT',
+    'category': 'TEXT',
+    '#views': 'BIGINT',
+    '#comments': 'BIGINT',
+    '#likes': 'BIGINT',
+    '#dislikes': 'BIGINT',
+    'timestamp': 'DATE',
+    'duration': 'DOUBLE PRECISION',
+    'description': 'TEXT',
+    'tags': 'TEXT',
+    'country': 'TEXT',
+}
+text_columns = [col for col, col_type in yt_columns.items() if col_type == 'TEXT']
+
+# Columns the loaders compute rather than read from the CSV: tag_ids holds
+# each row's cleaned tags as yt_tag_vocab ids (see tag_tokens.py)
+derived_columns = {'tag_ids': 'INTEGER[]'}
+table_columns = {**yt_columns, **derived_columns}
+
+# Indexes on yt (name suffix -> definition). row_key serves append mode's
+# "already seen" check on ("ID", timestamp, country) and the /rows export's
+# keyset order (timestamp, "ID", country).
+yt_indexes = {
+    'timestamp': '(timestamp)',
+    'country': '(country)',
+    'category': '(category)',
+    'tags_gin': "USING GIN ((string_to_array(tags, '|')))",
+    'country_cat_ts': '(country, category, timestamp)',
+    'country_ts': '(country, timestamp)',
+    'cat_ts': '(category, timestamp)',
+    'row_key': '(timestamp, "ID", country)',
+}
+
+# Indexes benchmarks/index_advisor.py measured and kept (name suffix, table,
+# "USING ..." spec); createDB.py recreates the yt ones after a full reload
+index_advice_table = 'yt_index_advice'
+INDEX_ADVICE_DDL = f"""
+CREATE TABLE IF NOT EXISTS {index_advice_table} (
+    name TEXT PRIMARY KEY,
+    table_name TEXT NOT NULL,
+    spec TEXT NOT NULL,
+    gain DOUBLE PRECISION,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+"""
+
+
+def advised_indexes(cur, table):
+    """{name suffix: spec} of the kept advisor indexes on `table` (psycopg2 cursor)"""
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL;", (index_advice_table,))
+    if not cur.fetchone()[0]:
+        return {}
+    cur.execute(f"SELECT name, spec FROM {index_advice_table} WHERE table_name = %s ORDER BY name;", (table,))
+    return dict(cur.fetchall())
+
+
+def yt_table_ddl(name):
+    # Range-partitioned by month on "timestamp": a query on a date range only
+    # scans the partitions of its months. Rows without a timestamp go to the
+    # default partition.
+    columns_ddl = ',\n'.join(f'"{col}" {col_type}' for col, col_type in table_columns.items())
+    return f'CREATE TABLE {name} (\n{columns_ddl}\n) PARTITION BY RANGE ("timestamp");'
+
+
+# -------------------------------
+# Month partitions
+# -------------------------------
+
+def partition_name(table, month):
+    return f"{table}_{month:%Y%m}"
+
+
+def month_bounds(month):
+    """First day of `month` and of the month after it"""
+    first_day = month.replace(day=1)
+    return first_day, (first_day + timedelta(days=32)).replace(day=1)
+
+
+def chunk_months(chunk):
+    """First days of the months a prepared chunk has rows for"""
+    return {day.replace(day=1) for day in chunk['timestamp'].dropna().unique()}
+
+
+def partitions(cur, table):
+    """Names of `table`'s partitions (none for a plain table)"""
+    cur.execute(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = to_regclass(%s) ORDER BY c.relname;",
+        (table,)
+    )
+    return [row[0] for row in cur.fetchall()]
+
+
+def create_partitions(cur, table, months):
+    """Create the default partition and those of `months` that `table` lacks"""
+    cur.execute(f"CREATE TABLE IF NOT EXISTS {table}_default PARTITION OF {table} DEFAULT;")
+    for month in sorted(months):
+        first_day, next_month = month_bounds(month)
+        cur.execute(
+            f"CREATE TABLE IF NOT EXISTS {partition_name(table, month)} PARTITION OF {table} "
+            "FOR VALUES FROM (%s) TO (%s);",
+            (first_day, next_month)
+        )
+
+
+def index_partition(cur, partition, indexes):
+    """
+    Build `indexes` ({name suffix: definition}) on one partition as
+    idx_<partition>_<name>. A CREATE INDEX on the parent, or attaching the
+    partition, then adopts these instead of building its own.
+    """
+    for name, definition in indexes.items():
+        cur.execute(f"CREATE INDEX IF NOT EXISTS idx_{partition}_{name} ON {partition} {definition};")
+
+
+def copy_chunk(cur, target, chunk):
+    """Stream a prepared chunk (with its tag_ids) into `target` with COPY FROM STDIN"""
+    buffer = io.StringIO()
+    chunk.loc[:, list(table_columns)].to_csv(buffer, index=False, header=False)
+    buffer.seek(0)
+    columns = ', '.join(f'"{col}"' for col in table_columns)
+    cur.copy_expert(f'COPY {target} ({columns}) FROM STDIN WITH (FORMAT csv)', buffer)
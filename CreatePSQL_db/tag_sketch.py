@@ -0,0 +1,171 @@
+import hashlib
+import json
+import math
+import zlib
+
+import numpy as np
+
+# -------------------------------
+# Mergeable tag-count sketches
+# -------------------------------
+# A TagSketch summarises the tag counts of one (month, country, category)
+# group in a fixed size, whatever the number of distinct tags:
+#
+# - a Count-Min table (depth x width counters): a tag's count is never
+#   underestimated, and with probability 1 - e^-depth it is overestimated by
+#   at most (e / width) x total occurrences;
+# - a Space-Saving style list of the group's `top` heaviest tags with their
+#   counts, plus `floor`, an upper bound on the count of any unlisted tag.
+#
+# Sketches of the same size merge by adding tables and lists, so the counts
+# of any set of groups come from merging their sketches. The estimate of a
+# listed tag is the smaller of its two upper bounds; its lower bound is the
+# sum of the counts the merged lists actually saw. Each sketch records the
+# (epsilon, delta, top) it was built with; only equal ones merge.
+
+
+def sketch_size(epsilon, delta):
+    """Count-Min (width, depth) for an error of epsilon x total with probability 1 - delta"""
+    return math.ceil(math.e / epsilon), math.ceil(math.log(1 / delta))
+
+
+def tag_rows(tags, width, depth):
+    """Count-Min column of each tag in each row, shape (len(tags), depth)"""
+    digests = b''.join(
+        hashlib.blake2b(tag.encode(), digest_size=4 * depth).digest() for tag in tags
+    )
+    return (np.frombuffer(digests, dtype='<u4').reshape(len(tags), depth) % width).astype(np.intp)
+
+
+class TagSketch:
+
+    def __init__(self, table, top, floor=0, total=0, settings=None):
+        self.table = table
+        # tag -> [upper bound, lower bound]
+        self.top = top
+        self.floor = floor
+        self.total = total
+        # (epsilon, delta, top) it was built with; None for older sketches
+        self.settings = settings
+
+    @property
+    def width(self):
+        return self.table.shape[1]
+
+    @property
+    def depth(self):
+        return self.table.shape[0]
+
+    @classmethod
+    def build(cls, counts, width, depth, top, rows=None, settings=None):
+        """
+        Sketch of exact {tag: count} counts. `rows` may hold precomputed
+        tag_rows for the tags (in the dict's order), shared across groups.
+        `settings` records the (epsilon, delta, top) behind width, depth and top.
+        """
+        tags = list(counts)
+        values = np.fromiter(counts.values(), dtype=np.int64, count=len(tags))
+        if rows is None:
+            rows = tag_rows(tags, width, depth)
+        table = np.vstack([
+            np.bincount(rows[:, r], weights=values, minlength=width) for r in range(depth)
+        ]).astype(np.int64) if tags else np.zeros((depth, width), dtype=np.int64)
+
+        order = np.argsort(-values, kind='stable')
+        listed = order[:top]
+        floor = int(values[order[top]]) if len(order) > top else 0
+        return cls(
+            table,
+            {tags[i]: [int(values[i]), int(values[i])] for i in listed},
+            floor=floor,
+            total=int(values.sum()),
+            settings=settings
+        )
+
+    @classmethod
+    def merge(cls, sketches, top=None):
+        """
+        One sketch for the union of the groups `sketches` summarise, listing
+        as many tags as they were built to; `top` is only used for sketches
+        from before settings were recorded
+        """
+        sketches = list(sketches)
+        if not sketches:
+            raise ValueError("Nothing to merge")
+        if len({(sketch.table.shape, sketch.settings) for sketch in sketches}) > 1:
+            raise ValueError("Sketches built with different settings; rebuild the rollups after changing them")
+        settings = sketches[0].settings
+        if settings:
+            top = settings[2]
+        elif top is None:
+            raise ValueError("Sketches without settings need a top")
+
+        table = np.sum([sketch.table for sketch in sketches], axis=0)
+        floor = sum(sketch.floor for sketch in sketches)
+        # A tag missing from a list may still have up to that list's floor there
+        merged = {}
+        for sketch in sketches:
+            for tag, (upper, lower) in sketch.top.items():
+                bounds = merged.setdefault(tag, [floor, 0])
+                bounds[0] += upper - sketch.floor
+                bounds[1] += lower
+
+        ranked = sorted(merged.items(), key=lambda item: (-item[1][0], item[0]))
+        if len(ranked) > top:
+            floor = max(floor, ranked[top][1][0])
+        return cls(table, dict(ranked[:top]), floor=floor, total=sum(sketch.total for sketch in sketches),
+                   settings=settings)
+
+    def estimate(self, tags):
+        """Count-Min upper bounds for `tags`"""
+        rows = tag_rows(tags, self.width, self.depth)
+        return self.table[np.arange(self.depth), rows].min(axis=1)
+
+    def heavy_hitters(self, limit, min_count=1):
+        """
+        The `limit` tags with the highest estimates, as (tag, estimate, lower
+        bound); an unlisted tag has a count of at most `floor`.
+        """
+        tags = list(self.top)
+        if not tags:
+            return []
+        cm = self.estimate(tags)
+        found = [
+            (tag, min(int(upper), self.top[tag][0]), self.top[tag][1])
+            for tag, upper in zip(tags, cm)
+        ]
+        found = [item for item in found if item[1] >= min_count]
+        found.sort(key=lambda item: (-item[1], item[0]))
+        return found[:limit]
+
+    def bounds(self):
+        """The error bounds of this sketch's Count-Min table"""
+        epsilon = math.e / self.width
+        return {
+            'epsilon': round(epsilon, 6),
+            'delta': round(math.exp(-self.depth), 6),
+            'occurrences': self.total,
+            'max_overcount': math.ceil(epsilon * self.total),
+            'unlisted_max': self.floor,
+        }
+
+    # Stored as zlib(JSON header + '\n' + int64 table); small groups' tables
+    # are mostly zeros and compress to little
+    def to_bytes(self):
+        header = json.dumps({
+            'width': self.width, 'depth': self.depth, 'floor': self.floor,
+            'total': self.total, 'top': [[tag, *bounds] for tag, bounds in self.top.items()],
+            'settings': self.settings
+        })
+        return zlib.compress(header.encode() + b'\n' + self.table.astype('<i8').tobytes())
+
+    @classmethod
+    def from_bytes(cls, data):
+        raw = zlib.decompress(data)
+        split = raw.index(b'\n')
+        header = json.loads(raw[:split])
+        table = np.frombuffer(raw[split + 1:], dtype='<i8').reshape(header['depth'], header['width'])
+        top = {tag: [upper, lower] for tag, upper, lower in header['top']}
+        settings = header.get('settings')
+        return cls(table, top, floor=header['floor'], total=header['total'],
+                   settings=tuple(settings) if settings else None)
@@ -0,0 +1,142 @@
+import io
+
+import numpy as np
+import pandas as pd
+
+# -------------------------------
+# Tag normalization and tokens
+# -------------------------------
+# A video's tags arrive as one '|'-separated string, which is read two ways:
+#
+# - as tags, for the word cloud: split on '|', quotes trimmed, lowercased,
+#   with empty pieces and the '[none]' placeholder dropped. The loaders do
+#   this once per chunk with pandas string operations and store each row's
+#   tags as yt_tag_vocab ids in its tag_ids column; the tag rollups count
+#   those ids, so Postgres never re-parses the tag strings.
+# - as words, for the prediction model: '|' read as a space, cut to
+#   MAX_TAG_CHARS characters and split on whitespace. The model's GloVe
+#   features were trained on exactly this, so it must not change.
+
+vocab_table = 'yt_tag_vocab'
+NO_TAGS = '[none]'
+MAX_TAG_CHARS = 512
+
+VOCAB_TABLE_DDL = f"""
+CREATE TABLE IF NOT EXISTS {vocab_table} (
+    id INTEGER PRIMARY KEY,
+    tag TEXT NOT NULL UNIQUE
+);
+"""
+
+
+def split_tags(tags):
+    """
+    The cleaned tags of a sequence of tag strings, one entry per occurrence,
+    in order, labelled with the position of the row they came from
+    """
+    tags = pd.Series(np.asarray(tags, dtype=object))
+    tags = tags[tags.notna() & ~tags.isin(['', NO_TAGS])]
+    pieces = tags.astype(str).str.split('|').explode().str.strip('"').str.lower()
+    return pieces[pieces != '']
+
+
+def model_text(tags):
+    """A tag string as the prediction model reads it (before splitting into words)"""
+    if pd.isna(tags):
+        return ''
+    return str(tags).replace('|', ' ')[:MAX_TAG_CHARS]
+
+
+def model_words(tags):
+    return model_text(tags).split()
+
+
+class TagVocabulary:
+    """
+    tag -> id of yt_tag_vocab. Ids are only ever added, so the tag_ids
+    stored by earlier loads stay valid; tags encoded since `load` are
+    written by `save`, in the same transaction as the rows using them.
+    """
+
+    def __init__(self, tags=(), ids=()):
+        self.tags = pd.Index(list(tags), dtype=object)
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.saved = len(self.tags)
+
+    @classmethod
+    def load(cls, cur):
+        cur.execute(VOCAB_TABLE_DDL)
+        cur.execute(f"SELECT tag, id FROM {vocab_table} ORDER BY id;")
+        rows = cur.fetchall()
+        return cls([tag for tag, _ in rows], [id_ for _, id_ in rows])
+
+    def encode(self, tags):
+        """
+        The tag_ids of each entry of `tags` as Postgres array literals
+        ('{3,17,3}'), in a Series aligned with `tags`. Unseen tags get the
+        next free ids.
+        """
+        # A video trends on many days, so each distinct string is split once
+        codes, distinct = pd.factorize(np.asarray(tags, dtype=object))
+        pieces = split_tags(distinct)
+        positions = self.tags.get_indexer(pieces.to_numpy())
+        unseen = positions < 0
+        if unseen.any():
+            new_tags = pd.unique(pieces.to_numpy()[unseen])
+            first_id = int(self.ids.max()) + 1 if len(self.ids) else 1
+            self.tags = self.tags.append(pd.Index(new_tags, dtype=object))
+            self.ids = np.concatenate([self.ids, np.arange(first_id, first_id + len(new_tags))])
+            positions = self.tags.get_indexer(pieces.to_numpy())
+
+        # Concatenate each string's "id," parts in one pass over the ids
+        literals = np.full(len(distinct) + 1, '{}', dtype=object)
+        counts = np.bincount(pieces.index.to_numpy(), minlength=len(distinct))
+        tagged = np.flatnonzero(counts)
+        if len(tagged):
+            parts = self.ids[positions].astype(str).astype(object) + ','
+            joined = np.add.reduceat(parts, np.concatenate([[0], np.cumsum(counts[tagged])[:-1]]))
+            literals[tagged] = '{' + pd.Series(joined).str[:-1].to_numpy() + '}'
+        # Missing values have code -1, the '{}' at the end
+        index = tags.index if isinstance(tags, pd.Series) else None
+        return pd.Series(literals[codes], index=index)
+
+    def save(self, cur):
+        """Insert the tags encoded since `load`"""
+        if self.saved == len(self.tags):
+            return
+        new = pd.DataFrame({'id': self.ids[self.saved:], 'tag': self.tags[self.saved:]})
+        copy_frame(cur, vocab_table, new)
+        self.saved = len(self.tags)
+
+
+def copy_frame(cur, target, frame):
+    """COPY a DataFrame's columns into the same-named columns of `target`"""
+    buffer = io.StringIO()
+    frame.to_csv(buffer, index=False, header=False)
+    buffer.seek(0)
+    columns = ', '.join(f'"{col}"' for col in frame.columns)
+    cur.copy_expert(f'COPY {target} ({columns}) FROM STDIN WITH (FORMAT csv)', buffer)
+
+
+def add_tag_ids(cur, table, vocab):
+    """
+    Add and fill the tag_ids column of a `table` loaded before it existed.
+    Each distinct tag string is encoded once. Returns whether it was added.
+    """
+    cur.execute(
+        "SELECT 1 FROM information_schema.columns WHERE table_name = %s AND column_name = 'tag_ids';",
+        (table,)
+    )
+    if cur.fetchone():
+        return False
+    cur.execute(f"ALTER TABLE {table} ADD COLUMN tag_ids INTEGER[];")
+    cur.execute(f"SELECT DISTINCT tags FROM {table} WHERE tags IS NOT NULL;")
+    tags = pd.Series([row[0] for row in cur.fetchall()], dtype=object)
+
+    backfill = f"{table}_tag_ids"
+    cur.execute(f"CREATE TEMP TABLE {backfill} (tags TEXT, tag_ids INTEGER[]) ON COMMIT DROP;")
+    copy_frame(cur, backfill, pd.DataFrame({'tags': tags, 'tag_ids': vocab.encode(tags)}))
+    vocab.save(cur)
+    cur.execute(f"UPDATE {table} t SET tag_ids = b.tag_ids FROM {backfill} b WHERE t.tags = b.tags;")
+    cur.execute(f"UPDATE {table} SET tag_ids = ARRAY[]::INTEGER[] WHERE tags IS NULL;")
+    return True
@@ -0,0 +1,114 @@
+import os
+import numpy as np
+from functools import lru_cache
+
+# -------------------------------
+# Compact word-vector index
+# -------------------------------
+
+class EmbeddingIndex:
+    """
+    Word vectors as a word -> row dict plus one contiguous float32 matrix.
+    On disk this is <prefix>.npy (the matrix) and <prefix>.vocab (one word
+    per line, in row order); `load` memory-maps the matrix.
+    """
+
+    def __init__(self, words, vectors):
+        self.vectors = vectors
+        self.word_to_row = {word: row for row, word in enumerate(words)}
+        self.dim = vectors.shape[1]
+
+    @classmethod
+    def from_keyed_vectors(cls, keyed_vectors):
+        vectors = np.ascontiguousarray(keyed_vectors.vectors, dtype=np.float32)
+        return cls(list(keyed_vectors.index_to_key), vectors)
+
+    @staticmethod
+    def exists(prefix):
+        return os.path.exists(prefix + '.npy') and os.path.exists(prefix + '.vocab')
+
+    @classmethod
+    def load(cls, prefix, mmap=True):
+        vectors = np.load(prefix + '.npy', mmap_mode='r' if mmap else None)
+        with open(prefix + '.vocab', encoding='utf-8') as f:
+            words = f.read().split('\n')
+        return cls(words[:len(vectors)], vectors)
+
+    def save(self, prefix):
+        """
+        Write both files under temporary names and move them into place,
+        .vocab last, so `exists` is only true once both are complete (workers
+        converting at the same time each write their own temporary files)
+        """
+        suffix = f'.{os.getpid()}.tmp'
+        with open(prefix + '.npy' + suffix, 'wb') as f:
+            np.save(f, np.asarray(self.vectors, dtype=np.float32))
+        os.replace(prefix + '.npy' + suffix, prefix + '.npy')
+        words = sorted(self.word_to_row, key=self.word_to_row.get)
+        with open(prefix + '.vocab' + suffix, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(words))
+        os.replace(prefix + '.vocab' + suffix, prefix + '.vocab')
+
+    def mean_embedding(self, words):
+        """Mean vector of the known words (gather + mean); zeros if none are known."""
+        lookup = self.word_to_row.get
+        rows = [row for row in map(lookup, words) if row is not None]
+        if not rows:
+            return np.zeros(self.dim)
+        return self.vectors[rows].mean(axis=0)
+
+
+def convert_word2vec_text(src, prefix):
+    """One-time conversion of a word2vec text file into <prefix>.npy / <prefix>.vocab"""
+    from gensim.models import KeyedVectors
+
+    keyed_vectors = KeyedVectors.load_word2vec_format(src, binary=False)
+    index = EmbeddingIndex.from_keyed_vectors(keyed_vectors)
+    index.save(prefix)
+    return index
+
+
+# -------------------------------
+# Tag embedding cache
+# -------------------------------
+
+class TagEmbeddingCache:
+    """
+    Bounded LRU of tag string -> mean embedding of its `words(tags)`, with
+    hit/miss counters. A hit skips splitting the string again.
+    """
+
+    def __init__(self, index, words=str.split, maxsize=20000):
+        self.index = index
+        self.words = words
+        self._lookup = lru_cache(maxsize=maxsize)(self._embed)
+
+    def _embed(self, tags):
+        embedding = self.index.mean_embedding(self.words(tags))
+        # Shared between callers, so make accidental in-place edits fail loudly
+        embedding.setflags(write=False)
+        return embedding
+
+    def get(self, tags):
+        return self._lookup(tags)
+
+    def clear(self):
+        self._lookup.cache_clear()
+
+    def stats(self):
+        info = self._lookup.cache_info()
+        lookups = info.hits + info.misses
+        return {
+            'hits': info.hits,
+            'misses': info.misses,
+            'size': info.currsize,
+            'maxsize': info.maxsize,
+            'hit_rate': round(info.hits / lookups, 4) if lookups else 0.0
+        }
+
+
+if __name__ == '__main__':
+    # python -m Project.embedding_index <word2vec.txt> <output prefix>
+    import sys
+    convert_word2vec_text(sys.argv[1], sys.argv[2])
+    print(f"Wrote {sys.argv[2]}.npy and {sys.argv[2]}.vocab")
@@ -1,46 +1,108 @@
 import numpy as np
-import pandas as pd
-import lightgbm as lgb
 import pickle
 import os
-from gensim.models import KeyedVectors
+import threading
+import time
+from CreatePSQL_db.tag_tokens import model_text
+from Project.embedding_index import EmbeddingIndex, TagEmbeddingCache, convert_word2vec_text
 
 # -------------------------------
-# Load all required artifacts
+# Artifacts (loaded lazily on first prediction)
 # -------------------------------
 
-# Load GloVe model
-glove_model = KeyedVectors.load_word2vec_format('./Project/Model_dir/glove.6B.50d.word2vec.txt', binary=False)
+model_dir = './Project/Model_dir'
+glove_path = f'{model_dir}/glove.6B.50d.word2vec.txt'
+glove_index_prefix = f'{model_dir}/glove.6B.50d'
 
-# Load LabelEncoders
-with open('./Project/Model_dir/le_country.pkl', 'rb') as f:
-    le_country = pickle.load(f)
+target_cols = ['#views', '#comments', '#likes', '#dislikes']
+valid_categories = ['People and Lifestyle', 'Music', 'Films', 'Travel and Vlogs','Science and Technology', 'Gaming and Sports', 'Current Affairs']
+required_fields = ['tags', 'duration', 'country', 'category']
+EMBED_DIM = 50
+
+glove_index = None
+tag_embedding_cache = None
+le_country = None
+le_category = None
+known_countries = set()
+models = {}
 
-with open('./Project/Model_dir/le_category.pkl', 'rb') as f:
-    le_category = pickle.load(f)
+load_metrics = {'loaded': False, 'load_seconds': None}
+_load_lock = threading.Lock()
+_encoders_lock = threading.Lock()
 
-# Load trained LightGBM models
-models = {}
-target_cols = ['#views', '#comments', '#likes', '#dislikes']
-for target in target_cols:
-    model_path = f'./Project/Model_dir/models/lgb_{target}.txt'
-    models[target] = lgb.Booster(model_file=model_path)
+def load_encoders():
+    """
+    Load the country and category LabelEncoders once. They are small, and
+    all validate_input needs, so checking an input does not load the models.
+    """
+    global le_country, le_category, known_countries
+
+    if le_country is not None:
+        return
+    with _encoders_lock:
+        if le_country is not None:
+            return
+        with open(f'{model_dir}/le_category.pkl', 'rb') as f:
+            le_category = pickle.load(f)
+        with open(f'{model_dir}/le_country.pkl', 'rb') as f:
+            countries = pickle.load(f)
+        known_countries = set(countries.classes_)
+        # Set last: the checks above read it as "loaded"
+        le_country = countries
+
+def load_artifacts():
+    """
+    Load the GloVe index, label encoders and LightGBM boosters once. Called
+    on the first prediction; call it up front to load before forking workers.
+    """
+    global glove_index, tag_embedding_cache
+
+    if load_metrics['loaded']:
+        return
+    with _load_lock:
+        if load_metrics['loaded']:
+            return
+        started = time.perf_counter()
+
+        # GloVe vectors as a memory-mapped index; the word2vec text file is
+        # only parsed if the one-time conversion has not been run yet
+        if not EmbeddingIndex.exists(glove_index_prefix):
+            convert_word2vec_text(glove_path, glove_index_prefix)
+        glove_index = EmbeddingIndex.load(glove_index_prefix)
+
+        # Popular tag sets repeat a lot, so keep their embeddings around,
+        # keyed by the cleaned (and length-capped) tag text
+        tag_embedding_cache = TagEmbeddingCache(
+            glove_index, maxsize=int(os.getenv('TAG_CACHE_SIZE', 20000))
+        )
+
+        load_encoders()
+
+        # Load trained LightGBM models
+        import lightgbm as lgb
+        for target in target_cols:
+            model_path = f'{model_dir}/models/lgb_{target}.txt'
+            models[target] = lgb.Booster(model_file=model_path)
+
+        load_metrics['load_seconds'] = round(time.perf_counter() - started, 3)
+        load_metrics['loaded'] = True
 
 # -------------------------------
 # Helper functions
 # -------------------------------
 
-# Clean tags (replace '|' with space, limit to 512 characters)
-def clean_tags(tags):
-    if pd.isna(tags):
-        return ''
-    return str(tags).replace('|', ' ')[:512]
+# Clean tags (replace '|' with space, limit to 512 characters); the rules
+# live in CreatePSQL_db/tag_tokens.py next to the word cloud's
+clean_tags = model_text
+
+# Get average embedding for tags, cached by their cleaned text
+def get_avg_embedding(tags):
+    return tag_embedding_cache.get(model_text(tags))
 
-# Get average embedding for tags
-def get_avg_embedding(tags, model=glove_model, dim=50):
-    words = tags.split()
-    embeddings = [model[word] for word in words if word in model]
-    return np.mean(embeddings, axis=0) if embeddings else np.zeros(dim)
+def tag_cache_stats():
+    if tag_embedding_cache is None:
+        return {}
+    return tag_embedding_cache.stats()
 
 # -------------------------------
 # Main prediction function
@@ -57,43 +119,69 @@ def predict_from_input(input_data):
         'category': "Music"
     }
     """
-    # print("Input data:", input_data)
-    # Prepare input DataFrame
-    df_input = pd.DataFrame([input_data])
-
-    if df_input['category'].iloc[0] not in ['People and Lifestyle', 'Music', 'Films', 'Travel and Vlogs','Science and Technology', 'Gaming and Sports', 'Current Affairs']:
-        
+    if input_data['category'] not in valid_categories:
         print("Enter valid category")
-        
         return {}
-    # print( df_input['category'].iloc[0])
-    # print( df_input['country'].iloc[0])
-    # print( df_input['tags'].iloc[0])
-    # print(df_input['duration'].iloc[0])
-    # Clean and process inputs
-    df_input['clean_tags'] = df_input['tags'].apply(clean_tags)
-    df_input['log_duration'] = np.log1p(df_input['duration'].clip(lower=0))
-    df_input['country_encoded'] = le_country.transform(df_input['country'])
-    df_input['category_encoded'] = le_category.transform(df_input['category'])
-
-    # Get tag embeddings
-    tag_embeds = df_input['clean_tags'].apply(get_avg_embedding)
-    tag_embeds = np.vstack(tag_embeds.values)
-
-    # Final feature matrix
-    X_processed = np.hstack([
-        df_input[['log_duration', 'country_encoded', 'category_encoded']].values,
-        tag_embeds
-    ])
-
-    # Predict for each target
-    predictions = {}
-    for target in target_cols:
-        pred_log = models[target].predict(X_processed)[0]
-        pred = np.expm1(pred_log)  # Reverse log1p
-        predictions[target] = pred
-
-    return predictions
+
+    return predict_batch([input_data])[0]
+
+def validate_input(input_data):
+    """Return an error message for an unusable input, or None if it can be scored"""
+    load_encoders()
+    if not isinstance(input_data, dict) or not all(field in input_data for field in required_fields):
+        return "Missing required field(s)"
+    try:
+        float(input_data['duration'])
+    except (TypeError, ValueError):
+        return "Invalid duration format"
+    if input_data['category'] not in valid_categories:
+        return "Invalid category specified"
+    if input_data['country'] not in known_countries:
+        return "Invalid country specified"
+    return None
+
+def build_features(inputs):
+    """
+    Feature matrix for a list of inputs, one row each:
+    [log_duration, country_encoded, category_encoded, 50-d tag embedding]
+    """
+    X = np.empty((len(inputs), 3 + EMBED_DIM))
+
+    durations = np.array([float(item['duration']) for item in inputs])
+    X[:, 0] = np.log1p(np.clip(durations, 0, None))
+    X[:, 1] = le_country.transform([item['country'] for item in inputs])
+    X[:, 2] = le_category.transform([item['category'] for item in inputs])
+
+    for row, item in enumerate(inputs):
+        X[row, 3:] = get_avg_embedding(item['tags'])
+
+    return X
+
+def predict_batch(inputs):
+    """
+    inputs: list of dicts shaped like predict_from_input's input_data.
+    Builds one feature matrix and calls each booster once for the whole batch.
+    Returns a list aligned with inputs; items with an invalid category get {}.
+    Unknown countries raise ValueError, as in predict_from_input.
+    """
+    load_artifacts()
+    results = [{} for _ in inputs]
+    valid = [i for i, item in enumerate(inputs) if item['category'] in valid_categories]
+    if not valid:
+        return results
+
+    X_processed = build_features([inputs[i] for i in valid])
+
+    # Predict for each target, reversing the log1p
+    batch_preds = {
+        target: np.expm1(models[target].predict(X_processed))
+        for target in target_cols
+    }
+
+    for row, i in enumerate(valid):
+        results[i] = {target: batch_preds[target][row] for target in target_cols}
+
+    return results
 
 # -------------------------------
 # Example usage
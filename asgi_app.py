@@ -0,0 +1,460 @@
+import time
+BOOT_STARTED = time.perf_counter()
+
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import create_async_engine
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+from config import Config
+from endpoints import CHARTS, ChartQuery, DATA_VERSION_SQL, EndpointError, TEST_ROWS_SQL, video_row
+from endpoints import ROW_FORMATS, ROWS_BATCH, rows_query, row_encoder
+from serializers import FORMATS, FormatUnavailable, dumps_json, encode_columnar, negotiate
+from endpoints import predict_payload, predict_batch_payload, PREDICT_ERROR, PREDICT_BATCH_ERROR
+from dashboard import AGGREGATE_PANELS, dashboard_queries, dashboard_shape
+from columnar_engine import ColumnarEngine, ColumnarStore
+from metrics import LatencyMetrics, RequestTimer, current_timer, phase, wants_prometheus
+from metrics import explain_payload, explain_requested, explain_statement
+from Project.prediction import load_artifacts, load_metrics, predict_batch as predict_inline, tag_cache_stats
+from prediction_pool import PredictionPoolBusy, pool_from_config
+from db_routing import ReplicaSet, engine_options
+
+# -------------------------------
+# Async entry point: same routes and JSON as app.py
+# -------------------------------
+# Run with e.g. `uvicorn asgi_app:app --workers 4`. Chart queries go through
+# asyncpg, so a slow query only holds its own request; predictions run in
+# the thread pool.
+
+logger = logging.getLogger('asgi_app')
+
+
+def async_database_uri(url=None):
+    if url is None and Config.ASYNC_DATABASE_URI:
+        url = make_url(Config.ASYNC_DATABASE_URI)
+    else:
+        url = make_url(url or Config.SQLALCHEMY_DATABASE_URI).set(drivername='postgresql+asyncpg')
+    # asyncpg prepares every statement; this many stay prepared per connection
+    return url.update_query_dict({'prepared_statement_cache_size': str(Config.PREPARED_STATEMENT_CACHE_SIZE)})
+
+def make_async_engine(url=None):
+    return create_async_engine(
+        async_database_uri(url),
+        **engine_options(Config.ASYNC_POOL_SIZE, Config.ASYNC_MAX_OVERFLOW, asyncpg=True)
+    )
+
+engine = make_async_engine()
+# Chart reads: replicas first, the primary when none is usable or in sync
+replicas = ReplicaSet(
+    engine,
+    [(f'replica{i}', make_async_engine(url)) for i, url in enumerate(Config.DATABASE_REPLICA_URLS)],
+    retry_seconds=Config.REPLICA_RETRY_SECONDS,
+    check_seconds=Config.DATA_VERSION_CHECK_SECONDS
+)
+
+# Cancelling a request cancels its asyncpg query on the server; the
+# statement_timeout, a little longer, catches anything that slips past
+STATEMENT_TIMEOUT_MS = int((Config.REQUEST_TIMEOUT_SECONDS + 1) * 1000)
+
+# In-memory mode (ANALYTICS_ENGINE=memory): loading yt and the NumPy group-bys
+# are synchronous, so they go through a plain engine and the thread pool
+columnar_store = None
+if Config.ANALYTICS_ENGINE == 'memory':
+    sync_engine = create_engine(Config.SQLALCHEMY_DATABASE_URI, **engine_options(1, 0))
+
+    def read_data_version():
+        # Errors propagate; ColumnarStore keeps the copy it has
+        with sync_engine.connect() as conn:
+            version = conn.execute(DATA_VERSION_SQL).scalar()
+        return version or '0'
+
+    columnar_store = ColumnarStore(
+        loader=lambda: ColumnarEngine.load(sync_engine),
+        version_source=read_data_version,
+        check_seconds=Config.DATA_VERSION_CHECK_SECONDS
+    )
+
+# With PREDICTION_WORKERS set, the pool loads the models and forks its
+# workers at import, before the event loop and its thread pool exist
+prediction_pool = pool_from_config()
+scorer = prediction_pool.predict if prediction_pool is not None else predict_inline
+
+
+latency_metrics = LatencyMetrics()
+
+
+class TimingMiddleware:
+    """Times every HTTP request into latency_metrics and adds a Server-Timing header"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        timer = RequestTimer()
+        token = current_timer.set(timer)
+        status = 500
+
+        async def send_timed(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+                message.setdefault('headers', [])
+                message['headers'] = list(message['headers']) + [
+                    (b'server-timing', timer.server_timing().encode())
+                ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_timed)
+        finally:
+            # Streamed bodies (/rows) are timed to the end of the stream here
+            route = scope['path'] if scope['path'] in known_routes else 'unmatched'
+            latency_metrics.record(route, timer, status)
+            current_timer.reset(token)
+
+
+class ChartResponse(JSONResponse):
+    """JSON the way Flask's jsonify writes it (NUMERIC values as strings), via orjson when installed"""
+
+    def render(self, content):
+        return dumps_json(content)
+
+
+def chart_response(data, fmt):
+    if fmt == 'json':
+        return ChartResponse(data)
+    return Response(encode_columnar(data, fmt), media_type=FORMATS[fmt])
+
+
+async def read_version(conn):
+    try:
+        return (await conn.execute(DATA_VERSION_SQL)).scalar()
+    except DBAPIError:
+        await conn.rollback()
+        return None
+
+async def primary_version():
+    async with engine.connect() as conn:
+        return await read_version(conn) or '0'
+
+async def fetch_rows(query, limit):
+    """
+    Run a ChartQuery once one of the endpoint's slots is free, on the first
+    usable replica or else the primary (see db_routing)
+    """
+    with phase('queue'):
+        await limit.acquire()
+    try:
+        for name, candidate in replicas.candidates():
+            conn = candidate.connect()
+            try:
+                await conn.start()
+            except (DBAPIError, OSError) as e:
+                if name == 'primary':
+                    raise
+                replicas.failed(name, e)
+                continue
+            try:
+                if replicas.needs_check(name) and \
+                        not replicas.in_sync(name, await read_version(conn), await primary_version()):
+                    continue
+                await conn.execute(
+                    text("SELECT set_config('statement_timeout', :timeout, true)"),
+                    {'timeout': f'{STATEMENT_TIMEOUT_MS}ms'}
+                )
+                with phase('db'):
+                    result = await conn.execute(query.statement, query.params)
+                with phase('materialize'):
+                    rows = result.fetchall()
+            except DBAPIError as e:
+                # Only a lost connection moves on; a bad query fails here too
+                if name == 'primary' or not e.connection_invalidated:
+                    raise
+                replicas.failed(name, e)
+                continue
+            finally:
+                await conn.close()
+            replicas.used(name)
+            return rows
+    finally:
+        limit.release()
+
+
+async def explain_response(queries, limit):
+    """EXPLAIN (ANALYZE, BUFFERS) of each named (statement, params), instead of the data"""
+    plans = {}
+    for name, (statement, params) in queries.items():
+        rows = await asyncio.wait_for(
+            fetch_rows(ChartQuery(explain_statement(statement), params, None), limit),
+            Config.REQUEST_TIMEOUT_SECONDS
+        )
+        plans[name] = explain_payload(statement, params, rows[0][0])
+    return ChartResponse(plans, headers={'Cache-Control': 'no-store'})
+
+
+def chart_endpoint(name):
+    chart = CHARTS[name]
+    limit = asyncio.Semaphore(Config.ENDPOINT_CONCURRENCY)
+
+    async def endpoint(request):
+        try:
+            with phase('parse'):
+                fmt = negotiate(request.query_params.get('format'), request.headers.get('accept'))
+                if fmt is None:
+                    raise EndpointError(f"Invalid format. Use one of: {', '.join(FORMATS)}")
+                explain = explain_requested(request.query_params)
+
+            if columnar_store is not None and name in AGGREGATE_PANELS:
+                if explain:
+                    raise EndpointError("explain=1 needs ANALYTICS_ENGINE=postgres")
+                with phase('engine'):
+                    data = await asyncio.wait_for(run_in_threadpool(
+                        lambda: AGGREGATE_PANELS[name](columnar_store.get(), request.query_params)
+                    ), Config.REQUEST_TIMEOUT_SECONDS)
+            else:
+                with phase('parse'):
+                    query = chart.build(request.query_params)
+                if explain:
+                    return await explain_response({name: (query.statement, query.params)}, limit)
+                results = await asyncio.wait_for(
+                    fetch_rows(query, limit), Config.REQUEST_TIMEOUT_SECONDS
+                )
+                with phase('materialize'):
+                    data = chart.shape(results, query.context)
+
+            with phase('serialize'):
+                return chart_response(data, fmt)
+
+        except EndpointError as e:
+            return JSONResponse({"error": str(e)}, status_code=400)
+        except FormatUnavailable as e:
+            return JSONResponse({"error": str(e)}, status_code=406)
+        except asyncio.TimeoutError:
+            logger.error(f"{chart.log_label} error: timed out")
+            return JSONResponse({
+                "error": chart.error_message,
+                "details": f"Timed out after {Config.REQUEST_TIMEOUT_SECONDS}s"
+            }, status_code=504)
+        except Exception as e:
+            logger.error(f"{chart.log_label} error: {str(e)}")
+            return JSONResponse({
+                "error": chart.error_message,
+                "details": str(e)
+            }, status_code=500)
+
+    return endpoint
+
+
+rows_limit = asyncio.Semaphore(Config.ENDPOINT_CONCURRENCY)
+
+async def rows(request):
+    try:
+        with phase('parse'):
+            export = rows_query(request.query_params, request.headers.get('accept'))
+        if explain_requested(request.query_params):
+            return await explain_response({'rows': (export.statement, export.params)}, rows_limit)
+        encoder = row_encoder(export)
+    except EndpointError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    except FormatUnavailable as e:
+        return JSONResponse({"error": str(e)}, status_code=406)
+    except Exception as e:
+        logger.error(f"Rows export error: {str(e)}")
+        return JSONResponse({"error": "Failed to export rows", "details": str(e)}, status_code=500)
+
+    async def generate():
+        # Exports are long by nature, so no request timeout; server-side
+        # cursor, one batch of rows in memory at a time
+        async with rows_limit:
+            try:
+                async with engine.connect() as conn:
+                    result = await conn.stream(export.statement, export.params)
+                    yield encoder.header()
+                    async for batch in result.partitions(ROWS_BATCH):
+                        yield encoder.batch(batch)
+                    yield encoder.footer()
+            except Exception as e:
+                logger.error(f"Rows export error: {str(e)}")
+                raise
+
+    headers = {}
+    if export.format == 'csv':
+        headers['Content-Disposition'] = 'attachment; filename=rows.csv'
+    return StreamingResponse(generate(), media_type=ROW_FORMATS[export.format], headers=headers)
+
+
+dashboard_limit = asyncio.Semaphore(Config.ENDPOINT_CONCURRENCY)
+
+async def dashboard(request):
+    try:
+        source = None
+        if columnar_store is not None:
+            source = await run_in_threadpool(columnar_store.get)
+        with phase('parse'):
+            panels, queries = dashboard_queries(request.query_params, source)
+        if explain_requested(request.query_params):
+            return await explain_response(queries, dashboard_limit)
+        # The aggregate and the word_cloud query run side by side
+        names = list(queries)
+        results = await asyncio.wait_for(asyncio.gather(*(
+            fetch_rows(ChartQuery(*queries[name], None), dashboard_limit) for name in names
+        )), Config.REQUEST_TIMEOUT_SECONDS)
+        with phase('materialize'):
+            data = await run_in_threadpool(
+                dashboard_shape, panels, dict(zip(names, results)), request.query_params, source
+            )
+        with phase('serialize'):
+            return ChartResponse(data)
+
+    except EndpointError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    except asyncio.TimeoutError:
+        logger.error("Dashboard error: timed out")
+        return JSONResponse({
+            "error": "Failed to generate dashboard data",
+            "details": f"Timed out after {Config.REQUEST_TIMEOUT_SECONDS}s"
+        }, status_code=504)
+    except Exception as e:
+        logger.error(f"Dashboard error: {str(e)}")
+        return JSONResponse({
+            "error": "Failed to generate dashboard data",
+            "details": str(e)
+        }, status_code=500)
+
+
+test_limit = asyncio.Semaphore(Config.ENDPOINT_CONCURRENCY)
+
+async def test(request):
+    try:
+        results = await asyncio.wait_for(
+            fetch_rows(ChartQuery(TEST_ROWS_SQL, {}, None), test_limit),
+            Config.REQUEST_TIMEOUT_SECONDS
+        )
+        return JSONResponse([video_row(item) for item in results])
+
+    except Exception as e:
+        logger.error(f"Database error: {str(e)}")
+        return JSONResponse({"error": "Database operation failed"}, status_code=500)
+
+
+def busy_response(e):
+    return JSONResponse({"error": str(e), "status": "busy"}, status_code=503, headers={'Retry-After': '1'})
+
+
+async def predict(request):
+    try:
+        payload, status = await run_in_threadpool(predict_payload, await request.json(), scorer)
+        return JSONResponse(payload, status_code=status)
+
+    except PredictionPoolBusy as e:
+        return busy_response(e)
+
+    except Exception as e:
+        logger.error(f"Prediction error: {str(e)}")
+        return JSONResponse({
+            "error": PREDICT_ERROR,
+            "details": str(e),
+            "status": "error"
+        }, status_code=500)
+
+
+async def predict_batch(request):
+    try:
+        payload, status = await run_in_threadpool(predict_batch_payload, await request.json(), scorer)
+        return JSONResponse(payload, status_code=status)
+
+    except PredictionPoolBusy as e:
+        return busy_response(e)
+
+    except Exception as e:
+        logger.error(f"Batch prediction error: {str(e)}")
+        return JSONResponse({
+            "error": PREDICT_BATCH_ERROR,
+            "details": str(e),
+            "status": "error"
+        }, status_code=500)
+
+
+async def health(request):
+    return JSONResponse({
+        "status": "ok",
+        "boot_seconds": STARTUP_METRICS['boot_seconds'],
+        "models_loaded": load_metrics['loaded'],
+        "model_load_seconds": load_metrics['load_seconds'],
+        "tag_cache": tag_cache_stats(),
+        "prediction_pool": prediction_pool.stats() if prediction_pool is not None else None,
+        "db_pool": engine.pool.status(),
+        "databases": replicas.stats(),
+        "analytics_engine": Config.ANALYTICS_ENGINE,
+        "columnar": columnar_store.stats() if columnar_store is not None else None
+    })
+
+
+async def metrics(request):
+    """Per-route latency histograms (JSON, or Prometheus text with format=prometheus)"""
+    if wants_prometheus(request.query_params.get('format'), request.headers.get('accept')):
+        return PlainTextResponse(latency_metrics.prometheus(), media_type='text/plain; version=0.0.4')
+    return ChartResponse(latency_metrics.snapshot())
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # Models load lazily on the first prediction unless asked to preload
+    if Config.PRELOAD_MODELS:
+        await run_in_threadpool(load_artifacts)
+    yield
+    for _, candidate in replicas.replicas:
+        await candidate.dispose()
+    await engine.dispose()
+    if prediction_pool is not None:
+        prediction_pool.close()
+
+
+routes = [
+    Route('/test', test, methods=['GET']),
+    Route('/rows', rows, methods=['GET']),
+]
+routes += [Route(f'/{name}', chart_endpoint(name), methods=['GET']) for name in CHARTS]
+routes += [
+    Route('/dashboard', dashboard, methods=['GET']),
+    Route('/predict', predict, methods=['POST']),
+    Route('/predict_batch', predict_batch, methods=['POST']),
+    Route('/health', health, methods=['GET']),
+    Route('/metrics', metrics, methods=['GET']),
+]
+known_routes = {route.path for route in routes}
+
+app = Starlette(
+    routes=routes,
+    middleware=[
+        Middleware(
+            CORSMiddleware,
+            allow_origins=["*"],
+            allow_methods=["GET", "POST", "OPTIONS"],
+            allow_headers=["Content-Type", "Authorization", "ngrok-skip-browser-warning"],
+            expose_headers=["X-Custom-Header"]
+        ),
+        Middleware(TimingMiddleware),
+    ],
+    lifespan=lifespan
+)
+
+STARTUP_METRICS = {'boot_seconds': round(time.perf_counter() - BOOT_STARTED, 3)}
+logger.info(f"Startup completed in {STARTUP_METRICS['boot_seconds']}s")
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, host='0.0.0.0', port=8000)
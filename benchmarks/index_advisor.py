@@ -0,0 +1,356 @@
+import argparse
+import glob
+import hashlib
+import json
+import re
+import time
+from collections import Counter
+
+from sqlalchemy import create_engine, text
+
+from benchmarks.run import PostgresTarget, Skipped, route_cases
+from benchmarks.synthetic import month_range
+from CreatePSQL_db.rollups import (daily_table, monthly_stats_table, source_table,
+                                   tag_counts_table)
+from CreatePSQL_db.schema import INDEX_ADVICE_DDL, index_advice_table
+from metrics import QueryLog
+
+# -------------------------------
+# Index advisor
+# -------------------------------
+# 1. Workload: the SQL the endpoints ran, from query logs written with
+#    QUERY_LOG_PATH set, or by replaying the benchmark grid against the data.
+# 2. Shapes: for each query, the equality and range columns its scans filter
+#    on (from EXPLAIN) and the columns it reads.
+# 3. Candidates: a covering B-tree per (table, filter columns), equality
+#    columns first, the columns read in INCLUDE; and BRIN on range columns.
+# 4. Each candidate is created and the queries whose plan picks it are timed
+#    (best of --runs) before and after; it is kept only if they got at least
+#    --min-gain faster (weighted by how often they ran). Kept indexes are noted
+#    in yt_index_advice, so createDB.py recreates those on yt after a reload.
+#
+#   python -m benchmarks.index_advisor --database-url postgresql://... [--query-log 'queries.log*']
+
+TABLES = [source_table, daily_table, monthly_stats_table, tag_counts_table]
+
+# An index holds at most 32 key + INCLUDE columns
+MAX_INDEX_COLUMNS = 32
+
+_CONDITION = re.compile(r'(?:\w+\.)?("[^"]+"|[A-Za-z_]\w*)\s*(=\s*ANY|>=|<=|<>|=|<|>)')
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+
+
+# -------------------------------
+# Workload
+# -------------------------------
+
+def read_query_logs(pattern):
+    queries = Counter()
+    for path in glob.glob(pattern):
+        with open(path) as f:
+            for line in f:
+                queries[json.loads(line)['sql']] += 1
+    return queries
+
+
+def replay_workload(engine):
+    """The SQL of every benchmark case, run once against the current data"""
+    with engine.connect() as conn:
+        first, last = conn.execute(text(
+            f"SELECT to_char(MIN(day), 'YYYY-MM'), to_char(MAX(day), 'YYYY-MM') FROM {daily_table}"
+        )).one()
+        countries = conn.execute(text(
+            f"SELECT country FROM {daily_table} WHERE country IS NOT NULL "
+            "GROUP BY country ORDER BY SUM(video_count) DESC"
+        )).scalars().all()
+        categories = conn.execute(text(
+            f"SELECT DISTINCT category FROM {daily_table} WHERE category IS NOT NULL ORDER BY category"
+        )).scalars().all()
+    if first is None:
+        raise SystemExit(f"{daily_table} is empty; load data first")
+
+    start_year, start_month = map(int, first.split('-'))
+    end_year, end_month = map(int, last.split('-'))
+    months = month_range(first, (end_year - start_year) * 12 + end_month - start_month + 1)
+
+    log = QueryLog().install()
+    try:
+        target = PostgresTarget(engine)
+        for route, params in route_cases(months, countries, categories):
+            try:
+                target.call(route, params)
+            except Skipped:
+                pass
+    finally:
+        log.remove()
+    return Counter(log.queries)
+
+
+# -------------------------------
+# Shapes and candidates
+# -------------------------------
+
+def table_columns(conn, table):
+    return conn.execute(text(
+        "SELECT column_name FROM information_schema.columns "
+        "WHERE table_name = :table ORDER BY ordinal_position"
+    ), {'table': table}).scalars().all()
+
+
+def relation_tables(conn, tables):
+    """{relation: table} for `tables` and their partitions, which plans scan instead"""
+    relations = {table: table for table in tables}
+    for table in tables:
+        relations.update(dict.fromkeys(conn.execute(text(
+            "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = to_regclass(:table)"
+        ), {'table': table}).scalars().all(), table))
+    return relations
+
+
+def scan_conditions(plan, relations):
+    """(table, condition text) for every scan of one of `relations` in a plan tree"""
+    found = []
+    relation = relations.get(plan.get('Relation Name'))
+    if relation is not None:
+        for key in ('Filter', 'Index Cond', 'Recheck Cond'):
+            if key in plan:
+                found.append((relation, plan[key]))
+        if not any(key in plan for key in ('Filter', 'Index Cond', 'Recheck Cond')):
+            found.append((relation, ''))
+    for child in plan.get('Plans', []):
+        found += scan_conditions(child, relations)
+    return found
+
+
+def query_shapes(conn, sql, columns, relations):
+    """(table, equality columns, range columns, columns read) per scanned table"""
+    plan = conn.exec_driver_sql('EXPLAIN (VERBOSE, FORMAT JSON) ' + sql).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    bare_sql = _STRING_LITERAL.sub("''", sql)
+
+    shapes = {}
+    for table, condition in scan_conditions(plan[0]['Plan'], relations):
+        equality, ranged = shapes.setdefault(table, (set(), set()))
+        for match in _CONDITION.finditer(condition):
+            name = match.group(1).strip('"')
+            if name not in columns[table]:
+                continue
+            operator = match.group(2)
+            if operator.startswith('='):
+                equality.add(name)
+            elif operator != '<>':
+                ranged.add(name)
+
+    result = []
+    for table, (equality, ranged) in shapes.items():
+        read = {
+            col for col in columns[table]
+            if re.search(r'(?<![\w"#])"?' + re.escape(col) + r'"?(?![\w"])', bare_sql)
+        }
+        order = columns[table].index
+        result.append((table, sorted(equality, key=order), sorted(ranged - equality, key=order),
+                       sorted(read, key=order)))
+    return result
+
+
+def quote(col):
+    return f'"{col}"'
+
+
+def index_spec(method, keys, include=()):
+    spec = f"USING {method} ({', '.join(map(quote, keys))})"
+    if include:
+        spec += f" INCLUDE ({', '.join(map(quote, include))})"
+    return spec
+
+
+def spec_signature(spec):
+    """Method, key and INCLUDE columns of an index spec or pg_indexes.indexdef, for comparison"""
+    match = re.search(r'USING (\w+) \((.*?)\)(?: INCLUDE \((.*?)\))?$', spec)
+    if match is None:
+        return None
+    split = lambda cols: tuple(col.strip().strip('"') for col in cols.split(',')) if cols else ()
+    return match.group(1), split(match.group(2)), split(match.group(3))
+
+
+def candidate_indexes(shapes):
+    """
+    {(table, spec): weight}: one covering B-tree per (table, equality +
+    range columns), INCLUDE-ing what its queries read, and BRIN per range column.
+    """
+    covering = {}
+    candidates = Counter()
+    for (table, equality, ranged, read), weight in shapes.items():
+        keys = equality + ranged
+        if not keys:
+            continue
+        entry = covering.setdefault((table, keys), [set(), 0])
+        entry[0].update(col for col in read if col not in keys)
+        entry[1] += weight
+        for col in ranged:
+            candidates[(table, index_spec('brin', [col]))] += weight
+
+    for (table, keys), (include, weight) in covering.items():
+        include = sorted(include)
+        if len(keys) + len(include) > MAX_INDEX_COLUMNS:
+            include = []
+        candidates[(table, index_spec('btree', keys, include))] += weight
+    return candidates
+
+
+def existing_signatures(conn, table):
+    definitions = conn.execute(text(
+        "SELECT indexdef FROM pg_indexes WHERE tablename = :table"
+    ), {'table': table}).scalars().all()
+    return {spec_signature(definition) for definition in definitions} - {None}
+
+
+def already_served(signature, existing):
+    """True if an existing index has the same method, starts with the same keys and holds the INCLUDE columns"""
+    method, keys, include = signature
+    for other_method, other_keys, other_include in existing:
+        if (other_method == method and other_keys[:len(keys)] == keys
+                and set(include) <= set(other_keys) | set(other_include)):
+            return True
+    return False
+
+
+def advice_name(table, spec):
+    """Name suffix createDB.py's idx_<table>_<name> scheme turns into the index name"""
+    return 'adv_' + hashlib.sha1(f'{table} {spec}'.encode()).hexdigest()[:10]
+
+
+# -------------------------------
+# Measuring
+# -------------------------------
+
+def time_query(conn, sql, runs):
+    """Best of `runs` executions after one warm-up, in ms"""
+    conn.exec_driver_sql(sql).fetchall()
+    best = None
+    for _ in range(runs):
+        started = time.perf_counter()
+        conn.exec_driver_sql(sql).fetchall()
+        elapsed = (time.perf_counter() - started) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def index_tree(conn, index_name):
+    """The index and, on a partitioned table, its per-partition indexes"""
+    partition_indexes = conn.execute(text(
+        "SELECT relid::regclass::text FROM pg_partition_tree(:name) WHERE level > 0"
+    ), {'name': index_name}).scalars().all()
+    return [index_name, *partition_indexes]
+
+
+def plan_uses(conn, sql, index_names):
+    plan = conn.exec_driver_sql('EXPLAIN (FORMAT JSON) ' + sql).scalar()
+    plan = plan if isinstance(plan, str) else json.dumps(plan)
+    return any(f'"{name}"' in plan for name in index_names)
+
+
+def advise(engine, workload, runs=5, min_gain=0.05, dry_run=False):
+    report = {'queries': len(workload), 'executions': sum(workload.values()), 'candidates': []}
+
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        columns = {table: table_columns(conn, table) for table in TABLES}
+        relations = relation_tables(conn, TABLES)
+        shapes = Counter()
+        by_table = {table: Counter() for table in TABLES}
+        for sql, weight in workload.items():
+            for table, equality, ranged, read in query_shapes(conn, sql, columns, relations):
+                shapes[(table, tuple(equality), tuple(ranged), tuple(read))] += weight
+                by_table[table][sql] = weight
+        report['shapes'] = [
+            {'table': table, 'equality': list(equality), 'range': list(ranged),
+             'reads': len(read), 'weight': weight}
+            for (table, equality, ranged, read), weight in shapes.most_common()
+        ]
+
+        candidates = candidate_indexes(shapes)
+        if not dry_run:
+            conn.execute(text(INDEX_ADVICE_DDL))
+
+        # Current time of each query; updated as indexes are kept
+        baseline = {}
+        for (table, spec), weight in candidates.most_common():
+            entry = {'table': table, 'index': spec, 'weight': weight}
+            report['candidates'].append(entry)
+            if already_served(spec_signature(spec), existing_signatures(conn, table)):
+                entry['result'] = 'exists'
+                continue
+            if dry_run:
+                entry['result'] = 'proposed'
+                continue
+
+            if table not in baseline:
+                # Index-only scans need the visibility map, hence VACUUM first
+                conn.execute(text(f"VACUUM ANALYZE {table}"))
+                baseline[table] = {sql: time_query(conn, sql, runs) for sql in by_table[table]}
+
+            name = f'idx_{table}_{advice_name(table, spec)}'
+            started = time.perf_counter()
+            conn.execute(text(f"CREATE INDEX {name} ON {table} {spec}"))
+            entry['build_seconds'] = round(time.perf_counter() - started, 3)
+            indexes = index_tree(conn, name)
+            entry['size_bytes'] = sum(
+                conn.execute(text("SELECT pg_relation_size(:name)"), {'name': index}).scalar()
+                for index in indexes
+            )
+            conn.execute(text(f"VACUUM ANALYZE {table}"))
+
+            # Only the queries whose plan picks the index can get faster
+            users = [sql for sql in by_table[table] if plan_uses(conn, sql, indexes)]
+            entry['queries_using'] = len(users)
+            gain = 0.0
+            if users:
+                after = {sql: time_query(conn, sql, runs) for sql in users}
+                before_ms = sum(baseline[table][sql] * by_table[table][sql] for sql in users)
+                after_ms = sum(after[sql] * by_table[table][sql] for sql in users)
+                gain = (before_ms - after_ms) / before_ms if before_ms else 0.0
+                entry.update(before_ms=round(before_ms, 3), after_ms=round(after_ms, 3))
+            entry['gain'] = round(gain, 4)
+
+            if gain >= min_gain:
+                entry['result'] = 'kept'
+                baseline[table].update(after)
+                conn.execute(text(
+                    f"INSERT INTO {index_advice_table} (name, table_name, spec, gain) "
+                    "VALUES (:name, :table, :spec, :gain) ON CONFLICT (name) DO NOTHING"
+                ), {'name': advice_name(table, spec), 'table': table, 'spec': spec, 'gain': gain})
+            else:
+                entry['result'] = 'dropped' if users else 'unused'
+                conn.execute(text(f"DROP INDEX {name}"))
+
+    report['kept'] = [entry['index'] for entry in report['candidates'] if entry.get('result') == 'kept']
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Propose, test and keep indexes for the endpoint queries")
+    parser.add_argument('--database-url', required=True)
+    parser.add_argument('--query-log', help="glob of QUERY_LOG_PATH files; default: replay the benchmark grid")
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--min-gain', type=float, default=0.05,
+                        help="fraction by which a table's queries must speed up to keep an index")
+    parser.add_argument('--dry-run', action='store_true', help="only report shapes and candidates")
+    parser.add_argument('--output', help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    engine = create_engine(args.database_url)
+    workload = read_query_logs(args.query_log) if args.query_log else replay_workload(engine)
+    report = advise(engine, workload, args.runs, args.min_gain, args.dry_run)
+
+    output = json.dumps(report, indent=1)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,384 @@
+import argparse
+import itertools
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import datetime, timezone
+
+from werkzeug.datastructures import MultiDict
+
+from benchmarks.synthetic import (add_generator_arguments, generate_yt, generator_settings,
+                                  load_partitions, load_postgres, month_range, prediction_inputs)
+from columnar_engine import ColumnarEngine
+from dashboard import AGGREGATE_PANELS, dashboard_queries, dashboard_shape
+from endpoints import CHARTS, ROWS_BATCH, TEST_ROWS_SQL, rows_query, row_encoder, video_row
+from metrics import RequestTimer
+from serializers import dumps_json
+
+# -------------------------------
+# Benchmarks for the routes and the prediction path
+# -------------------------------
+# Targets:
+#   http     - a running server (app.py or asgi_app.py) at --base-url
+#   postgres - in process: the endpoint functions the routes run, against
+#              --database-url (--load first replaces yt with synthetic data)
+#   memory   - in process: the NumPy engine built from the synthetic data,
+#              no database (routes that need Postgres are skipped)
+#
+#   python -m benchmarks.run --target memory --output bench.json
+#   python -m benchmarks.run --compare before.json after.json
+#
+# Run from the repository root, so the models under ./Project load.
+
+PREDICT_BATCH_SIZES = [1, 10, 100, 1000, 10_000]
+
+
+# -------------------------------
+# Cases: each route across its filter combinations
+# -------------------------------
+
+def route_cases(months, countries, categories):
+    """(route, params) pairs; None leaves a parameter out"""
+    first, middle, last = months[0], months[len(months) // 2], months[-1]
+    quarter = months[len(months) // 2: len(months) // 2 + 3]
+    ranges = [
+        (None, None),
+        (middle, middle),
+        (quarter[0], quarter[-1]),
+        (first, last),
+    ]
+    country = countries[0]
+    two_categories = json.dumps(categories[:2])
+
+    axes = {
+        'test': {},
+        'rows': {'limit': [1000, 10_000], 'country': [None, country]},
+        'word_cloud': {'country': [None, country], 'category': [None, categories[0]], 'range': ranges},
+        'bar_chart': {'country': [None, country], 'range': ranges},
+        'radar_chart': {'categories': [None, two_categories], 'range': ranges},
+        'world_map': {'metric': ['likes', 'views'], 'range': ranges},
+        'corr_mat': {'country': ['ALL', country], 'categories': [None, two_categories], 'range': ranges},
+        'month_cat': {'country': ['ALL', country], 'metric': ['likes'], 'range': ranges[1:]},
+        'month_specific': {'month': [middle, last]},
+        'temp': {'range': ranges},
+        'dashboard': {'range': ranges},
+    }
+
+    cases = []
+    for route, options in axes.items():
+        names = list(options)
+        for values in itertools.product(*options.values()):
+            params = {}
+            for name, value in zip(names, values):
+                if name == 'range':
+                    if value[0] is not None:
+                        params['startDate'], params['endDate'] = value
+                elif value is not None:
+                    params[name] = value
+            cases.append((route, params))
+    return cases
+
+
+# -------------------------------
+# Targets: call(route, params) -> (status, response bytes, phase timings)
+# -------------------------------
+
+class Skipped(Exception):
+    """The target cannot serve this route"""
+
+
+class HttpTarget:
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.calls = 0
+
+    def call(self, route, params):
+        # A fresh `nocache` value per call keeps the response cache out of the numbers
+        self.calls += 1
+        query = urllib.parse.urlencode({**params, 'nocache': self.calls})
+        try:
+            with urllib.request.urlopen(f'{self.base_url}/{route}?{query}') as response:
+                return response.status, len(response.read()), {}
+        except urllib.error.HTTPError as e:
+            return e.code, len(e.read()), {}
+
+
+class PostgresTarget:
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    def call(self, route, params):
+        args = MultiDict(params)
+        timer = RequestTimer()
+        with self.engine.connect() as conn:
+            if route in CHARTS:
+                chart = CHARTS[route]
+                with timer.phase('parse'):
+                    query = chart.build(args)
+                with timer.phase('db'):
+                    result = conn.execute(query.statement, query.params)
+                with timer.phase('materialize'):
+                    data = chart.shape(result.fetchall(), query.context)
+            elif route == 'dashboard':
+                with timer.phase('parse'):
+                    panels, queries = dashboard_queries(args)
+                results = {}
+                for name, (statement, params) in queries.items():
+                    with timer.phase('db'):
+                        result = conn.execute(statement, params)
+                    with timer.phase('materialize'):
+                        results[name] = result.fetchall()
+                with timer.phase('materialize'):
+                    data = dashboard_shape(panels, results, args)
+            elif route == 'rows':
+                with timer.phase('parse'):
+                    export = rows_query(args)
+                    encoder = row_encoder(export)
+                size = len(encoder.header())
+                with timer.phase('db'):
+                    result = conn.execution_options(yield_per=ROWS_BATCH).execute(export.statement, export.params)
+                    for batch in result.partitions():
+                        size += len(encoder.batch(batch))
+                return 200, size + len(encoder.footer()), timer.phases
+            elif route == 'test':
+                with timer.phase('db'):
+                    rows = conn.execute(TEST_ROWS_SQL).fetchall()
+                with timer.phase('materialize'):
+                    data = [video_row(row) for row in rows]
+            else:
+                raise Skipped(route)
+        with timer.phase('serialize'):
+            body = dumps_json(data)
+        return 200, len(body), timer.phases
+
+
+class MemoryTarget:
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    def call(self, route, params):
+        args = MultiDict(params)
+        timer = RequestTimer()
+        if route in AGGREGATE_PANELS:
+            with timer.phase('engine'):
+                data = AGGREGATE_PANELS[route](self.engine, args)
+        elif route == 'dashboard':
+            args['panels'] = ','.join(AGGREGATE_PANELS)
+            with timer.phase('engine'):
+                panels, _ = dashboard_queries(args, self.engine)
+                data = dashboard_shape(panels, {}, args, self.engine)
+        else:
+            raise Skipped(route)
+        with timer.phase('serialize'):
+            body = dumps_json(data)
+        return 200, len(body), timer.phases
+
+
+# -------------------------------
+# Measuring
+# -------------------------------
+
+def summarize(latencies):
+    ordered = sorted(latencies)
+    return {
+        'runs': len(ordered),
+        'min_ms': round(ordered[0], 3),
+        'p50_ms': round(statistics.median(ordered), 3),
+        'p95_ms': round(ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))], 3),
+        'mean_ms': round(statistics.fmean(ordered), 3),
+        'max_ms': round(ordered[-1], 3),
+    }
+
+
+def bench_route(target, route, params, runs, warmup):
+    try:
+        for _ in range(warmup):
+            target.call(route, params)
+        latencies, phases = [], {}
+        for _ in range(runs):
+            started = time.perf_counter()
+            status, size, timings = target.call(route, params)
+            latencies.append((time.perf_counter() - started) * 1000)
+            for name, ms in timings.items():
+                phases.setdefault(name, []).append(ms)
+    except Skipped:
+        return {'route': f'/{route}', 'params': params, 'skipped': 'needs the postgres target'}
+
+    return {
+        'route': f'/{route}',
+        'params': params,
+        'status': status,
+        'bytes': size,
+        **summarize(latencies),
+        'phases_mean_ms': {name: round(statistics.fmean(values), 3) for name, values in phases.items()},
+    }
+
+
+def bench_predict(frame, batch_sizes, runs):
+    """predict_from_input (batch of 1) and predict_batch latency and rows/second"""
+    from Project import prediction
+    try:
+        prediction.load_artifacts()
+    except Exception as e:
+        return [{'skipped': f'models not available: {e}'}]
+
+    results = []
+    for size in batch_sizes:
+        inputs = prediction_inputs(frame, size, countries=prediction.known_countries)
+        if size == 1:
+            predict = lambda: prediction.predict_from_input(inputs[0])
+        else:
+            predict = lambda: prediction.predict_batch(inputs)
+
+        # The first call fills the tag-embedding cache; it is reported apart
+        started = time.perf_counter()
+        predict()
+        cold_ms = (time.perf_counter() - started) * 1000
+
+        latencies = []
+        for _ in range(runs):
+            started = time.perf_counter()
+            predict()
+            latencies.append((time.perf_counter() - started) * 1000)
+        stats = summarize(latencies)
+        results.append({
+            'batch_size': size,
+            'cold_ms': round(cold_ms, 3),
+            **stats,
+            'rows_per_second': round(size / (stats['p50_ms'] / 1000), 1),
+        })
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# -------------------------------
+# Comparing two result files
+# -------------------------------
+
+def case_key(entry):
+    return entry['route'] + '?' + urllib.parse.urlencode(sorted(entry['params'].items()))
+
+
+def compare(before_path, after_path, threshold):
+    """Print p50 changes per case; returns the number of regressions past `threshold`"""
+    with open(before_path) as f:
+        before = json.load(f)
+    with open(after_path) as f:
+        after = json.load(f)
+
+    pairs = []
+    old = {case_key(entry): entry for entry in before['routes'] if 'p50_ms' in entry}
+    for entry in after['routes']:
+        key = case_key(entry)
+        if 'p50_ms' in entry and key in old:
+            pairs.append((key, old[key]['p50_ms'], entry['p50_ms']))
+    old = {entry['batch_size']: entry for entry in before.get('predict', []) if 'p50_ms' in entry}
+    for entry in after.get('predict', []):
+        if entry.get('batch_size') in old:
+            pairs.append((f"predict[{entry['batch_size']}]",
+                          old[entry['batch_size']]['p50_ms'], entry['p50_ms']))
+
+    regressions = 0
+    for key, old_ms, new_ms in pairs:
+        ratio = new_ms / old_ms if old_ms else float('inf')
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = '  REGRESSION'
+            regressions += 1
+        print(f"{old_ms:10.3f} {new_ms:10.3f} {ratio:6.2f}x  {key}{flag}")
+    print(f"{len(pairs)} cases compared, {regressions} slower by more than {threshold:.0%}")
+    return regressions
+
+
+# -------------------------------
+# Command line
+# -------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the chart routes and the prediction path")
+    parser.add_argument('--target', choices=['http', 'postgres', 'memory'], default='memory')
+    parser.add_argument('--base-url', default='http://localhost:8000')
+    parser.add_argument('--database-url')
+    parser.add_argument('--load', action='store_true',
+                        help="replace yt in --database-url with the synthetic data first")
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--routes', help="comma-separated subset, e.g. bar_chart,dashboard")
+    parser.add_argument('--batch-sizes', default=','.join(map(str, PREDICT_BATCH_SIZES)))
+    parser.add_argument('--skip-predict', action='store_true')
+    parser.add_argument('--output', help="write the JSON results here instead of stdout")
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'),
+                        help="compare two result files instead of running")
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help="p50 slowdown counted as a regression by --compare")
+    add_generator_arguments(parser)
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare(*args.compare, args.threshold) else 0)
+
+    settings = generator_settings(args)
+    frame = generate_yt(**settings)
+
+    if args.target == 'http':
+        target = HttpTarget(args.base_url)
+    elif args.target == 'postgres':
+        if not args.database_url:
+            parser.error("--target postgres needs --database-url")
+        from sqlalchemy import create_engine
+        engine = create_engine(args.database_url)
+        if args.load:
+            load_postgres(engine, frame)
+        target = PostgresTarget(engine)
+    else:
+        target = MemoryTarget(ColumnarEngine.from_partitions(load_partitions(frame)))
+
+    cases = route_cases(month_range(args.start, args.months),
+                        frame['country'].value_counts().index.tolist(),
+                        sorted(frame['category'].unique()))
+    if args.routes:
+        wanted = set(args.routes.split(','))
+        cases = [case for case in cases if case[0] in wanted]
+
+    results = {
+        'meta': {
+            'commit': git_commit(),
+            'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'target': args.target,
+            'runs': args.runs,
+        },
+        'data': settings,
+        'routes': [bench_route(target, route, params, args.runs, args.warmup) for route, params in cases],
+        'predict': [] if args.skip_predict else bench_predict(
+            frame, [int(size) for size in args.batch_sizes.split(',')], args.runs
+        ),
+    }
+
+    output = json.dumps(results, indent=1)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
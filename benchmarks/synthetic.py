@@ -0,0 +1,186 @@
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from CreatePSQL_db.rollups import METRICS, refresh_rollups, source_table
+from CreatePSQL_db.schema import (chunk_months, copy_chunk, create_partitions, index_partition,
+                                 partitions, yt_columns, yt_indexes, yt_table_ddl)
+from CreatePSQL_db.tag_tokens import TagVocabulary
+from Project.prediction import valid_categories
+
+# -------------------------------
+# Synthetic yt data
+# -------------------------------
+# A seeded generator for yt-shaped rows, so benchmark runs on different
+# commits see the same data. Countries and tags are Zipf-skewed like the
+# real dataset, and a few NULLs are sprinkled in the columns that have them.
+#
+#   python -m benchmarks.synthetic --rows 1000000 --csv all_month_yt_data.csv
+#   python -m benchmarks.synthetic --rows 1000000 --database-url postgresql://...
+
+COUNTRIES = ['US', 'IN', 'GB', 'CA', 'DE', 'FR', 'JP', 'KR', 'MX', 'RU', 'BR']
+
+# METRICS names the SQL columns quoted; the frame uses the bare names
+METRIC_COLUMNS = [col.strip('"') for _, col in METRICS]
+
+
+def zipf_weights(n, exponent=1.1):
+    weights = 1.0 / np.arange(1, n + 1) ** exponent
+    return weights / weights.sum()
+
+
+def generate_yt(rows=100_000, countries=5, categories=7, months=24, start='2019-01',
+                tag_vocab=2000, seed=0):
+    """
+    yt rows as a DataFrame with the createDB column types. `countries` and
+    `categories` are counts (the real codes and category names come first),
+    `months` consecutive months from `start` are covered, and tags are drawn
+    from `tag_vocab` distinct words.
+    """
+    rng = np.random.default_rng(seed)
+    country_names = (COUNTRIES + [f'C{i}' for i in range(len(COUNTRIES), countries)])[:countries]
+    category_names = (valid_categories + [f'Category {i + 1}' for i in range(len(valid_categories), categories)])[:categories]
+
+    first_day = pd.Period(start, freq='M').start_time
+    last_day = (pd.Period(start, freq='M') + months - 1).end_time
+    days = pd.date_range(first_day, last_day.normalize(), freq='D').date
+
+    # A video trends on several days, so IDs repeat
+    video_ids = rng.integers(0, max(rows // 3, 1), rows)
+    tag_counts = rng.integers(0, 9, rows)
+    words = rng.choice(tag_vocab, tag_counts.sum(), p=zipf_weights(tag_vocab))
+    bounds = np.concatenate([[0], np.cumsum(tag_counts)])
+    tags = [
+        '|'.join(f'tag{word}' for word in words[lo:hi]) or '[none]'
+        for lo, hi in zip(bounds[:-1], bounds[1:])
+    ]
+
+    frame = pd.DataFrame({
+        'ID': [f'v{i}' for i in video_ids],
+        'title': 'title',
+        'category': rng.choice(category_names, rows),
+        '#views': rng.lognormal(12, 2, rows).astype('int64'),
+        '#comments': rng.lognormal(7, 2, rows).astype('int64'),
+        '#likes': rng.lognormal(9, 2, rows).astype('int64'),
+        '#dislikes': rng.lognormal(5, 2, rows).astype('int64'),
+        'timestamp': rng.choice(days, rows),
+        'duration': rng.integers(10, 5000, rows).astype(float),
+        'description': 'description',
+        'tags': tags,
+        'country': rng.choice(country_names, rows, p=zipf_weights(countries)),
+    })
+    for col, col_type in yt_columns.items():
+        if col_type == 'BIGINT':
+            frame[col] = frame[col].astype('Int64')
+    frame.loc[::97, 'duration'] = np.nan
+    frame.loc[::311, 'tags'] = None
+    frame.loc[::499, 'timestamp'] = None
+    frame.loc[::1009, '#dislikes'] = pd.NA
+    return frame
+
+
+def month_range(start, months):
+    """'YYYY-MM' labels of the months the generator covers"""
+    first = pd.Period(start, freq='M')
+    return [str(first + i) for i in range(months)]
+
+
+def load_postgres(engine, frame, chunk_rows=100_000):
+    """
+    Replace yt in the engine's database with `frame`, with the createDB
+    indexes and freshly built rollups. Meant for a benchmark database.
+    """
+    conn = engine.raw_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute(f"DROP TABLE IF EXISTS {source_table};")
+        cur.execute(yt_table_ddl(source_table))
+        create_partitions(cur, source_table, chunk_months(frame))
+        vocab = TagVocabulary.load(cur)
+        for lo in range(0, len(frame), chunk_rows):
+            chunk = frame.iloc[lo:lo + chunk_rows]
+            copy_chunk(cur, source_table, chunk.assign(tag_ids=vocab.encode(chunk['tags'])))
+        vocab.save(cur)
+        for partition in partitions(cur, source_table):
+            index_partition(cur, partition, yt_indexes)
+        for name, definition in yt_indexes.items():
+            cur.execute(f"CREATE INDEX idx_{source_table}_{name} ON {source_table} {definition};")
+        cur.execute(f"ANALYZE {source_table};")
+        refresh_rollups(cur)
+        conn.commit()
+        cur.close()
+    finally:
+        conn.close()
+
+
+def load_partitions(frame, chunk_rows=100_000):
+    """The frame as columnar_engine.LOAD_SQL-shaped row batches, NULLs as None"""
+    columns = ['timestamp', 'country', 'category'] + METRIC_COLUMNS
+    for lo in range(0, len(frame), chunk_rows):
+        chunk = frame.iloc[lo:lo + chunk_rows][columns].astype(object)
+        chunk = chunk.where(chunk.notna(), None)
+        yield list(chunk.itertuples(index=False, name=None))
+
+
+def prediction_inputs(frame, size, countries=None, seed=0):
+    """`size` /predict inputs drawn from the frame's rows (optionally only from `countries`)"""
+    rows = frame if countries is None else frame[frame['country'].isin(countries)]
+    sample = rows.sample(n=size, replace=len(rows) < size, random_state=seed)
+    return [
+        {
+            'tags': tags or '',
+            'duration': 300.0 if pd.isna(duration) else float(duration),
+            'country': country,
+            'category': category,
+        }
+        for tags, duration, country, category
+        in sample[['tags', 'duration', 'country', 'category']].itertuples(index=False, name=None)
+    ]
+
+
+# -------------------------------
+# Command line
+# -------------------------------
+
+def add_generator_arguments(parser):
+    group = parser.add_argument_group('synthetic data')
+    group.add_argument('--rows', type=int, default=100_000)
+    group.add_argument('--countries', type=int, default=5)
+    group.add_argument('--categories', type=int, default=len(valid_categories))
+    group.add_argument('--months', type=int, default=24)
+    group.add_argument('--start', default='2019-01', help="first month, 'YYYY-MM'")
+    group.add_argument('--tag-vocab', type=int, default=2000)
+    group.add_argument('--seed', type=int, default=0)
+
+
+def generator_settings(args):
+    return {
+        'rows': args.rows, 'countries': args.countries, 'categories': args.categories,
+        'months': args.months, 'start': args.start, 'tag_vocab': args.tag_vocab, 'seed': args.seed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic yt data")
+    add_generator_arguments(parser)
+    parser.add_argument('--csv', help="write a CSV createDB.py can load")
+    parser.add_argument('--database-url', help="replace yt in this (benchmark) database")
+    args = parser.parse_args()
+    if not (args.csv or args.database_url):
+        parser.error("give --csv and/or --database-url")
+
+    frame = generate_yt(**generator_settings(args))
+    if args.csv:
+        frame.to_csv(args.csv, index=False)
+        print(f"Wrote {len(frame)} rows to {args.csv}")
+    if args.database_url:
+        from sqlalchemy import create_engine
+        engine = create_engine(args.database_url)
+        load_postgres(engine, frame)
+        engine.dispose()
+        print(f"Loaded {len(frame)} rows into {source_table}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,231 @@
+import contextlib
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter
+from urllib.parse import urlencode
+
+from flask import request
+
+from response_cache import canonical_args
+from serializers import FORMATS
+
+logger = logging.getLogger(__name__)
+
+# -------------------------------
+# Cache warming
+# -------------------------------
+# Each process counts its cached GETs in memory by path, canonical args and
+# response format, in hourly buckets covering the last `window_hours`.
+# Every `flush_seconds` a thread rewrites ACCESS_LOG_PATH.<pid> with those
+# buckets, each cut to its `max_entries` most frequent combinations, so the
+# files stay bounded. When the data version changes (a load by
+# createDB.py), the warmer adds up the recent buckets of all processes and
+# replays the most requested combinations through the app, so their
+# responses are in the response cache before visitors ask. It stops at
+# `top` requests, after `time_budget` seconds or once its thread has used
+# `cpu_budget` seconds of CPU, whichever comes first.
+
+# WSGI environ key marking the warmer's own requests: not logged, not timed
+WARMING = 'yt.cache_warming'
+
+BUCKET_SECONDS = 3600
+
+
+def warming():
+    """Whether the current request is the warmer's"""
+    return bool(request.environ.get(WARMING))
+
+
+class AccessLog:
+    """Recent request counts, kept in memory and flushed to `path.<pid>` now and then"""
+
+    def __init__(self, path, window_hours=168, flush_seconds=60.0, max_entries=5000):
+        self.path = path
+        self.window = window_hours * 3600
+        self.flush_seconds = flush_seconds
+        self.max_entries = max_entries
+        # bucket start (epoch seconds) -> Counter of (path, args, variant)
+        self._buckets = {}
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def record(self, path, args, variant):
+        if warming():
+            return
+        combination = (path, canonical_args(args), variant)
+        bucket = int(time.time()) // BUCKET_SECONDS * BUCKET_SECONDS
+        with self._lock:
+            counts = self._buckets.get(bucket)
+            if counts is None:
+                counts = self._buckets[bucket] = Counter()
+                self._expire(bucket)
+            counts[combination] += 1
+            # Arbitrary query strings must not grow memory without bound
+            if len(counts) > 2 * self.max_entries:
+                self._buckets[bucket] = Counter(dict(counts.most_common(self.max_entries)))
+            if self._thread is None:
+                # Started here, in the serving process (after any fork)
+                self._thread = threading.Thread(target=self._flush_loop, name='access-log', daemon=True)
+                self._thread.start()
+
+    def _expire(self, now_bucket):
+        for bucket in [b for b in self._buckets if b <= now_bucket - self.window]:
+            del self._buckets[bucket]
+
+    def _snapshot(self):
+        with self._lock:
+            return {
+                bucket: counts.most_common(self.max_entries)
+                for bucket, counts in self._buckets.items()
+            }
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_seconds)
+            try:
+                self.flush()
+            except OSError as e:
+                logger.error(f"Writing the access log failed: {e}")
+
+    def flush(self):
+        """Replace this process's file with its current buckets"""
+        data = {str(bucket): [[*combination, count] for combination, count in entries]
+                for bucket, entries in self._snapshot().items()}
+        name = f'{self.path}.{os.getpid()}'
+        with open(name + '.tmp', 'w') as f:
+            json.dump(data, f)
+        os.replace(name + '.tmp', name)
+
+    def most_requested(self, limit):
+        """
+        The `limit` most frequent (path, canonical args, format) of the last
+        `window_hours`, across this process's counts and the other processes'
+        files. Files with nothing recent left are removed.
+        """
+        since = time.time() - self.window
+        counts = Counter()
+        for bucket, entries in self._snapshot().items():
+            if bucket > since:
+                for combination, count in entries:
+                    counts[combination] += count
+
+        own = f'{self.path}.{os.getpid()}'
+        for name in glob.glob(f'{glob.escape(self.path)}.*'):
+            if name == own or name.endswith('.tmp'):
+                continue
+            try:
+                with open(name) as f:
+                    buckets = json.load(f)
+            except (OSError, ValueError):
+                continue
+            recent = {bucket: entries for bucket, entries in buckets.items() if int(bucket) > since}
+            if not recent:
+                # A process that stopped long ago
+                with contextlib.suppress(OSError):
+                    os.remove(name)
+                continue
+            for entries in recent.values():
+                for path, args, variant, count in entries:
+                    counts[(path, args, variant)] += count
+        return [combination for combination, _ in counts.most_common(limit)]
+
+
+class CacheWarmer:
+    """
+    Renders the most requested chart responses into `cache` after each data
+    load, by running them through `app` like any other request. `seeds`
+    (path, canonical args, format) follow the logged combinations, so the
+    default views are warm even before there is a log; a seed that is not
+    answered with 200 is dropped.
+    """
+
+    def __init__(self, app, cache, access_log=None, seeds=(), top=200,
+                 time_budget=120.0, cpu_budget=60.0, check_seconds=5.0):
+        self.app = app
+        self.cache = cache
+        self.access_log = access_log
+        self.seeds = list(seeds)
+        self.top = top
+        self.time_budget = time_budget
+        self.cpu_budget = cpu_budget
+        self.check_seconds = check_seconds
+        self.warmed_version = None
+        self.last_run = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def ensure_started(self):
+        """Start the background thread (in the serving process, after any fork)"""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._watch, name='cache-warmer', daemon=True)
+                self._thread.start()
+
+    def _watch(self):
+        while True:
+            try:
+                version = self.cache.data_version()
+                if version != self.warmed_version:
+                    # Once per version, whatever the outcome
+                    self.warmed_version = version
+                    self.warm()
+            except Exception as e:
+                logger.error(f"Cache warming failed: {e}")
+            time.sleep(self.check_seconds)
+
+    def combinations(self):
+        """Most requested first, then the seeds not already among them"""
+        logged = self.access_log.most_requested(self.top) if self.access_log is not None else []
+        seen = set(logged)
+        return (logged + [seed for seed in self.seeds if seed not in seen])[:self.top]
+
+    def warm(self):
+        started = time.monotonic()
+        cpu_started = time.thread_time()
+        client = self.app.test_client()
+        warmed = failed = 0
+        stopped = None
+
+        # Counting the log is part of the budget
+        for path, args, variant in self.combinations():
+            if time.monotonic() - started >= self.time_budget:
+                stopped = 'time budget'
+                break
+            if time.thread_time() - cpu_started >= self.cpu_budget:
+                stopped = 'cpu budget'
+                break
+            try:
+                response = client.get(
+                    path,
+                    query_string=urlencode([tuple(item) for item in json.loads(args)]),
+                    headers={'Accept': FORMATS.get(variant, FORMATS['json'])},
+                    environ_base={WARMING: True}
+                )
+            except Exception as e:
+                logger.error(f"Cache warming {path} failed: {e}")
+                failed += 1
+                continue
+            if response.status_code == 200:
+                warmed += 1
+            else:
+                failed += 1
+                # A default view that needs parameters will not do better next time
+                if (path, args, variant) in self.seeds:
+                    self.seeds.remove((path, args, variant))
+
+        self.last_run = {
+            'data_version': self.cache.data_version(),
+            'warmed': warmed,
+            'failed': failed,
+            'stopped_by': stopped,
+            'seconds': round(time.monotonic() - started, 3),
+            'cpu_seconds': round(time.thread_time() - cpu_started, 3),
+        }
+        logger.info(f"Cache warmed: {self.last_run}")
+
+    def stats(self):
+        return {'warmed_version': self.warmed_version, 'last_run': self.last_run}
@@ -0,0 +1,300 @@
+import logging
+import threading
+import time
+from collections import namedtuple
+from datetime import date
+from decimal import Decimal
+
+import numpy as np
+from sqlalchemy import text
+
+from CreatePSQL_db.rollups import METRICS, source_table
+
+logger = logging.getLogger(__name__)
+
+# -------------------------------
+# In-memory columnar copy of yt
+# -------------------------------
+# yt is held as NumPy columns sorted by day: day ordinals (date ranges are a
+# searchsorted slice), dictionary-encoded country/category codes, and one
+# value array plus NULL mask per metric. `group` answers the same
+# SUM ... GROUP BY calls as dashboard.RowsSource with bincount kernels, so
+# the dashboard panels (and the chart endpoints built on them) run unchanged
+# on either.
+
+EPOCH = date(1970, 1, 1).toordinal()
+NULL_DAY = np.iinfo(np.int32).max
+
+# Integer sums go through bincount's float64 in two 26-bit halves, each of
+# which stays exact for up to 2**27 rows per group
+_LOW_BITS = 26
+_LOW_MASK = (1 << _LOW_BITS) - 1
+
+LOAD_SQL = f"""
+SELECT "timestamp", country, category, {', '.join(col for _, col in METRICS)}
+FROM {source_table}
+"""
+
+
+def encode(values, vocab):
+    """Dictionary-encode values (None included) into int16 codes, growing vocab"""
+    return np.fromiter((vocab.setdefault(value, len(vocab)) for value in values),
+                       dtype=np.int16, count=len(values))
+
+
+class ColumnarEngine:
+
+    def __init__(self, days, countries, categories, values, valid, country_labels, category_labels):
+        self.days = days                  # int32 days since 1970-01-01, NULL_DAY last
+        self.countries = countries        # int16 codes into country_labels
+        self.categories = categories      # int16 codes into category_labels
+        self.values = values              # metric -> int64 (float64 for duration), 0 where NULL
+        self.valid = valid                # metric -> bool, False where NULL
+        self.country_labels = country_labels
+        self.category_labels = category_labels
+        self.country_index = {label: code for code, label in enumerate(country_labels)}
+        self.category_index = {label: code for code, label in enumerate(category_labels)}
+
+        self.dated_rows = int(np.searchsorted(days, NULL_DAY))
+        dated = days[:self.dated_rows].astype('datetime64[D]')
+        months = np.full(len(days), -1, dtype=np.int32)
+        months[:self.dated_rows] = dated.astype('datetime64[M]').astype(np.int32)
+        self.months = months              # months since 1970-01, -1 where NULL
+        self.first_month = int(months[:self.dated_rows].min(initial=0))
+        self.month_count = int(months[:self.dated_rows].max(initial=0)) - self.first_month + 1
+        self.floats = {name: column.astype(np.float64) for name, column in values.items()}
+
+    def __len__(self):
+        return len(self.days)
+
+    # -------------------------------
+    # Loading
+    # -------------------------------
+
+    @classmethod
+    def load(cls, bind, chunk_rows=200_000):
+        """Read yt through a SQLAlchemy engine or connection"""
+        if hasattr(bind, 'connect'):
+            with bind.connect() as conn:
+                return cls.load(conn, chunk_rows)
+
+        result = bind.execution_options(stream_results=True, yield_per=chunk_rows).execute(text(LOAD_SQL))
+        return cls.from_partitions(result.partitions())
+
+    @classmethod
+    def from_partitions(cls, partitions):
+        """Build from batches of LOAD_SQL-shaped rows (dates, None for NULL)"""
+        country_vocab, category_vocab = {}, {}
+        chunks = []
+        for rows in partitions:
+            timestamps, countries, categories, *metrics = zip(*rows)
+            days = np.fromiter(
+                (NULL_DAY if day is None else day.toordinal() - EPOCH for day in timestamps),
+                dtype=np.int32, count=len(rows)
+            )
+            values, valid = {}, {}
+            for (name, _), column in zip(METRICS, metrics):
+                column = np.array(column, dtype=object)
+                valid[name] = column != None  # noqa: E711 (elementwise)
+                column[~valid[name]] = 0
+                values[name] = column.astype(np.float64 if name == 'duration' else np.int64)
+            chunks.append((days, encode(countries, country_vocab),
+                           encode(categories, category_vocab), values, valid))
+
+        return cls.from_columns(chunks, list(country_vocab), list(category_vocab))
+
+    @classmethod
+    def from_columns(cls, chunks, country_labels, category_labels):
+        names = [name for name, _ in METRICS]
+        if not chunks:
+            empty = {name: np.zeros(0, dtype=np.float64 if name == 'duration' else np.int64) for name in names}
+            return cls(np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int16), np.zeros(0, dtype=np.int16),
+                       empty, {name: np.zeros(0, dtype=bool) for name in names},
+                       country_labels, category_labels)
+
+        days = np.concatenate([chunk[0] for chunk in chunks])
+        order = np.argsort(days, kind='stable')
+        return cls(
+            days[order],
+            np.concatenate([chunk[1] for chunk in chunks])[order],
+            np.concatenate([chunk[2] for chunk in chunks])[order],
+            {name: np.concatenate([chunk[3][name] for chunk in chunks])[order] for name in names},
+            {name: np.concatenate([chunk[4][name] for chunk in chunks])[order] for name in names},
+            country_labels, category_labels
+        )
+
+    # -------------------------------
+    # Group-by kernels
+    # -------------------------------
+
+    def select(self, country=None, categories=None, between=None):
+        """Rows matching the filters: a slice of the day range, narrowed by a mask if needed"""
+        lo, hi = 0, len(self)
+        if between is not None:
+            start, end = (day.toordinal() - EPOCH for day in between)
+            dated = self.days[:self.dated_rows]
+            lo = int(np.searchsorted(dated, start, side='left'))
+            hi = int(np.searchsorted(dated, end, side='right'))
+
+        mask = None
+        if country is not None:
+            code = self.country_index.get(country)
+            if code is None:
+                return np.zeros(0, dtype=np.intp)
+            mask = self.countries[lo:hi] == code
+        if categories is not None:
+            codes = [self.category_index[c] for c in categories if c in self.category_index]
+            in_categories = np.isin(self.categories[lo:hi], codes)
+            mask = in_categories if mask is None else mask & in_categories
+
+        if mask is None:
+            return slice(lo, hi)
+        return np.flatnonzero(mask) + lo
+
+    def key_codes(self, name, rows):
+        """(int64 codes, cardinality, decode) for one group key over the selected rows"""
+        if name == 'country':
+            labels = self.country_labels
+            return self.countries[rows].astype(np.int64), len(labels), labels.__getitem__
+        if name == 'category':
+            labels = self.category_labels
+            return self.categories[rows].astype(np.int64), len(labels), labels.__getitem__
+        if name == 'month':
+            # 0 is NULL, then 1, 2, ... from the first month in the data
+            codes = np.where(self.months[rows] < 0, 0, self.months[rows] - self.first_month + 1)
+            return codes.astype(np.int64), self.month_count + 1, self.decode_month
+        raise ValueError(f"Unknown group key: {name}")
+
+    def decode_month(self, code):
+        if code == 0:
+            return None
+        months = self.first_month + code - 1
+        return date(1970 + months // 12, months % 12 + 1, 1)
+
+    def group_ids(self, keys, rows):
+        """Compact group id per selected row, plus the decoded key tuple of each group"""
+        size = len(self.days[rows])
+        combined = np.zeros(size, dtype=np.int64)
+        decoders = []
+        for name in keys:
+            codes, cardinality, decode = self.key_codes(name, rows)
+            combined = combined * cardinality + codes
+            decoders.append((cardinality, decode))
+
+        unique, inverse = np.unique(combined, return_inverse=True)
+        group_keys = []
+        for value in unique.tolist():
+            key = []
+            for cardinality, decode in reversed(decoders):
+                value, code = divmod(value, cardinality)
+                key.append(decode(code))
+            group_keys.append(tuple(reversed(key)))
+        return inverse, group_keys
+
+    def column_sums(self, column, groups, rows, count):
+        """Per-group values of one rollup column, typed the way the rollup returns them"""
+        kind, _, metric = column.partition('_')
+
+        if column == 'video_count':
+            return [Decimal(int(n)) for n in np.bincount(groups, minlength=count)]
+
+        if column == 'cnt_duration':
+            counts = np.bincount(groups, weights=self.valid['duration'][rows], minlength=count)
+            return [Decimal(int(n)) for n in counts]
+
+        if kind == 'sum':
+            counts = np.bincount(groups, weights=self.valid[metric][rows], minlength=count)
+            if metric == 'duration':
+                sums = np.bincount(groups, weights=self.values[metric][rows], minlength=count)
+                return [Decimal(repr(float(s))) if n else None for s, n in zip(sums, counts)]
+            values = self.values[metric][rows]
+            low = np.bincount(groups, weights=values & _LOW_MASK, minlength=count)
+            high = np.bincount(groups, weights=values >> _LOW_BITS, minlength=count)
+            return [
+                Decimal((int(h) << _LOW_BITS) + int(l)) if n else None
+                for h, l, n in zip(high, low, counts)
+            ]
+
+        if kind == 'pw':
+            stat, a, b = metric.split('_')
+            both = self.valid[a][rows] & self.valid[b][rows]
+            if stat == 'n':
+                return [int(n) for n in np.bincount(groups, weights=both, minlength=count)]
+            x = np.where(both, self.floats[a][rows], 0.0)
+            if stat == 's':
+                weights = x
+            elif stat == 'q':
+                weights = x * x
+            else:
+                weights = x * np.where(both, self.floats[b][rows], 0.0)
+            return np.bincount(groups, weights=weights, minlength=count).tolist()
+
+        raise ValueError(f"Unknown rollup column: {column}")
+
+    def group(self, keys, fields, country=None, categories=None, between=None):
+        """Same contract as dashboard.RowsSource.group, computed from the raw rows"""
+        rows = self.select(country, categories, between)
+        groups, group_keys = self.group_ids(keys, rows)
+        columns = [self.column_sums(column, groups, rows, len(group_keys)) for column in fields.values()]
+
+        Group = namedtuple('Group', list(keys) + list(fields))
+        return [Group(*key, *values) for key, *values in zip(group_keys, *columns)]
+
+
+# -------------------------------
+# Reloading on new data
+# -------------------------------
+
+class ColumnarStore:
+    """
+    Holds the current engine and reloads it when the data version stamped by
+    createDB.py changes. While a reload runs, other requests keep answering
+    from the previous copy.
+    """
+
+    def __init__(self, loader, version_source, check_seconds=5.0):
+        self.loader = loader
+        self.version_source = version_source
+        self.check_seconds = check_seconds
+        self.engine = None
+        self.version = None
+        self.load_seconds = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    def get(self):
+        now = time.monotonic()
+        if self.engine is not None and now - self._checked < self.check_seconds:
+            return self.engine
+
+        self._checked = now
+        try:
+            version = str(self.version_source())
+        except Exception as e:
+            logger.warning(f"Reading the data version failed: {e}")
+            # Not a new version: keep answering from the loaded copy. A
+            # first load goes ahead, and the next successful read reloads
+            if self.engine is not None:
+                return self.engine
+            version = None
+        if self.engine is not None and version == self.version:
+            return self.engine
+
+        # The first load waits; later reloads are done by one request at a time
+        if self._lock.acquire(blocking=self.engine is None):
+            try:
+                if self.engine is None or version != self.version:
+                    started = time.perf_counter()
+                    self.engine = self.loader()
+                    self.version = version
+                    self.load_seconds = round(time.perf_counter() - started, 3)
+            finally:
+                self._lock.release()
+        return self.engine
+
+    def stats(self):
+        return {
+            'rows': len(self.engine) if self.engine is not None else 0,
+            'data_version': self.version,
+            'load_seconds': self.load_seconds
+        }
@@ -0,0 +1,100 @@
+import numpy as np
+from collections import namedtuple
+from itertools import combinations
+
+from CreatePSQL_db.rollups import METRIC_PAIRS, stat_columns
+
+# -------------------------------
+# Pearson correlation from sufficient statistics
+# -------------------------------
+
+# Axis order of the correlation matrix; also the order of the pair keys in
+# the /corr_mat response ("likes_views", "likes_dislikes", ...).
+CORR_COLUMNS = ['likes', 'views', 'dislikes', 'comments', 'duration']
+PAIR_KEYS = [f'{a}_{b}' for a, b in combinations(CORR_COLUMNS, 2)]
+
+_AXIS = {name: i for i, name in enumerate(CORR_COLUMNS)}
+
+# Variances this small relative to the raw sum of squares are rounding noise
+# of a constant column; CORR() returns NULL for those.
+_ZERO_VARIANCE = 1e-12
+
+# Pairwise statistics, each of shape (..., 5, 5). For i != j:
+#   n[i, j]        rows where metrics i and j are both non-null
+#   sums[i, j]     sum of metric i over those rows
+#   squares[i, j]  sum of metric i squared over those rows
+#   products[i, j] sum of metric i times metric j
+# n and products are symmetric; the diagonals are unused.
+CorrStats = namedtuple('CorrStats', ['n', 'sums', 'squares', 'products'])
+
+
+def stats_from_rows(rows):
+    """Stack rollup rows (anything with the pw_* attributes) into CorrStats of k groups."""
+    dim = len(CORR_COLUMNS)
+    stats = CorrStats(*(np.zeros((len(rows), dim, dim)) for _ in CorrStats._fields))
+
+    for r, row in enumerate(rows):
+        for a, b in METRIC_PAIRS:
+            i, j = _AXIS[a], _AXIS[b]
+            stats.n[r, i, j] = stats.n[r, j, i] = float(getattr(row, f'pw_n_{a}_{b}') or 0)
+            stats.sums[r, i, j] = getattr(row, f'pw_s_{a}_{b}') or 0.0
+            stats.sums[r, j, i] = getattr(row, f'pw_s_{b}_{a}') or 0.0
+            stats.squares[r, i, j] = getattr(row, f'pw_q_{a}_{b}') or 0.0
+            stats.squares[r, j, i] = getattr(row, f'pw_q_{b}_{a}') or 0.0
+            stats.products[r, i, j] = stats.products[r, j, i] = getattr(row, f'pw_p_{a}_{b}') or 0.0
+
+    return stats
+
+
+def combine(stats, mask=None):
+    """Merge groups of statistics (optionally only those selected by mask)."""
+    if mask is not None:
+        stats = CorrStats(*(field[mask] for field in stats))
+    return CorrStats(*(field.sum(axis=0) for field in stats))
+
+
+def append_total(stats):
+    """Add the merge of all groups as one extra trailing group."""
+    total = combine(stats)
+    return CorrStats(*(
+        np.concatenate([field, total_field[None]])
+        for field, total_field in zip(stats, total)
+    ))
+
+
+def pearson(stats):
+    """
+    Correlation matrices for one or more groups of statistics. Entries that
+    CORR() would leave NULL (no rows, or a constant column) are 0; the
+    diagonal is 1.
+    """
+    n, sums, squares, products = (np.asarray(field, dtype=float) for field in stats)
+    sums_t = np.swapaxes(sums, -1, -2)
+    squares_t = np.swapaxes(squares, -1, -2)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cov = products - sums * sums_t / n
+        var = squares - sums * sums / n
+        var_t = squares_t - sums_t * sums_t / n
+        var[~(var > _ZERO_VARIANCE * squares)] = 0.0
+        var_t[~(var_t > _ZERO_VARIANCE * squares_t)] = 0.0
+        denom = np.sqrt(var * var_t)
+        corr = cov / denom
+
+    corr[~(denom > 0) | ~(n > 0)] = 0.0
+    idx = np.arange(len(CORR_COLUMNS))
+    corr[..., idx, idx] = 1.0
+    return corr
+
+
+def pair_values(matrix):
+    """Flatten a single 5x5 matrix into the {"likes_views": ...} response keys."""
+    return {
+        key: float(matrix[i, j])
+        for key, (i, j) in zip(PAIR_KEYS, combinations(range(len(CORR_COLUMNS)), 2))
+    }
+
+
+def stats_select_columns():
+    """SQL select list summing the monthly statistics of a group."""
+    return ',\n'.join(f'SUM({col}) AS {col}' for col in stat_columns())
@@ -0,0 +1,264 @@
+import logging
+from collections import namedtuple
+
+from sqlalchemy import text
+
+from corr_engine import stats_select_columns
+from CreatePSQL_db.rollups import stat_columns
+from endpoints import CHARTS, EndpointError, convert_to_full_dates, month_labels, parse_categories
+from timeseries import bucket_starts, densify
+
+# -------------------------------
+# /dashboard: several charts from one aggregate read
+# -------------------------------
+# The chart panels are all sums over (month, country, category), so one
+# grouped read of yt_daily at that grain serves every one of them; each panel
+# then filters and re-groups that small result in Python and hands it to the
+# chart's own shaper. A panel answers exactly what its endpoint would for
+# the same query args. word_cloud reads yt_tag_monthly, so it needs a second
+# query.
+
+logger = logging.getLogger(__name__)
+
+AGGREGATE_COLUMNS = [
+    'video_count', 'sum_views', 'sum_likes', 'sum_comments',
+    'sum_dislikes', 'sum_duration', 'cnt_duration'
+]
+
+
+def aggregate_query(args, with_stats=False):
+    """(month, country, category) sums over the dashboard's date range"""
+    select = [
+        "DATE_TRUNC('month', day)::date AS month",
+        'country',
+        'category',
+    ]
+    select += [f'SUM({col}) AS {col}' for col in AGGREGATE_COLUMNS]
+    if with_stats:
+        # The daily rollup carries the correlation statistics too
+        select.append(stats_select_columns())
+
+    sql = "SELECT\n    " + ',\n    '.join(select) + "\nFROM yt_daily\n"
+    params = {}
+    start_mon = args.get('startDate')
+    end_mon = args.get('endDate')
+    if start_mon and end_mon:
+        start_date, end_date = convert_to_full_dates(start_mon, end_mon)
+        sql += "WHERE day BETWEEN :start_date AND :end_date\n"
+        params = {'start_date': start_date, 'end_date': end_date}
+    sql += "GROUP BY DATE_TRUNC('month', day), country, category"
+    return text(sql), params
+
+
+def sql_sum(a, b):
+    """SUM() semantics: NULLs are skipped, all-NULL stays NULL"""
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return a + b
+
+def nulls_last(value):
+    return (value is None, value)
+
+
+class RowsSource:
+    """
+    The aggregate read as a panel data source. `group` is a SUM ... GROUP BY
+    over those rows; columnar_engine.ColumnarEngine offers the same call.
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def group(self, keys, fields, country=None, categories=None, between=None):
+        """
+        Sum `fields` (output name -> aggregate column) grouped by `keys`,
+        over rows matching every filter given: country equal to `country`,
+        category in `categories`, month within the `between` date pair.
+        Returns namedtuples of keys + fields.
+        """
+        groups = {}
+        for row in self.rows:
+            if country is not None and row.country != country:
+                continue
+            if categories is not None and row.category not in categories:
+                continue
+            if between is not None and (row.month is None or not between[0] <= row.month <= between[1]):
+                continue
+            key = tuple(getattr(row, name) for name in keys)
+            values = [getattr(row, column) for column in fields.values()]
+            total = groups.get(key)
+            groups[key] = values if total is None else list(map(sql_sum, total, values))
+
+        Group = namedtuple('Group', list(keys) + list(fields))
+        return [Group(*key, *values) for key, values in groups.items()]
+
+
+def in_months(args):
+    """(first day, last day) of the startDate/endDate range; None unless both are set"""
+    start_mon = args.get('startDate')
+    end_mon = args.get('endDate')
+    if not (start_mon and end_mon):
+        return None
+    return convert_to_full_dates(start_mon, end_mon)
+
+
+# -------------------------------
+# Panels (same parameters and defaults as the endpoints)
+# -------------------------------
+# Each takes a source (RowsSource or a ColumnarEngine) and the request args.
+
+def bar_chart_panel(source, args):
+    country = args.get('country')
+    if not country or country == "ALL":
+        country = None
+
+    results = source.group(['category'], {
+        'total_likes': 'sum_likes',
+        'total_views': 'sum_views',
+        'total_comments': 'sum_comments',
+        'total_dislikes': 'sum_dislikes',
+        'video_count': 'video_count'
+    }, country=country, between=in_months(args))
+    return CHARTS['bar_chart'].shape(results, None)
+
+
+RadarRow = namedtuple('RadarRow', ['category', 'likes', 'views', 'comments', 'dislikes', 'avg_duration'])
+
+def radar_chart_panel(source, args):
+    categories = parse_categories(args) or None
+
+    groups = source.group(['category'], {
+        'likes': 'sum_likes',
+        'views': 'sum_views',
+        'comments': 'sum_comments',
+        'dislikes': 'sum_dislikes',
+        'sum_duration': 'sum_duration',
+        'cnt_duration': 'cnt_duration'
+    }, categories=categories, between=in_months(args))
+
+    results = [
+        RadarRow(g.category, g.likes, g.views, g.comments, g.dislikes,
+                 g.sum_duration / g.cnt_duration
+                 if g.sum_duration is not None and g.cnt_duration else None)
+        for g in groups
+    ]
+    return CHARTS['radar_chart'].shape(results, None)
+
+
+def world_map_panel(source, args):
+    metric = args.get('metric', 'likes').lower()
+    if metric not in ('likes', 'dislikes', 'views', 'comments'):
+        raise EndpointError("Invalid metric")
+
+    results = source.group(['country', 'category'], {'total': f'sum_{metric}'},
+                           between=in_months(args))
+    return CHARTS['world_map'].shape(results, None)
+
+
+def corr_mat_panel(source, args):
+    country = args.get('country', 'US')
+    categories = parse_categories(args) or None
+
+    results = source.group(['category'], {col: col for col in stat_columns()},
+                           country=None if country == 'ALL' else country,
+                           categories=categories, between=in_months(args))
+    results.sort(key=lambda row: nulls_last(row.category))
+    return CHARTS['corr_mat'].shape(results, None)
+
+
+def month_cat_panel(source, args):
+    metric = args.get('metric', 'likes').lower()
+    country = args.get('country', 'ALL').upper()
+    if metric not in ('likes', 'views', 'comments', 'dislikes'):
+        raise EndpointError("Invalid metric")
+
+    start_date, end_date = convert_to_full_dates(args.get('startDate'), args.get('endDate'))
+
+    results = source.group(['category', 'month'],
+                           {'total': f'sum_{metric}', 'video_count': 'video_count'},
+                           country=None if country == 'ALL' else country,
+                           between=(start_date, end_date))
+    results.sort(key=lambda row: (row.month, nulls_last(row.category)))
+    series = densify(results, 'category', 'month', ['total', 'video_count'],
+                     bucket_starts(start_date, end_date, 'month'))
+    return CHARTS['month_cat'].shape(series, month_labels(start_date, end_date))
+
+
+def temp_panel(source, args):
+    start_date, end_date = convert_to_full_dates(
+        args.get('startDate', "2017-01"), args.get('endDate', "2021-12")
+    )
+    results = source.group(['month'], {'total': 'video_count'}, between=(start_date, end_date))
+    series = densify(results, None, 'month', ['total'], bucket_starts(start_date, end_date, 'month'))
+    return CHARTS['temp'].shape(series, month_labels(start_date, end_date))
+
+
+AGGREGATE_PANELS = {
+    'bar_chart': bar_chart_panel,
+    'radar_chart': radar_chart_panel,
+    'world_map': world_map_panel,
+    'corr_mat': corr_mat_panel,
+    'month_cat': month_cat_panel,
+    'temp': temp_panel,
+}
+PANELS = list(AGGREGATE_PANELS) + ['word_cloud']
+
+
+# -------------------------------
+# Request handling
+# -------------------------------
+
+def requested_panels(args):
+    """`panels=bar_chart,world_map,...`; every panel when absent"""
+    panels_param = args.get('panels')
+    if not panels_param:
+        return list(PANELS)
+    panels = [name.strip() for name in panels_param.split(',') if name.strip()]
+    unknown = [name for name in panels if name not in PANELS]
+    if unknown:
+        raise EndpointError(f"Unknown panel(s): {', '.join(unknown)}. Choose from {', '.join(PANELS)}")
+    return list(dict.fromkeys(panels))
+
+
+def dashboard_queries(args, source=None):
+    """
+    The requested panels and the (at most two) queries they need, keyed by
+    name. With a `source` (the in-memory engine) the aggregate read is skipped.
+    """
+    panels = requested_panels(args)
+    queries = {}
+    if source is None and any(name in AGGREGATE_PANELS for name in panels):
+        queries['aggregate'] = aggregate_query(args, with_stats='corr_mat' in panels)
+    if 'word_cloud' in panels:
+        query = CHARTS['word_cloud'].build(args)
+        queries['word_cloud'] = (query.statement, query.params)
+    return panels, queries
+
+
+def dashboard_shape(panels, results, args, source=None):
+    """
+    Shape every panel from the query results (or `source`). A failing panel
+    gets the error its endpoint would have returned; the other panels are
+    unaffected.
+    """
+    if source is None and 'aggregate' in results:
+        source = RowsSource(results['aggregate'])
+    response = {}
+    for name in panels:
+        try:
+            if name == 'word_cloud':
+                context = CHARTS['word_cloud'].build(args).context
+                response[name] = CHARTS['word_cloud'].shape(results['word_cloud'], context)
+            else:
+                response[name] = AGGREGATE_PANELS[name](source, args)
+        except EndpointError as e:
+            response[name] = {"error": str(e)}
+        except Exception as e:
+            logger.error(f"Dashboard {CHARTS[name].log_label} error: {str(e)}")
+            response[name] = {
+                "error": CHARTS[name].error_message,
+                "details": str(e)
+            }
+    return response
@@ -0,0 +1,228 @@
+import hashlib
+import itertools
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+
+from sqlalchemy import event
+from sqlalchemy.exc import DBAPIError
+
+from config import Config
+from endpoints import DATA_VERSION_SQL
+from metrics import phase
+
+logger = logging.getLogger(__name__)
+
+# -------------------------------
+# Connection pools, read replicas and prepared statements
+# -------------------------------
+# Chart reads go to the replicas in DATABASE_REPLICA_URLS in turn, and to
+# the primary when none is usable. A replica that cannot be reached is left
+# out for REPLICA_RETRY_SECONDS; one whose data version (yt_meta, stamped by
+# createDB.py) differs from the primary's is left out until it catches up,
+# so a cache keyed by the primary's version never stores a lagging answer.
+#
+# On psycopg2, which only has client-side parameters, each distinct chart
+# SQL is PREPAREd once per connection and then EXECUTEd, so Postgres parses
+# and analyses it once rather than on every request; PLAN_CACHE_MODE decides
+# whether the plan is reused too. asyncpg (asgi_app.py) prepares and caches
+# statements itself.
+
+
+def engine_options(pool_size=None, max_overflow=None, asyncpg=False):
+    """create_engine pool and connection arguments from Config"""
+    # Set when the session starts, so no transaction rollback undoes it
+    if asyncpg:
+        connect_args = {'server_settings': {'plan_cache_mode': Config.PLAN_CACHE_MODE}}
+    else:
+        connect_args = {'options': f'-c plan_cache_mode={Config.PLAN_CACHE_MODE}'}
+    return {
+        'pool_size': Config.DB_POOL_SIZE if pool_size is None else pool_size,
+        'max_overflow': Config.DB_MAX_OVERFLOW if max_overflow is None else max_overflow,
+        'pool_timeout': Config.DB_POOL_TIMEOUT,
+        'pool_recycle': Config.DB_POOL_RECYCLE,
+        'pool_pre_ping': Config.DB_POOL_PRE_PING,
+        'connect_args': connect_args,
+    }
+
+
+class ReplicaSet:
+    """
+    Health of the read replicas. candidates() gives the order to try the
+    engines in (usable replicas round robin, then the primary); callers
+    report back with failed(), in_sync() and used().
+    """
+
+    def __init__(self, primary, replicas, retry_seconds=30.0, check_seconds=5.0):
+        self.primary = primary
+        # [(name, engine)]
+        self.replicas = replicas
+        self.retry_seconds = retry_seconds
+        self.check_seconds = check_seconds
+        self._down = {}
+        self._checked = {}
+        self._turn = itertools.count()
+        self._lock = threading.Lock()
+        self._stats = {name: {'reads': 0, 'failures': 0, 'stale': 0} for name in self.names()}
+
+    def names(self):
+        return [name for name, _ in self.replicas] + ['primary']
+
+    def candidates(self):
+        now = time.monotonic()
+        with self._lock:
+            usable = [(name, engine) for name, engine in self.replicas if self._down.get(name, 0) <= now]
+        if usable:
+            start = next(self._turn) % len(usable)
+            usable = usable[start:] + usable[:start]
+        return usable + [('primary', self.primary)]
+
+    def needs_check(self, name):
+        """Whether `name`'s data version is due to be compared with the primary's"""
+        if name == 'primary':
+            return False
+        with self._lock:
+            return time.monotonic() - self._checked.get(name, float('-inf')) >= self.check_seconds
+
+    def in_sync(self, name, version, primary_version):
+        """Record `name`'s data version; a lagging replica sits out until its next check"""
+        now = time.monotonic()
+        with self._lock:
+            self._checked[name] = now
+            if str(version or '0') == str(primary_version):
+                self._down.pop(name, None)
+                return True
+            self._down[name] = now + self.check_seconds
+            self._stats[name]['stale'] += 1
+        logger.warning(f"Replica {name} is at data version {version}, primary at {primary_version}")
+        return False
+
+    def failed(self, name, error):
+        with self._lock:
+            self._stats[name]['failures'] += 1
+            if name != 'primary':
+                self._down[name] = time.monotonic() + self.retry_seconds
+        logger.error(f"Database {name} unavailable: {error}")
+
+    def used(self, name):
+        with self._lock:
+            self._stats[name]['reads'] += 1
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            return {
+                name: dict(self._stats[name], usable=self._down.get(name, 0) <= now)
+                for name in self.names()
+            }
+
+
+def replica_set(primary, replica_urls, make_engine):
+    """
+    ReplicaSet over `primary` and an engine per replica URL (named replica0,
+    replica1, ...), all preparing the chart statements
+    """
+    return ReplicaSet(
+        prepare_statements(primary),
+        [(f'replica{i}', prepare_statements(make_engine(url))) for i, url in enumerate(replica_urls)],
+        retry_seconds=Config.REPLICA_RETRY_SECONDS,
+        check_seconds=Config.DATA_VERSION_CHECK_SECONDS
+    )
+
+
+# %(name)s parameters of the SQL psycopg2 is about to run
+PLACEHOLDER = re.compile(r'%\((\w+)\)s')
+
+@lru_cache(maxsize=1024)
+def prepared_form(sql):
+    """(statement name, PREPARE body, parameter names in $n order) for `sql`"""
+    names = []
+
+    def placeholder(match):
+        if match.group(1) not in names:
+            names.append(match.group(1))
+        return f'${names.index(match.group(1)) + 1}'
+
+    # The %% psycopg2 needed for a literal % is not wanted without parameters
+    body = PLACEHOLDER.sub(placeholder, sql).replace('%%', '%')
+    return 'yt_' + hashlib.sha1(body.encode()).hexdigest()[:20], body, tuple(names)
+
+
+def execute_prepared(conn, cursor, statement, parameters, context, executemany):
+    """
+    before_cursor_execute hook: statements run with the `prepare` execution
+    option become EXECUTE of a statement PREPAREd once per connection
+    """
+    if executemany or not context.execution_options.get('prepare') \
+            or not isinstance(parameters, dict) or Config.PREPARED_STATEMENT_CACHE_SIZE <= 0:
+        return statement, parameters
+    name, body, names = prepared_form(statement)
+
+    # Statements this DBAPI connection has prepared, oldest use first
+    prepared = conn.connection.info.setdefault('prepared_statements', OrderedDict())
+    if name in prepared:
+        prepared.move_to_end(name)
+    else:
+        # Without parameters, psycopg2 sends the body as it is
+        if len(prepared) >= Config.PREPARED_STATEMENT_CACHE_SIZE:
+            oldest, _ = prepared.popitem(last=False)
+            cursor.execute(f'DEALLOCATE {oldest}')
+        cursor.execute(f'PREPARE {name} AS {body}')
+        prepared[name] = True
+
+    if not names:
+        return f'EXECUTE {name}', parameters
+    return f"EXECUTE {name} ({', '.join(f'%({n})s' for n in names)})", parameters
+
+
+def prepare_statements(engine):
+    """Have `engine` prepare the statements run with execution_options(prepare=True)"""
+    if engine.dialect.driver == 'psycopg2':
+        event.listen(engine, 'before_cursor_execute', execute_prepared, retval=True)
+    elif Config.PREPARED_STATEMENT_CACHE_SIZE > 0:
+        # asyncpg engines (asgi_app.py) do not come through here
+        logger.warning(
+            f"Chart statements are not prepared on the {engine.dialect.driver} driver; "
+            "use a postgresql+psycopg2:// URL to prepare them"
+        )
+    return engine
+
+
+def read_rows(replicas, statement, params, primary_version):
+    """
+    All rows of `statement`, from the first usable replica or else the
+    primary. `primary_version` is called for the version to compare with.
+    """
+    for name, engine in replicas.candidates():
+        try:
+            conn = engine.connect()
+        except DBAPIError as e:
+            if name == 'primary':
+                raise
+            replicas.failed(name, e)
+            continue
+        with conn:
+            try:
+                if replicas.needs_check(name):
+                    try:
+                        version = conn.execute(DATA_VERSION_SQL).scalar()
+                    except DBAPIError:
+                        conn.rollback()
+                        version = None
+                    if not replicas.in_sync(name, version, primary_version()):
+                        continue
+                with phase('db'):
+                    result = conn.execution_options(prepare=True).execute(statement, params)
+                with phase('materialize'):
+                    rows = result.fetchall()
+            except DBAPIError as e:
+                # Only a lost connection moves on; a bad query fails here too
+                if name == 'primary' or not e.connection_invalidated:
+                    raise
+                replicas.failed(name, e)
+                continue
+        replicas.used(name)
+        return rows
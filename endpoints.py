@@ -0,0 +1,866 @@
+import calendar
+import csv
+import io
+import json
+import re
+from collections import namedtuple
+from datetime import date
+
+import numpy as np
+from sqlalchemy import BigInteger, Date, Numeric, Text, bindparam, column, func, select, table, text
+
+from serializers import ColumnarRowEncoder, negotiate
+from corr_engine import stats_from_rows, append_total, pearson, pair_values, stats_select_columns
+from CreatePSQL_db.rollups import ALL, SKETCH_TOP, tag_sketch_table
+from CreatePSQL_db.tag_sketch import TagSketch
+from Project.prediction import predict_batch, validate_input
+from timeseries import GRANULARITIES, bucket_labels, bucket_starts, series_sql
+
+# -------------------------------
+# Framework-neutral chart endpoints
+# -------------------------------
+# Each chart is split into a query builder (request args -> SQL statement)
+# and a shaper (result rows -> JSON-ready data), so the Flask app and the
+# ASGI app run the same SQL and return the same JSON.
+
+class EndpointError(Exception):
+    """Bad request parameters; served as 400 {"error": message}"""
+
+
+# statement: SQLAlchemy statement; params: its bind values;
+# context: whatever the shaper needs besides the rows
+ChartQuery = namedtuple('ChartQuery', ['statement', 'params', 'context'])
+# build(args) -> ChartQuery; shape(rows, context) -> JSON-ready data
+Chart = namedtuple('Chart', ['build', 'shape', 'log_label', 'error_message'])
+
+
+DATA_VERSION_SQL = text("SELECT value FROM yt_meta WHERE key = 'data_version'")
+
+yt_daily = table(
+    'yt_daily',
+    column('day', Date),
+    column('country', Text),
+    column('category', Text),
+    column('video_count', BigInteger),
+    column('sum_views', Numeric),
+    column('sum_likes', Numeric),
+    column('sum_comments', Numeric),
+    column('sum_dislikes', Numeric),
+    column('sum_duration', Numeric),
+    column('cnt_duration', BigInteger),
+)
+
+
+def convert_to_full_dates(start_date, end_date):
+    start_year, start_month = map(int, start_date.split('-'))
+    end_year, end_month = map(int, end_date.split('-'))
+
+    start_full = date(start_year, start_month, 1)
+    last_day = calendar.monthrange(end_year, end_month)[1]
+    end_full = date(end_year, end_month, last_day)
+    return start_full, end_full
+
+def add_dates_filter_to_query(query, start_mon, end_mon, column):
+    if start_mon and end_mon:
+        # Parse YYY-MM input to date objects
+        start_date,end_date=convert_to_full_dates(start_mon, end_mon)
+        return query.where(column.between(start_date, end_date))
+    return query
+
+def month_labels(start_date, end_date):
+    """'YYYY-MM' for every month from start_date to end_date, inclusive"""
+    return bucket_labels(start_date, end_date, 'month')
+
+def parse_categories(args):
+    categories_param = args.get('categories', '[]')
+    try:
+        return json.loads(categories_param)
+    except json.JSONDecodeError:
+        return []
+
+
+# -------------------------------
+# /test
+# -------------------------------
+
+TEST_ROWS_SQL = text("""
+SELECT "ID", title, category, "#views" AS views, "#comments" AS comments,
+       "#likes" AS likes, "#dislikes" AS dislikes, "timestamp", duration,
+       description, tags, country
+FROM yt
+LIMIT 10
+""")
+
+def video_row(item):
+    return {
+        "ID": item.ID,
+        "title": item.title,
+        "category": item.category,
+        "views": item.views,
+        "comments": item.comments,
+        "likes": item.likes,
+        "dislikes": item.dislikes,
+        "timestamp": item.timestamp.isoformat() if item.timestamp else None,
+        "duration": item.duration,
+        "description": item.description,
+        "tags": item.tags,
+        "country": item.country
+    }
+
+
+# -------------------------------
+# /rows
+# -------------------------------
+
+# Output name -> yt column, in default output order
+ROW_COLUMNS = {
+    'ID': '"ID"',
+    'title': 'title',
+    'category': 'category',
+    'views': '"#views"',
+    'comments': '"#comments"',
+    'likes': '"#likes"',
+    'dislikes': '"#dislikes"',
+    'timestamp': '"timestamp"',
+    'duration': 'duration',
+    'description': 'description',
+    'tags': 'tags',
+    'country': 'country',
+}
+# Keyset order; a video appears once per (day, country), so ID alone does
+# not make the key unique. Matches the row_key index on yt.
+ROW_KEY = ['timestamp', 'ID', 'country']
+ROWS_BATCH = 5000
+ROW_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+    'arrow': 'application/vnd.apache.arrow.stream',
+    'parquet': 'application/vnd.apache.parquet',
+}
+# Arrow type of each column for the arrow/parquet formats
+ROW_ARROW_TYPES = {
+    'ID': 'string',
+    'title': 'string',
+    'category': 'string',
+    'views': 'int64',
+    'comments': 'int64',
+    'likes': 'int64',
+    'dislikes': 'int64',
+    'timestamp': 'date32',
+    'duration': 'float64',
+    'description': 'string',
+    'tags': 'string',
+    'country': 'string',
+}
+
+# statement/params: the query; columns: output names; format: key of ROW_FORMATS
+RowsExport = namedtuple('RowsExport', ['statement', 'params', 'columns', 'format'])
+
+
+def rows_query(args, accept=None):
+    """
+    Filtered, projected yt rows. `columns` picks output columns; `limit`
+    and `after` (the JSON list [timestamp, ID, country] of the last row
+    seen) page through the rows in key order, and then always include the
+    key columns. Without `format`, an Accept header asking for Arrow or
+    Parquet picks that, otherwise NDJSON.
+    """
+    fmt = (args.get('format') or '').lower()
+    if not fmt:
+        fmt = negotiate(None, accept)
+        fmt = fmt if fmt in ROW_FORMATS else 'ndjson'
+    if fmt not in ROW_FORMATS:
+        raise EndpointError(f"Invalid format. Use one of: {', '.join(ROW_FORMATS)}")
+
+    columns = list(ROW_COLUMNS)
+    columns_param = args.get('columns')
+    if columns_param:
+        columns = [name.strip() for name in columns_param.split(',') if name.strip()]
+        unknown = [name for name in columns if name not in ROW_COLUMNS]
+        if unknown:
+            raise EndpointError(f"Unknown column(s): {', '.join(unknown)}")
+
+    limit = args.get('limit')
+    after = args.get('after')
+    paged = bool(limit or after)
+    if paged:
+        columns += [name for name in ROW_KEY if name not in columns]
+
+    sql = "SELECT " + ', '.join(f'{ROW_COLUMNS[name]} AS "{name}"' for name in columns)
+    sql += " FROM yt WHERE TRUE"
+    params = {}
+
+    # Same filters as the charts
+    country = args.get('country')
+    if country and country != 'ALL':
+        sql += " AND country = :country"
+        params['country'] = country
+    categories = parse_categories(args)
+    if args.get('category'):
+        categories = [args.get('category')]
+    if categories:
+        sql += " AND category IN :categories"
+        params['categories'] = list(categories)
+    start_mon = args.get('startDate')
+    end_mon = args.get('endDate')
+    if start_mon and end_mon:
+        start_date, end_date = convert_to_full_dates(start_mon, end_mon)
+        sql += ' AND "timestamp" BETWEEN :start_date AND :end_date'
+        params['start_date'] = start_date
+        params['end_date'] = end_date
+
+    if after:
+        try:
+            after_timestamp, after_id, after_country = json.loads(after)
+            if after_timestamp is not None:
+                after_timestamp = date.fromisoformat(after_timestamp[:10])
+        except (ValueError, TypeError):
+            raise EndpointError('Invalid after. Use ["YYYY-MM-DD", "<ID>", "<country>"] from the last row')
+        params.update(after_id=after_id, after_country=after_country)
+        # NULL timestamps sort last
+        if after_timestamp is None:
+            sql += ' AND "timestamp" IS NULL AND ("ID", country) > (:after_id, :after_country)'
+        else:
+            sql += (' AND (("timestamp", "ID", country) > (:after_timestamp, :after_id, :after_country)'
+                    ' OR "timestamp" IS NULL)')
+            params['after_timestamp'] = after_timestamp
+
+    if paged:
+        sql += ' ORDER BY "timestamp", "ID", country'
+    if limit:
+        try:
+            params['limit'] = int(limit)
+        except ValueError:
+            raise EndpointError("Invalid limit")
+        sql += " LIMIT :limit"
+
+    stmt = text(sql)
+    if categories:
+        stmt = stmt.bindparams(bindparam('categories', expanding=True))
+    return RowsExport(stmt, params, columns, fmt)
+
+
+def export_value(value):
+    return value.isoformat() if isinstance(value, date) else value
+
+class TextRowEncoder:
+    """NDJSON or CSV chunks; same header() / batch(rows) / footer() calls as ColumnarRowEncoder"""
+
+    def __init__(self, fmt, columns):
+        self.fmt = fmt
+        self.columns = columns
+
+    def header(self):
+        # The CSV header line
+        return self.batch([self.columns]) if self.fmt == 'csv' else ''
+
+    def batch(self, rows):
+        if self.fmt == 'csv':
+            out = io.StringIO()
+            csv.writer(out).writerows(rows)
+            return out.getvalue()
+        return ''.join(
+            json.dumps(dict(zip(self.columns, map(export_value, row)))) + '\n'
+            for row in rows
+        )
+
+    def footer(self):
+        return ''
+
+def row_encoder(export):
+    if export.format in ('arrow', 'parquet'):
+        return ColumnarRowEncoder(export.format, export.columns, ROW_ARROW_TYPES)
+    return TextRowEncoder(export.format, export.columns)
+
+
+# -------------------------------
+# /word_cloud
+# -------------------------------
+
+MAX_WORDS = 150
+MIN_OCCURRENCE = 3
+
+def word_cloud_query(args):
+    if args.get('approx') == '1':
+        return word_cloud_sketch_query(args)
+
+    country = args.get('country')
+    category = args.get('category')
+    start_date = args.get('startDate')
+    end_date = args.get('endDate')
+
+    # Sum the pre-counted (tag, month, country, category) frequencies;
+    # tags are already split and cleaned at load time
+    sql = """
+    SELECT tag AS cleaned_tag, SUM(count) AS count
+    FROM yt_tag_monthly
+    WHERE TRUE
+    """
+    params = {
+        'min_occurrence': MIN_OCCURRENCE,
+        'max_words': MAX_WORDS
+    }
+
+    # Apply filters
+    if country:
+        sql += " AND country = :country"
+        params['country'] = country
+    if category:
+        sql += " AND category = :category"
+        params['category'] = category
+
+    if start_date and end_date:
+        # Convert to date objects
+        start_full, end_full = convert_to_full_dates(start_date, end_date)
+
+        sql += " AND month BETWEEN :start_date AND :end_date"
+        params['start_date'] = start_full
+        params['end_date'] = end_full
+
+    sql += """
+    GROUP BY tag
+    HAVING SUM(count) >= :min_occurrence
+    ORDER BY count DESC, tag
+    LIMIT :max_words
+    """
+    return ChartQuery(text(sql), params, None)
+
+def word_cloud_shape(results, context):
+    if context == APPROX:
+        return approx_word_cloud_shape(results)
+    return [{"text": row.cleaned_tag, "value": int(row.count)}
+            for row in results if row.cleaned_tag]
+
+
+# approx=1: merge the per-month tag sketches the rollups keep (see
+# CreatePSQL_db/rollups.py) instead of summing the exact counts. A missing
+# country or category reads the '*' sketches, so at most one sketch per
+# month is merged whatever the filters.
+APPROX = 'approx'
+
+def word_cloud_sketch_query(args):
+    start_date = args.get('startDate')
+    end_date = args.get('endDate')
+
+    sql = f"SELECT sketch FROM {tag_sketch_table} WHERE country = :country AND category = :category"
+    params = {
+        'country': args.get('country') or ALL,
+        'category': args.get('category') or ALL
+    }
+    if start_date and end_date:
+        start_full, end_full = convert_to_full_dates(start_date, end_date)
+        sql += " AND month BETWEEN :start_date AND :end_date"
+        params['start_date'] = start_full
+        params['end_date'] = end_full
+    return ChartQuery(text(sql), params, APPROX)
+
+def approx_word_cloud_shape(results):
+    """
+    Words with their estimated count and how much it may exceed the true
+    one (`error`), plus the bounds of the merged sketch under "approx"
+    """
+    sketches = [TagSketch.from_bytes(row.sketch) for row in results]
+    if not sketches:
+        return {"words": [], "approx": {"sketches": 0, "occurrences": 0}}
+    merged = TagSketch.merge(sketches, SKETCH_TOP)
+    words = [
+        {"text": tag, "value": value, "error": value - lower}
+        for tag, value, lower in merged.heavy_hitters(MAX_WORDS, MIN_OCCURRENCE)
+    ]
+    return {"words": words, "approx": dict(merged.bounds(), sketches=len(sketches))}
+
+
+# -------------------------------
+# /bar_chart
+# -------------------------------
+
+def bar_chart_query(args):
+    country = args.get('country')
+    start_date = args.get('startDate')
+    end_date = args.get('endDate')
+
+    # Base query
+    query = select(
+        yt_daily.c.category,
+        func.sum(yt_daily.c.sum_likes).label('total_likes'),
+        func.sum(yt_daily.c.sum_views).label('total_views'),
+        func.sum(yt_daily.c.sum_comments).label('total_comments'),
+        func.sum(yt_daily.c.sum_dislikes).label('total_dislikes'),
+        func.sum(yt_daily.c.video_count).label('video_count')
+    )
+    # Apply filters
+    if country and country != "ALL":
+        query = query.where(yt_daily.c.country == country)
+
+    query=add_dates_filter_to_query(query, start_date, end_date, yt_daily.c.day)
+
+    # Group by category
+    return ChartQuery(query.group_by(yt_daily.c.category), {}, None)
+
+def bar_chart_shape(results, context):
+    return [{
+        "category": row.category or "Uncategorized",
+        "likes": int(row.total_likes/1000000) or 0,
+        "views": int(row.total_views/1000000) or 0,
+        "videos": int(row.video_count) or 0,
+        "comments": int(row.total_comments/1000000) or 0,
+        "dislikes": int(row.total_dislikes/1000000) or 0
+    } for row in results]
+
+
+# -------------------------------
+# /radar_chart
+# -------------------------------
+
+def radar_chart_query(args):
+    start_date = args.get('startDate')
+    end_date = args.get('endDate')
+    categories = parse_categories(args)
+
+    # Base query
+    query = select(
+        yt_daily.c.category,
+        func.sum(yt_daily.c.sum_likes).label('likes'),
+        func.sum(yt_daily.c.sum_views).label('views'),
+        func.sum(yt_daily.c.sum_comments).label('comments'),
+        func.sum(yt_daily.c.sum_dislikes).label('dislikes'),
+        (func.sum(yt_daily.c.sum_duration) /
+         func.nullif(func.sum(yt_daily.c.cnt_duration), 0)).label('avg_duration')
+    )
+
+    query=add_dates_filter_to_query(query, start_date, end_date, yt_daily.c.day)
+
+    # Apply category filter
+    if categories:
+        query = query.where(yt_daily.c.category.in_(categories))
+    return ChartQuery(query.group_by(yt_daily.c.category), {}, None)
+
+def radar_chart_shape(results, context):
+    return [{
+        "category": row.category,
+        "likes": int(row.likes) if row.likes else 0,
+        "views": int(row.views) if row.views else 0,
+        "comments": int(row.comments) if row.comments else 0,
+        "dislikes": int(row.dislikes) if row.dislikes else 0,
+        "avg_duration": round(float(row.avg_duration), 2) if row.avg_duration else 0.00
+    } for row in results]
+
+
+# -------------------------------
+# /world_map
+# -------------------------------
+
+WORLD_MAP_CATEGORIES = [
+    'Current Affairs', 'Films', 'Gaming and Sports',
+    'Music', 'People and Lifestyle',
+    'Science and Technology', 'Travel and Vlogs'
+]
+
+def world_map_query(args):
+    start_date = args.get('startDate')
+    end_date = args.get('endDate')
+    metric = args.get('metric', 'likes').lower()
+
+    # Map metric to database column
+    metric_columns = {
+        'likes': yt_daily.c.sum_likes,
+        'dislikes': yt_daily.c.sum_dislikes,
+        'views': yt_daily.c.sum_views,
+        'comments': yt_daily.c.sum_comments
+    }
+
+    if metric not in metric_columns:
+        raise EndpointError("Invalid metric")
+
+    # Base query with filters
+    query = select(
+        yt_daily.c.country,
+        yt_daily.c.category,
+        func.sum(metric_columns[metric]).label('total')
+    )
+
+    query=add_dates_filter_to_query(query, start_date, end_date, yt_daily.c.day)
+
+    return ChartQuery(query.group_by(yt_daily.c.country, yt_daily.c.category), {}, None)
+
+def world_map_shape(results, context):
+    # Process results into country-based format
+    country_map = {}
+    for country, category, total in results:
+        if country not in country_map:
+            # Initialize with all categories at 0
+            country_map[country] = {'country': country}
+            for cat in WORLD_MAP_CATEGORIES:
+                country_map[country][cat] = 0.0
+
+        if category in WORLD_MAP_CATEGORIES:
+            country_map[country][category] = float(total) if total else 0.0
+
+    return list(country_map.values())
+
+
+# -------------------------------
+# /corr_mat
+# -------------------------------
+
+def corr_mat_query(args):
+    start_mon = args.get('startDate')
+    end_mon = args.get('endDate')
+    country = args.get('country', 'US')
+
+    start_date=None
+    end_date=None
+    if start_mon and end_mon:
+        start_date,end_date=convert_to_full_dates(start_mon, end_mon)
+
+    # Categories to include (all when empty)
+    categories = parse_categories(args)
+
+    # Per-category sufficient statistics summed over the months in range
+    sql = f'''
+    SELECT
+        category,
+        {stats_select_columns()}
+    FROM yt_monthly_stats
+    WHERE (CAST(:start_date AS date) IS NULL OR month >= :start_date) AND
+        (CAST(:end_date AS date) IS NULL OR month <= :end_date)  AND
+        (country = :country OR :country = 'ALL')
+    '''
+    params = {
+        'start_date': start_date,
+        'end_date': end_date,
+        'country': country
+    }
+    if categories:
+        sql += " AND category IN :categories"
+    sql += " GROUP BY category ORDER BY category"
+
+    stmt = text(sql)
+    if categories:
+        stmt = stmt.bindparams(bindparam('categories', expanding=True))
+        params['categories'] = list(categories)
+    return ChartQuery(stmt, params, None)
+
+def corr_mat_shape(results, context):
+    # Per-category matrices plus the combined 'ALL' matrix
+    matrices = pearson(append_total(stats_from_rows(results)))
+    labels = [row.category if row.category is not None else 'ALL' for row in results]
+    labels.append('ALL')
+
+    return [
+        {"category": label, **pair_values(matrix)}
+        for label, matrix in zip(labels, matrices)
+    ]
+
+
+# -------------------------------
+# /month_cat
+# -------------------------------
+
+def month_cat_query(args):
+    start_mon = args.get('startDate')
+    end_mon = args.get('endDate')
+    metric = args.get('metric', 'likes').lower()
+    country = args.get('country', 'ALL').upper()
+
+    # Validate metric
+    valid_metrics = {'likes', 'views', 'comments', 'dislikes'}
+    if metric not in valid_metrics:
+        raise EndpointError("Invalid metric")
+
+    # Convert to full dates
+    start_date, end_date = convert_to_full_dates(start_mon, end_mon)
+
+    # One dense array per category, every month present (0 where empty)
+    where = ''
+    params = {
+        'start_date': start_date,
+        'end_date': end_date
+    }
+    if country != 'ALL':
+        where = " AND country = :country"
+        params['country'] = country
+
+    sql = series_sql('yt_daily', 'day', 'month', {
+        'total': f'SUM(sum_{metric})',
+        'video_count': 'SUM(video_count)'
+    }, key='category', where=where)
+    return ChartQuery(text(sql), params, month_labels(start_date, end_date))
+
+def month_cat_shape(results, dates):
+    return [{
+        'category': row.key,
+        'months': [
+            {'month': month, 'total': round(total / video_count, 2) if video_count > 0 else 0}
+            for month, total, video_count in zip(dates, row.total, row.video_count)
+        ]
+    } for row in results]
+
+
+# -------------------------------
+# /month_specific
+# -------------------------------
+
+MONTH_TOTALS_SQL = text("""
+SELECT
+    COALESCE(SUM(sum_views), 0) AS total_views,
+    COALESCE(SUM(sum_likes), 0) AS total_likes,
+    COALESCE(SUM(sum_comments), 0) AS total_comments
+FROM yt_daily
+WHERE day BETWEEN :start_date AND :end_date
+""")
+
+def month_specific_query(args):
+    year_month = args.get('month')
+
+    # Validate input format
+    if not re.match(r'^\d{4}-\d{2}$', year_month):
+        raise EndpointError("Invalid month format. Use YYYY-MM")
+
+    year, month = map(int, year_month.split('-'))
+
+    # Validate month range
+    if month < 1 or month > 12:
+        raise EndpointError("Invalid month. Must be 01-12")
+
+    # Calculate month start/end dates
+    try:
+        first_day = date(year, month, 1)
+        last_day = date(year, month, calendar.monthrange(year, month)[1])
+    except ValueError as ve:
+        raise EndpointError(f"Invalid date parameters: {str(ve)}")
+
+    params = {
+        'start_date': first_day,
+        'end_date': last_day
+    }
+    return ChartQuery(MONTH_TOTALS_SQL, params, year_month)
+
+def month_specific_shape(results, year_month):
+    result = results[0]
+    return {
+        "month": year_month,
+        "totals": {
+            "views": int(result.total_views),
+            "likes": int(result.total_likes),
+            "comments": int(result.total_comments)
+        }
+    }
+
+
+# -------------------------------
+# /temp
+# -------------------------------
+
+MONTHLY_COUNTS_SQL = text(series_sql('yt_daily', 'day', 'month', {'total': 'SUM(video_count)'}))
+
+def temp_query(args):
+    start_mon = args.get('startDate', "2017-01")
+    end_mon = args.get('endDate', "2021-12")
+
+    # Convert to full dates
+    start_date, end_date = convert_to_full_dates(start_mon, end_mon)
+    params = {
+        'start_date': start_date,
+        'end_date': end_date
+    }
+    return ChartQuery(MONTHLY_COUNTS_SQL, params, month_labels(start_date, end_date))
+
+def temp_shape(results, dates):
+    # A single series, absent when no month has data
+    totals = results[0].total if results else [0] * len(dates)
+    return [{'month': month, 'total': int(total)} for month, total in zip(dates, totals)]
+
+
+# -------------------------------
+# /timeseries
+# -------------------------------
+# Dense series from yt_daily at day/week/month/quarter granularity:
+#   granularity  day | week | month (default) | quarter
+#   metric       count (videos, default) | views | likes | comments | dislikes
+#   stat         sum (default) | avg (metric per video)
+#   groupBy      country | category (one series when absent)
+#   window       rolling (over `size` buckets, default 7) | cumulative
+#   country, categories as in the other charts
+#   startDate, endDate  YYYY-MM as in the other charts, or YYYY-MM-DD
+# The response is {"granularity", "buckets": [labels], "series": [{"key", "values"}]}.
+
+MAX_BUCKETS = 20000
+TIMESERIES_METRICS = {
+    'count': 'video_count',
+    'views': 'sum_views',
+    'likes': 'sum_likes',
+    'comments': 'sum_comments',
+    'dislikes': 'sum_dislikes',
+}
+TimeseriesContext = namedtuple('TimeseriesContext', ['granularity', 'labels', 'stat', 'metric'])
+
+def timeseries_dates(start_param, end_param):
+    """YYYY-MM bounds cover whole months; YYYY-MM-DD ones are taken as they are"""
+    try:
+        start_date, end_date = convert_to_full_dates(start_param[:7], end_param[:7])
+        if len(start_param) > 7:
+            start_date = date.fromisoformat(start_param)
+        if len(end_param) > 7:
+            end_date = date.fromisoformat(end_param)
+    except ValueError:
+        raise EndpointError("Invalid startDate/endDate. Use YYYY-MM or YYYY-MM-DD")
+    if start_date > end_date:
+        raise EndpointError("startDate is after endDate")
+    return start_date, end_date
+
+def timeseries_query(args):
+    granularity = args.get('granularity', 'month')
+    metric = args.get('metric', 'count').lower()
+    stat = args.get('stat', 'sum')
+    group_by = args.get('groupBy')
+    window_param = args.get('window')
+    country = args.get('country', 'ALL').upper()
+    categories = parse_categories(args)
+
+    if granularity not in GRANULARITIES:
+        raise EndpointError(f"Invalid granularity. Use one of: {', '.join(GRANULARITIES)}")
+    if metric not in TIMESERIES_METRICS:
+        raise EndpointError(f"Invalid metric. Use one of: {', '.join(TIMESERIES_METRICS)}")
+    if stat not in ('sum', 'avg') or (stat == 'avg' and metric == 'count'):
+        raise EndpointError("Invalid stat. Use sum, or avg with a metric other than count")
+    if group_by not in (None, 'country', 'category'):
+        raise EndpointError("Invalid groupBy. Use country or category")
+
+    window = None
+    if window_param == 'cumulative':
+        window = ('cumulative',)
+    elif window_param == 'rolling':
+        try:
+            size = int(args.get('size', 7))
+        except ValueError:
+            raise EndpointError("Invalid size")
+        if size < 1:
+            raise EndpointError("Invalid size")
+        window = ('rolling', size)
+    elif window_param is not None:
+        raise EndpointError("Invalid window. Use rolling or cumulative")
+
+    start_date, end_date = timeseries_dates(args.get('startDate', "2017-01"), args.get('endDate', "2021-12"))
+    buckets = len(bucket_starts(start_date, end_date, granularity))
+    if buckets > MAX_BUCKETS:
+        raise EndpointError(f"Too many buckets ({buckets}, max {MAX_BUCKETS}); use a coarser granularity")
+    labels = bucket_labels(start_date, end_date, granularity)
+
+    params = {'start_date': start_date, 'end_date': end_date}
+    where = ''
+    if country != 'ALL':
+        where += " AND country = :country"
+        params['country'] = country
+    if categories:
+        where += " AND category IN :categories"
+        params['categories'] = categories
+
+    fields = {'total': f'SUM({TIMESERIES_METRICS[metric]})'}
+    if stat == 'avg':
+        fields['video_count'] = 'SUM(video_count)'
+    statement = text(series_sql('yt_daily', 'day', granularity, fields, key=group_by, where=where, window=window))
+    if categories:
+        statement = statement.bindparams(bindparam('categories', expanding=True))
+    return ChartQuery(statement, params, TimeseriesContext(granularity, labels, stat, metric))
+
+def timeseries_shape(results, context):
+    series = []
+    for row in results:
+        totals = np.array(row.total, dtype=np.float64)
+        if context.stat == 'avg':
+            counts = np.array(row.video_count, dtype=np.float64)
+            values = np.divide(totals, counts, out=np.zeros_like(totals), where=counts > 0).round(2).tolist()
+        else:
+            values = totals.astype(np.int64).tolist()
+        series.append({'key': row.key, 'values': values})
+    return {'granularity': context.granularity, 'buckets': context.labels, 'series': series}
+
+
+# Route name -> chart; the log labels and 500 messages are the ones the
+# endpoints have always used
+CHARTS = {
+    'word_cloud': Chart(word_cloud_query, word_cloud_shape,
+                        "Word cloud", "Failed to generate word cloud data"),
+    'bar_chart': Chart(bar_chart_query, bar_chart_shape,
+                       "Category stats", "Failed to fetch category statistics"),
+    'radar_chart': Chart(radar_chart_query, radar_chart_shape,
+                         "Radar chart", "Failed to generate radar chart data"),
+    'world_map': Chart(world_map_query, world_map_shape,
+                       "World map", "Failed to generate world map data"),
+    'corr_mat': Chart(corr_mat_query, corr_mat_shape,
+                      "Correlation matrix", "Failed to generate correlation matrix"),
+    'month_cat': Chart(month_cat_query, month_cat_shape,
+                       "Monthly category metrics", "Failed to generate monthly category metrics"),
+    'month_specific': Chart(month_specific_query, month_specific_shape,
+                            "Month specific", "Failed to retrieve monthly totals"),
+    'temp': Chart(temp_query, temp_shape,
+                  "Monthly counts", "Failed to generate monthly counts"),
+    'timeseries': Chart(timeseries_query, timeseries_shape,
+                        "Time series", "Failed to generate time series"),
+}
+
+
+# -------------------------------
+# Prediction payloads
+# -------------------------------
+# Both return (payload, status); exceptions are left to the caller, which
+# answers 500 with PREDICT_ERROR / PREDICT_BATCH_ERROR. `predict` scores a
+# list of inputs: predict_batch itself, or a PredictionPool's predict.
+
+PREDICT_ERROR = "Prediction failed"
+PREDICT_BATCH_ERROR = "Batch prediction failed"
+MAX_BATCH_SIZE = 10000
+
+def rounded_prediction(pred):
+    return {
+        "#views": round(pred.get('#views', 0)),
+        "#likes": round(pred.get('#likes', 0)),
+        "#comments": round(pred.get('#comments', 0)),
+        "#dislikes": round(pred.get('#dislikes', 0))
+    }
+
+def predict_payload(input_data, predict=predict_batch):
+    # Fields, duration, category and country, checked without the models
+    error = validate_input(input_data)
+    if error is not None:
+        return {"error": error}, 400
+
+    # Make prediction
+    predictions = predict([dict(input_data, duration=float(input_data['duration']))])[0]
+
+    return {
+        "predictions": rounded_prediction(predictions),
+        "status": "success"
+    }, 200
+
+def predict_batch_payload(input_data, predict=predict_batch):
+    # Accept either {"items": [...]} or a bare JSON list
+    items = input_data.get('items') if isinstance(input_data, dict) else input_data
+
+    if not isinstance(items, list):
+        return {"error": "Expected a list of items"}, 400
+    if len(items) > MAX_BATCH_SIZE:
+        return {"error": f"Batch too large (max {MAX_BATCH_SIZE} items)"}, 400
+
+    # Validate each item; invalid ones get an error entry in place
+    errors = [validate_input(item) for item in items]
+    valid_items = [
+        dict(item, duration=float(item['duration']))
+        for item, error in zip(items, errors) if error is None
+    ]
+
+    # Make predictions for all valid items at once
+    predictions = iter(predict(valid_items))
+
+    formatted_predictions = []
+    for error in errors:
+        if error is not None:
+            formatted_predictions.append({"error": error})
+            continue
+        formatted_predictions.append(rounded_prediction(next(predictions)))
+
+    return {
+        "predictions": formatted_predictions,
+        "status": "success"
+    }, 200
@@ -0,0 +1,249 @@
+import bisect
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from config import Config
+from endpoints import EndpointError
+
+# -------------------------------
+# Request timing
+# -------------------------------
+# Views wrap their steps in phase('parse' | 'db' | 'materialize' |
+# 'serialize' | ...); the app's request hooks start a RequestTimer and hand
+# it to LatencyMetrics when the response is ready. Everything is
+# per-process: with several workers, each keeps its own numbers.
+
+# Upper bounds of the histogram buckets, in milliseconds (+Inf is implied)
+BUCKETS_MS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+current_timer = ContextVar('current_timer', default=None)
+
+
+def phase(name):
+    """Time a block as part of the current request (no-op outside one)"""
+    timer = current_timer.get()
+    return timer.phase(name) if timer is not None else nullcontext()
+
+
+class RequestTimer:
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = {}
+
+    @contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = (time.perf_counter() - started) * 1000
+            self.phases[name] = self.phases.get(name, 0.0) + elapsed
+
+    def elapsed_ms(self):
+        return (time.perf_counter() - self.started) * 1000
+
+    def server_timing(self):
+        """Server-Timing header value, so browser dev tools show the phases"""
+        parts = [f'{name};dur={ms:.2f}' for name, ms in self.phases.items()]
+        parts.append(f'total;dur={self.elapsed_ms():.2f}')
+        return ', '.join(parts)
+
+
+class Histogram:
+
+    def __init__(self, bounds=BUCKETS_MS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, ms):
+        self.counts[bisect.bisect_left(self.bounds, ms)] += 1
+        self.count += 1
+        self.total += ms
+        self.min = ms if self.min is None else min(self.min, ms)
+        self.max = ms if self.max is None else max(self.max, ms)
+
+    def quantile(self, q):
+        """Estimate by linear interpolation inside the bucket holding the q-th value"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = max(self.bounds[i - 1] if i > 0 else 0.0, self.min)
+                upper = min(self.bounds[i] if i < len(self.bounds) else self.max, self.max)
+                return round(lower + (upper - lower) * (rank - seen) / count, 3)
+            seen += count
+        return round(self.max, 3)
+
+    def snapshot(self):
+        # Cumulative [upper bound, count] pairs, as in Prometheus
+        cumulative, buckets = 0, []
+        for bound, count in zip(list(self.bounds) + ['+Inf'], self.counts):
+            cumulative += count
+            buckets.append([bound, cumulative])
+        return {
+            'count': self.count,
+            'sum_ms': round(self.total, 3),
+            'mean_ms': round(self.total / self.count, 3) if self.count else None,
+            'max_ms': round(self.max, 3) if self.count else None,
+            'p50_ms': self.quantile(0.5),
+            'p95_ms': self.quantile(0.95),
+            'p99_ms': self.quantile(0.99),
+            'buckets': buckets
+        }
+
+
+class LatencyMetrics:
+    """Per-route histograms of total request time and of each phase"""
+
+    def __init__(self):
+        self._routes = {}
+        self._lock = threading.Lock()
+
+    def record(self, route, timer, status):
+        total = timer.elapsed_ms()
+        with self._lock:
+            entry = self._routes.setdefault(route, {'errors': 0, 'phases': {}})
+            if status >= 500:
+                entry['errors'] += 1
+            for name, ms in [('total', total), *timer.phases.items()]:
+                entry['phases'].setdefault(name, Histogram()).observe(ms)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                route: {
+                    'requests': entry['phases']['total'].count,
+                    'errors': entry['errors'],
+                    'phases': {name: hist.snapshot() for name, hist in entry['phases'].items()}
+                }
+                for route, entry in sorted(self._routes.items())
+            }
+
+    def prometheus(self):
+        """The same histograms in the Prometheus text format"""
+        lines = [
+            '# HELP request_phase_milliseconds Request time by route and phase',
+            '# TYPE request_phase_milliseconds histogram',
+        ]
+        for route, entry in self.snapshot().items():
+            for name, hist in entry['phases'].items():
+                labels = f'route="{route}",phase="{name}"'
+                for bound, count in hist['buckets']:
+                    lines.append(f'request_phase_milliseconds_bucket{{{labels},le="{bound}"}} {count}')
+                lines.append(f'request_phase_milliseconds_sum{{{labels}}} {hist["sum_ms"]}')
+                lines.append(f'request_phase_milliseconds_count{{{labels}}} {hist["count"]}')
+        lines += [
+            '# HELP request_errors_total Requests answered with a 5xx status',
+            '# TYPE request_errors_total counter',
+        ]
+        lines += [
+            f'request_errors_total{{route="{route}"}} {entry["errors"]}'
+            for route, entry in self.snapshot().items()
+        ]
+        return '\n'.join(lines) + '\n'
+
+
+def wants_prometheus(format_param, accept):
+    """/metrics answers in the Prometheus text format for format=prometheus or a scraper's Accept"""
+    if format_param:
+        return format_param == 'prometheus'
+    return 'text/plain' in (accept or '') or 'openmetrics' in (accept or '')
+
+
+# -------------------------------
+# Query plans (explain=1)
+# -------------------------------
+
+EXPLAIN_PREFIX = 'EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) '
+
+
+@event.listens_for(Engine, 'before_cursor_execute', retval=True)
+def _explain_statement(conn, cursor, statement, parameters, context, executemany):
+    # Statements run with execution_options(explain=True) return their plan
+    if context is not None and context.execution_options.get('explain'):
+        statement = EXPLAIN_PREFIX + statement
+    return statement, parameters
+
+
+def explain_requested(args):
+    if args.get('explain') != '1':
+        return False
+    if not Config.ALLOW_EXPLAIN:
+        raise EndpointError("explain=1 is disabled on this server")
+    return True
+
+
+def explain_statement(statement):
+    """The statement, set to run under EXPLAIN (ANALYZE, BUFFERS) instead"""
+    return statement.execution_options(explain=True)
+
+
+def explain_payload(statement, params, plan):
+    # psycopg2 parses the JSON plan; asyncpg hands it back as text
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    # Core statements carry their own bound values next to the explicit params
+    bound = {**statement.compile().params, **params}
+    return {'statement': str(statement).strip(), 'params': bound, 'plan': plan}
+
+
+# -------------------------------
+# Query log (input for benchmarks/index_advisor.py)
+# -------------------------------
+
+_DECLARE_CURSOR = re.compile(r'^DECLARE\s+"?\w+"?\s+CURSOR\b.*?\bFOR\s+', re.S)
+
+
+class QueryLog:
+    """
+    Records every SELECT as Postgres received it, values inlined. Only
+    psycopg2 exposes that text, so queries from the asyncpg app are not
+    seen. With a `path`, each process appends JSON lines to `path.<pid>`;
+    otherwise the text is kept in `queries`.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.queries = []
+        self._lock = threading.Lock()
+
+    def install(self, target=Engine):
+        event.listen(target, 'after_cursor_execute', self._record)
+        return self
+
+    def remove(self, target=Engine):
+        event.remove(target, 'after_cursor_execute', self._record)
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany):
+        sent = getattr(cursor, 'query', None)
+        # Prepared chart statements (db_routing.py) are sent as EXECUTE
+        # name (...); the context still holds the SQL they stand for
+        original = getattr(context, 'statement', None) or statement
+        if not sent or not original.lstrip().upper().startswith(('SELECT', 'WITH')):
+            return
+        if original != statement:
+            sent = cursor.mogrify(original, parameters)
+        sql = sent.decode() if isinstance(sent, bytes) else sent
+        # Server-side cursors (/rows) arrive wrapped in DECLARE ... FOR
+        sql = _DECLARE_CURSOR.sub('', sql)
+        with self._lock:
+            if self.path is None:
+                self.queries.append(sql)
+            else:
+                with open(f'{self.path}.{os.getpid()}', 'a') as f:
+                    f.write(json.dumps({'sql': sql}) + '\n')
@@ -0,0 +1,192 @@
+import gc
+import logging
+import multiprocessing
+import queue
+import signal
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+from config import Config
+from Project.prediction import load_artifacts, predict_batch
+
+logger = logging.getLogger(__name__)
+
+# -------------------------------
+# Prediction worker pool
+# -------------------------------
+# With PREDICTION_WORKERS > 0, /predict and /predict_batch are scored by that
+# many forked processes instead of the request threads. The artifacts are
+# loaded in the parent before forking, so the workers share the memory-mapped
+# GloVe matrix and the boosters' pages copy-on-write rather than each holding
+# a copy. Requests that arrive within the batch window are scored as one
+# predict_batch call, and the number of waiting items is bounded: past it,
+# requests are turned away with 503 instead of queueing without end.
+
+
+class PredictionPoolBusy(Exception):
+    """The queue is full, or the request waited too long; answered with 503"""
+
+
+def _worker_main(conn):
+    # Ctrl-C reaches the whole process group; the parent decides when to stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    while True:
+        try:
+            inputs = conn.recv()
+        except EOFError:
+            return
+        if inputs is None:
+            return
+        try:
+            conn.send((True, predict_batch(inputs)))
+        except Exception as e:
+            conn.send((False, e))
+
+
+class PredictionPool:
+    """
+    `workers` processes, each fed by a thread of this process. A feeder takes
+    the oldest request, adds whatever else arrives within `batch_window_ms`
+    (up to `max_batch` items), sends the lot to its worker and hands each
+    request its slice of the result.
+    """
+
+    def __init__(self, workers, batch_window_ms=2, max_batch=512, max_queued=20000, timeout=15):
+        load_artifacts()
+        self.batch_window = batch_window_ms / 1000
+        self.max_batch = max_batch
+        self.max_queued = max_queued
+        self.timeout = timeout
+        self._requests = queue.Queue()
+        self._queued = 0
+        self._lock = threading.Lock()
+        self._stats = {'requests': 0, 'items': 0, 'batches': 0, 'rejected': 0, 'timeouts': 0, 'restarts': 0}
+        self._context = multiprocessing.get_context('fork')
+
+        # Everything allocated so far (the artifacts included) is left out of
+        # future collections, so the collector does not write to, and thereby
+        # copy, those pages in the workers
+        gc.freeze()
+        # Fork before starting any thread of our own
+        self._workers = [self._spawn() for _ in range(workers)]
+        for slot in range(workers):
+            threading.Thread(target=self._feed, args=(slot,), name=f'prediction-feeder-{slot}', daemon=True).start()
+
+    def _spawn(self):
+        parent_conn, child_conn = self._context.Pipe()
+        process = self._context.Process(target=_worker_main, args=(child_conn,), daemon=True)
+        process.start()
+        child_conn.close()
+        return process, parent_conn
+
+    def submit(self, inputs):
+        """Queue `inputs`; the Future resolves to predict_batch's result for them"""
+        with self._lock:
+            if self._queued + len(inputs) > self.max_queued:
+                self._stats['rejected'] += 1
+                raise PredictionPoolBusy(f"Prediction queue is full ({self._queued} items waiting)")
+            self._queued += len(inputs)
+            self._stats['requests'] += 1
+        future = Future()
+        self._requests.put((inputs, future))
+        return future
+
+    def predict(self, inputs):
+        """Drop-in for predict_batch that runs in the pool"""
+        if not inputs:
+            return []
+        future = self.submit(inputs)
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeout:
+            # Still queued: the feeder skips it. Already running: the result is dropped
+            future.cancel()
+            with self._lock:
+                self._stats['timeouts'] += 1
+            raise PredictionPoolBusy(f"Prediction did not finish within {self.timeout}s")
+
+    def _feed(self, slot):
+        while True:
+            batch = [self._requests.get()]
+            size = len(batch[0][0])
+            deadline = time.perf_counter() + self.batch_window
+            while size < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    request = self._requests.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                batch.append(request)
+                size += len(request[0])
+            with self._lock:
+                self._queued -= size
+
+            batch = [(inputs, future) for inputs, future in batch if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            ok, result = self._run(slot, [item for inputs, _ in batch for item in inputs])
+            if not ok and len(batch) > 1:
+                # One bad request (e.g. an unknown country) must not fail the others
+                for inputs, future in batch:
+                    self._resolve(future, *self._run(slot, inputs))
+                continue
+            offset = 0
+            for inputs, future in batch:
+                self._resolve(future, ok, result[offset:offset + len(inputs)] if ok else result)
+                offset += len(inputs)
+
+    def _run(self, slot, inputs):
+        process, conn = self._workers[slot]
+        try:
+            conn.send(inputs)
+            ok, result = conn.recv()
+        except (EOFError, OSError) as e:
+            # The worker died (e.g. killed for memory); start a fresh one
+            logger.error(f"Prediction worker {slot} died: {e}")
+            process.kill()
+            process.join()
+            self._workers[slot] = self._spawn()
+            with self._lock:
+                self._stats['restarts'] += 1
+            return False, RuntimeError("Prediction worker died")
+        with self._lock:
+            self._stats['batches'] += 1
+            self._stats['items'] += len(inputs)
+        return ok, result
+
+    @staticmethod
+    def _resolve(future, ok, result):
+        if ok:
+            future.set_result(result)
+        else:
+            future.set_exception(result)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats, workers=len(self._workers), queued_items=self._queued)
+        stats['mean_batch'] = round(stats['items'] / stats['batches'], 2) if stats['batches'] else None
+        return stats
+
+    def close(self):
+        for process, conn in self._workers:
+            try:
+                conn.send(None)
+            except OSError:
+                pass
+            process.join(timeout=5)
+
+
+def pool_from_config():
+    """A PredictionPool as configured, or None to predict in the request thread"""
+    if Config.PREDICTION_WORKERS <= 0:
+        return None
+    return PredictionPool(
+        Config.PREDICTION_WORKERS,
+        batch_window_ms=Config.PREDICTION_BATCH_WINDOW_MS,
+        max_batch=Config.PREDICTION_MAX_BATCH,
+        max_queued=Config.PREDICTION_QUEUE_ITEMS,
+        timeout=Config.REQUEST_TIMEOUT_SECONDS
+    )
@@ -0,0 +1,349 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from functools import wraps
+
+from flask import Response, make_response, request
+
+logger = logging.getLogger(__name__)
+
+# -------------------------------
+# Storage backends
+# -------------------------------
+
+class LRUCache:
+    """Bounded in-process LRU"""
+
+    def __init__(self, maxsize=2048):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class DictBackend:
+    """
+    Local stand-in for the shared backend (same interface, one process):
+    an LRUCache of (value, expiry), so earlier data versions' entries are
+    evicted and `ttl` is honoured
+    """
+
+    def __init__(self, maxsize=2048):
+        self._entries = LRUCache(maxsize)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, expires = entry
+        if expires is not None and time.monotonic() >= expires:
+            return None
+        return value
+
+    def set(self, key, value, ttl=None):
+        expires = time.monotonic() + ttl if ttl else None
+        self._entries.set(key, (value, expires))
+
+
+class RedisBackend:
+    """Shared cache across workers/hosts; needs the `redis` package"""
+
+    def __init__(self, url, prefix='yt-cache:'):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self.prefix + key, value, ex=ttl)
+
+
+def make_shared_backend(url, maxsize=2048):
+    if not url:
+        return None
+    if url == 'memory://':
+        return DictBackend(maxsize)
+    return RedisBackend(url)
+
+
+# -------------------------------
+# Cached responses
+# -------------------------------
+
+class CachedResponse:
+    __slots__ = ('body', 'mimetype', 'etag')
+
+    def __init__(self, body, mimetype, etag):
+        self.body = body
+        self.mimetype = mimetype
+        self.etag = etag
+
+    def to_bytes(self):
+        return b'\n'.join([self.mimetype.encode(), self.etag.encode(), self.body])
+
+    @classmethod
+    def from_bytes(cls, data):
+        mimetype, etag, body = data.split(b'\n', 2)
+        return cls(body, mimetype.decode(), etag.decode())
+
+
+class UncachedResponse:
+    """A response that is not kept (errors, no-store), replayed to every caller that waited for it"""
+    __slots__ = ('body', 'status', 'headers')
+
+    def __init__(self, body, status, headers):
+        self.body = body
+        self.status = status
+        self.headers = headers
+
+    def to_response(self):
+        return Response(self.body, status=self.status, headers=self.headers)
+
+
+# -------------------------------
+# Request coalescing
+# -------------------------------
+
+class SingleFlight:
+    """
+    At most one call per key at a time: a caller arriving while the call for
+    its key runs waits, up to `timeout` seconds, for that call's result
+    instead of making its own. Waiters share the result object, so it must
+    not be changed after it is returned.
+    """
+
+    def __init__(self, timeout=15.0):
+        self.timeout = timeout
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.waiters = 0
+        self.timeouts = 0
+
+    def run(self, key, call):
+        """call() or the result of the running call for `key`; raises FutureTimeout after waiting too long"""
+        with self._lock:
+            flight = self._flights.get(key)
+            leading = flight is None
+            if leading:
+                flight = self._flights[key] = Future()
+                self.leaders += 1
+            else:
+                self.waiters += 1
+
+        if not leading:
+            try:
+                return flight.result(timeout=self.timeout)
+            except FutureTimeout:
+                with self._lock:
+                    self.timeouts += 1
+                raise
+
+        try:
+            result = call()
+        except BaseException as e:
+            flight.set_exception(e)
+            raise
+        else:
+            flight.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._flights[key]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'leaders': self.leaders,
+                'waiters': self.waiters,
+                'timeouts': self.timeouts,
+                'in_flight': len(self._flights)
+            }
+
+
+# Query args whose value does not change the response when normalized
+ARG_NORMALIZERS = {
+    'metric': lambda value: value.lower(),
+}
+# Query args holding a JSON list whose order does not matter
+UNORDERED_JSON_ARGS = {'categories'}
+
+
+def canonical_args(args):
+    """Stable string for a request's query args: sorted, with order-free lists sorted too"""
+    items = []
+    for name, value in args.items(multi=True):
+        if name in ARG_NORMALIZERS:
+            value = ARG_NORMALIZERS[name](value)
+        elif name in UNORDERED_JSON_ARGS:
+            try:
+                parsed = json.loads(value)
+            except json.JSONDecodeError:
+                parsed = None
+            if isinstance(parsed, list) and all(isinstance(item, str) for item in parsed):
+                value = json.dumps(sorted(set(parsed)))
+        items.append((name, value))
+    return json.dumps(sorted(items), separators=(',', ':'))
+
+
+class ResponseCache:
+    """
+    Caches successful GET responses keyed by (data version, path, canonical
+    args). Entries from an older data version are never served: the version
+    is part of the key, and the local LRU is dropped when it changes.
+    `vary`, if given, returns the response variant picked from the request
+    headers (e.g. the negotiated format); it is part of the key too.
+
+    `log_request`, if given, is called with (path, args, format variant)
+    for every request the cache sees (the cache warmer's access log).
+
+    Misses are coalesced: while one request renders a key, identical
+    requests wait up to `coalesce_timeout` seconds for its response rather
+    than running the same queries, and get 503 past that.
+    """
+
+    def __init__(self, version_source, maxsize=2048, shared=None,
+                 version_ttl=5.0, shared_ttl=None, vary=None, coalesce_timeout=15.0,
+                 log_request=None):
+        self.local = LRUCache(maxsize)
+        self.flights = SingleFlight(coalesce_timeout)
+        self.shared = shared
+        self.shared_ttl = shared_ttl
+        self.version_source = version_source
+        self.version_ttl = version_ttl
+        self.vary = vary
+        self.log_request = log_request
+        self._version = None
+        self._version_checked = 0.0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+
+    def data_version(self):
+        now = time.monotonic()
+        if self._version is None or now - self._version_checked >= self.version_ttl:
+            try:
+                version = str(self.version_source())
+            except Exception as e:
+                # A failed read is not a new version: keep the cache and
+                # its keys as they are and try again after version_ttl
+                logger.warning(f"Reading the data version failed: {e}")
+                with self._lock:
+                    self._version_checked = now
+                return self._version or '0'
+            with self._lock:
+                if version != self._version:
+                    self.local.clear()
+                self._version = version
+                self._version_checked = now
+        return self._version
+
+    def make_key(self, path, args):
+        variant = self.vary() if self.vary is not None else ''
+        return f'{self.data_version()}|{path}|{variant}|{canonical_args(args)}'
+
+    def lookup(self, key):
+        entry = self.local.get(key)
+        if entry is None and self.shared is not None:
+            data = self.shared.get(key)
+            if data is not None:
+                entry = CachedResponse.from_bytes(data)
+                self.local.set(key, entry)
+        return entry
+
+    def store(self, key, entry):
+        self.local.set(key, entry)
+        if self.shared is not None:
+            self.shared.set(key, entry.to_bytes(), ttl=self.shared_ttl)
+
+    def cached(self, view):
+        """Decorator for GET views; adds ETag and answers If-None-Match with 304"""
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            key = self.make_key(request.path, request.args)
+            if self.log_request is not None:
+                self.log_request(request.path, request.args, self.vary() if self.vary is not None else '')
+            entry = self.lookup(key)
+
+            if entry is None:
+                with self._lock:
+                    self.misses += 1
+                try:
+                    entry = self.flights.run(key, lambda: self.render(view, args, kwargs, key))
+                except FutureTimeout:
+                    return Response(
+                        json.dumps({"error": "An identical request is still running; retry shortly", "status": "busy"}),
+                        status=503, mimetype='application/json', headers={'Retry-After': '1'}
+                    )
+                if isinstance(entry, UncachedResponse):
+                    return entry.to_response()
+            else:
+                with self._lock:
+                    self.hits += 1
+
+            if entry.etag in request.if_none_match:
+                with self._lock:
+                    self.not_modified += 1
+                response = Response(status=304)
+            else:
+                response = Response(entry.body, mimetype=entry.mimetype)
+            response.set_etag(entry.etag)
+            response.headers['Cache-Control'] = 'no-cache'
+            if self.vary is not None:
+                response.headers['Vary'] = 'Accept'
+            return response
+
+        return wrapper
+
+    def render(self, view, args, kwargs, key):
+        """Run the view; a CachedResponse, stored, or an UncachedResponse"""
+        response = make_response(view(*args, **kwargs))
+        body = response.get_data()
+        # Errors and no-store answers (explain=1 plans) are not kept
+        if response.status_code != 200 or response.cache_control.no_store:
+            return UncachedResponse(body, response.status_code, list(response.headers.items()))
+        etag = hashlib.sha1(key.encode() + body).hexdigest()
+        entry = CachedResponse(body, response.mimetype, etag)
+        self.store(key, entry)
+        return entry
+
+    def stats(self):
+        with self._lock:
+            hits, misses, not_modified = self.hits, self.misses, self.not_modified
+        lookups = hits + misses
+        return {
+            'hits': hits,
+            'misses': misses,
+            'not_modified': not_modified,
+            'hit_rate': round(hits / lookups, 4) if lookups else 0.0,
+            'size': len(self.local),
+            'data_version': self._version,
+            'coalescing': self.flights.stats()
+        }
@@ -0,0 +1,212 @@
+import json
+from datetime import date
+from decimal import Decimal
+
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # optional: stdlib json is used instead
+    orjson = None
+
+# -------------------------------
+# Response formats
+# -------------------------------
+# JSON stays the default. Chart endpoints can also answer as an Arrow IPC
+# stream or a Parquet file (needs the optional `pyarrow` package), picked by
+# `format=` or the Accept header.
+
+FORMATS = {
+    'json': 'application/json',
+    'arrow': 'application/vnd.apache.arrow.stream',
+    'parquet': 'application/vnd.apache.parquet',
+}
+_MIMETYPE_FORMATS = {mimetype: fmt for fmt, mimetype in FORMATS.items()}
+
+
+class FormatUnavailable(Exception):
+    """A columnar format was asked for but pyarrow is not installed; served as 406"""
+
+
+def negotiate(format_param, accept):
+    """
+    Response format from an explicit `format` value, else the Accept header
+    (highest q first; anything unrecognised, including */*, means JSON).
+    Returns None for an unknown `format` value.
+    """
+    if format_param:
+        fmt = format_param.lower()
+        return fmt if fmt in FORMATS else None
+
+    ranked = []
+    for position, part in enumerate((accept or '').split(',')):
+        mimetype, *options = [piece.strip() for piece in part.split(';')]
+        quality = 1.0
+        for option in options:
+            if option.startswith('q='):
+                try:
+                    quality = float(option[2:])
+                except ValueError:
+                    quality = 0.0
+        ranked.append((-quality, position, mimetype.lower()))
+
+    for _, _, mimetype in sorted(ranked):
+        if mimetype in _MIMETYPE_FORMATS:
+            return _MIMETYPE_FORMATS[mimetype]
+        if mimetype in ('*/*', 'application/*'):
+            return 'json'
+    return 'json'
+
+
+# -------------------------------
+# JSON
+# -------------------------------
+
+def json_default(value):
+    # NUMERIC results come back as Decimal; Flask has always written them as strings
+    if isinstance(value, Decimal):
+        return str(value)
+    # Bound dates in explain=1 output; orjson writes them the same way
+    if isinstance(value, date):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def dumps_json(data, sort_keys=False):
+    """Compact JSON bytes, through orjson when it is installed"""
+    if orjson is not None:
+        return orjson.dumps(data, default=json_default,
+                            option=orjson.OPT_SORT_KEYS if sort_keys else 0)
+    return json.dumps(data, default=json_default, sort_keys=sort_keys,
+                      separators=(',', ':')).encode('utf-8')
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """jsonify() through dumps_json; pretty-printed output (debug) keeps the stdlib path"""
+
+    def response(self, *args, **kwargs):
+        if self.compact is False or (self.compact is None and self._app.debug):
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(dumps_json(obj, self.sort_keys), mimetype=self.mimetype)
+
+
+# -------------------------------
+# Arrow / Parquet
+# -------------------------------
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise FormatUnavailable("Arrow and Parquet output need the pyarrow package")
+    return pyarrow
+
+def columnar_value(value):
+    return float(value) if isinstance(value, Decimal) else value
+
+def flatten_records(data):
+    """
+    Chart JSON as flat records: nested objects become prefixed columns
+    (totals -> totals_views, ...) and a nested list of objects (the months
+    of /month_cat) becomes one record per item, repeating the parent fields.
+    """
+    if isinstance(data, dict):
+        data = [data]
+    records = []
+    for item in data:
+        fields, children = {}, None
+        for key, value in item.items():
+            if isinstance(value, dict):
+                fields.update((f'{key}_{k}', columnar_value(v)) for k, v in value.items())
+            elif isinstance(value, list):
+                children = value
+            else:
+                fields[key] = columnar_value(value)
+        if children is None:
+            records.append(fields)
+        else:
+            records.extend(
+                {**fields, **{k: columnar_value(v) for k, v in child.items()}}
+                for child in children
+            )
+    return records
+
+def write_table(table, fmt, sink):
+    pa = _pyarrow()
+    if fmt == 'parquet':
+        pa.parquet.write_table(table, sink)
+    else:
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+
+def encode_columnar(data, fmt):
+    """Chart data as Arrow IPC stream or Parquet bytes"""
+    pa = _pyarrow()
+    table = pa.Table.from_pylist(flatten_records(data))
+    sink = pa.BufferOutputStream()
+    write_table(table, fmt, sink)
+    return sink.getvalue().to_pybytes()
+
+
+class ChunkSink:
+    """Write-only file that hands back what was written since the last take()"""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+class ColumnarRowEncoder:
+    """
+    Streams row batches as one Arrow IPC stream or one Parquet file (a row
+    group per batch) with a fixed schema: header() / batch(rows) / footer()
+    each return the bytes to send next.
+    """
+
+    def __init__(self, fmt, columns, types):
+        pa = _pyarrow()
+        self.pa = pa
+        self.fmt = fmt
+        self.columns = columns
+        self.schema = pa.schema([(name, getattr(pa, types[name])()) for name in columns])
+        self.sink = ChunkSink()
+        if fmt == 'parquet':
+            self.writer = pa.parquet.ParquetWriter(self.sink, self.schema)
+        else:
+            self.writer = pa.ipc.new_stream(self.sink, self.schema)
+
+    def header(self):
+        return self.sink.take()
+
+    def batch(self, rows):
+        arrays = [
+            self.pa.array(values, type=field.type)
+            for values, field in zip(zip(*rows), self.schema)
+        ] if rows else [self.pa.array([], type=field.type) for field in self.schema]
+        self.writer.write_table(self.pa.Table.from_arrays(arrays, schema=self.schema))
+        return self.sink.take()
+
+    def footer(self):
+        self.writer.close()
+        return self.sink.take()
@@ -0,0 +1,143 @@
+from collections import namedtuple
+
+import numpy as np
+
+# -------------------------------
+# Time series with gap filling
+# -------------------------------
+# Buckets run from the bucket holding the first day to the one holding the
+# last day of a range, at day, week (starting Monday), month or quarter
+# granularity. series_sql has Postgres fill the gaps with generate_series
+# and return one dense array per field and series; densify does the same
+# for rows that are already grouped (the dashboard's panel sources).
+
+# name -> (DATE_TRUNC unit, generate_series step)
+GRANULARITIES = {
+    'day': ('day', '1 day'),
+    'week': ('week', '7 days'),
+    'month': ('month', '1 month'),
+    'quarter': ('quarter', '3 months'),
+}
+
+
+def bucket_starts(start_date, end_date, granularity):
+    """First day of every bucket from start_date to end_date, as datetime64[D]"""
+    start = np.datetime64(start_date, 'D')
+    end = np.datetime64(end_date, 'D')
+    if granularity == 'day':
+        return np.arange(start, end + 1)
+    if granularity == 'week':
+        # 1970-01-01 was a Thursday
+        monday = start - (start.astype(np.int64) + 3) % 7
+        return np.arange(monday, end + 1, 7)
+    first_month = start.astype('datetime64[M]')
+    if granularity == 'quarter':
+        first_month -= first_month.astype(np.int64) % 3
+    step = 3 if granularity == 'quarter' else 1
+    months = np.arange(first_month, end.astype('datetime64[M]') + 1, step)
+    return months.astype('datetime64[D]')
+
+
+def bucket_labels(start_date, end_date, granularity):
+    """
+    Label of every bucket: 'YYYY-MM-DD' (day, week), 'YYYY-MM' (month) or
+    'YYYY-Qn' (quarter)
+    """
+    starts = bucket_starts(start_date, end_date, granularity)
+    if granularity == 'month':
+        return np.datetime_as_string(starts, unit='M').tolist()
+    if granularity == 'quarter':
+        months = starts.astype('datetime64[M]').astype(np.int64)
+        years = (months // 12 + 1970).astype(str)
+        quarters = (months % 12 // 3 + 1).astype(str)
+        return np.char.add(np.char.add(years, '-Q'), quarters).tolist()
+    return np.datetime_as_string(starts, unit='D').tolist()
+
+
+def series_sql(table, date_column, granularity, fields, key=None, where='', window=None):
+    """
+    SQL for dense series over :start_date to :end_date. `fields` maps output
+    names to aggregates (e.g. 'SUM(video_count)'); `key` is the expression
+    splitting the series (one series without it) and `where` extra AND
+    conditions. Each row is (key, one array per field) with a value for
+    every bucket, 0 where there was no data; series come in order of their
+    first bucket with data. `window` is None, ('rolling', n) for the sum
+    over the last n buckets, or ('cumulative',) for the running sum.
+    """
+    unit, step = GRANULARITIES[granularity]
+    names = list(fields)
+    aggregates = ',\n        '.join(f'{aggregate} AS {name}' for name, aggregate in fields.items())
+    filled = ', '.join(f'COALESCE(g.{name}, 0) AS {name}' for name in names)
+
+    sql = f"""
+WITH buckets AS (
+    SELECT generate_series(
+        DATE_TRUNC('{unit}', CAST(:start_date AS date)),
+        CAST(:end_date AS date),
+        INTERVAL '{step}'
+    )::date AS bucket
+),
+grouped AS (
+    SELECT
+        {key or 'NULL::text'} AS key,
+        DATE_TRUNC('{unit}', {date_column})::date AS bucket,
+        {aggregates}
+    FROM {table}
+    WHERE {date_column} BETWEEN :start_date AND :end_date{where}
+    GROUP BY 1, 2
+),
+keys AS (
+    SELECT key, MIN(bucket) AS first_bucket FROM grouped GROUP BY key
+),
+series AS (
+    SELECT k.key, k.first_bucket, b.bucket, {filled}
+    FROM keys k
+    CROSS JOIN buckets b
+    LEFT JOIN grouped g ON g.key IS NOT DISTINCT FROM k.key AND g.bucket = b.bucket
+)"""
+    if window is not None:
+        if window[0] == 'rolling':
+            frame = f'ROWS BETWEEN {int(window[1]) - 1} PRECEDING AND CURRENT ROW'
+        else:
+            frame = 'ROWS UNBOUNDED PRECEDING'
+        windowed = ', '.join(f'SUM({name}) OVER w AS {name}' for name in names)
+        sql += f""",
+windowed AS (
+    SELECT key, first_bucket, bucket, {windowed}
+    FROM series
+    WINDOW w AS (PARTITION BY key ORDER BY bucket {frame})
+)"""
+    arrays = ', '.join(f'array_agg({name} ORDER BY bucket) AS {name}' for name in names)
+    sql += f"""
+SELECT key, {arrays}
+FROM {'windowed' if window is not None else 'series'}
+GROUP BY key, first_bucket
+ORDER BY first_bucket, key
+"""
+    return sql
+
+
+def densify(rows, key, bucket, fields, starts):
+    """
+    series_sql's output from rows grouped by (`key`, `bucket`): a namedtuple
+    (key, one list per field) per key, keys in order of first appearance,
+    every bucket of `starts` present (0 where there was no row). Values are
+    kept as they are, so the result shapes exactly like the SQL path's.
+    """
+    Series = namedtuple('Series', ['key'] + list(fields))
+    if not rows:
+        return []
+    keys = [getattr(row, key) for row in rows] if key else [None] * len(rows)
+    order = list(dict.fromkeys(keys))
+    index = {value: i for i, value in enumerate(order)}
+
+    series_rows = np.fromiter((index[value] for value in keys), dtype=np.intp, count=len(rows))
+    positions = np.searchsorted(starts, np.array([getattr(row, bucket) for row in rows], dtype='datetime64[D]'))
+    columns = []
+    for field in fields:
+        dense = np.zeros((len(order), len(starts)), dtype=object)
+        values = np.empty(len(rows), dtype=object)
+        values[:] = [getattr(row, field) for row in rows]
+        dense[series_rows, positions] = values
+        columns.append(dense)
+    return [Series(value, *(column[i].tolist() for column in columns)) for i, value in enumerate(order)]